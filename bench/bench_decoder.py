@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# bench_decoder.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Decoding throughput of the IbPy reader against *untws.fast_decoder*, on a
+recorded-like stream of TWS messages (mostly ticks, some portfolio
+updates) replayed from memory, so that only the decoding and dispatch are
+measured. Both decoders are first checked to produce the same messages.
+Results are printed as JSON. Usage:
+
+    python bench/bench_decoder.py [--messages N] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+from random import Random
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.EReader import EReader
+from ib.lib import DataInputStream
+from ib.opt import message
+from ib.opt.dispatcher import Dispatcher
+from ib.opt.receiver import Receiver
+from untws.fast_decoder import FAST_MESSAGE_TYPES, _FastReader, _SocketBuffer
+
+SERVER_VERSION = 70
+
+def encode(*fields):
+    return ''.join('%s\0' % f for f in fields).encode('ascii')
+
+def make_stream(count, seed=0):
+    """*count* messages: 60% prices, 25% option computations..."""
+    random = Random(seed)
+    out = []
+    for i in range(count):
+        ticker_id = random.randint(1, 500)
+        kind = random.random()
+        if kind < 0.6:
+            out.append(encode(1, 6, ticker_id, random.choice((1, 2, 4)),
+                '%.2f' % random.uniform(1, 200), random.randint(1, 900), 1))
+        elif kind < 0.85:
+            out.append(encode(21, 6, ticker_id, random.choice((10, 11, 13)),
+                '%.4f' % random.uniform(0.1, 0.9),
+                '%.4f' % random.uniform(-1, 1), '%.2f' % random.uniform(1, 9),
+                0, '%.4f' % random.uniform(0, 0.1),
+                '%.4f' % random.uniform(0, 0.5),
+                '%.4f' % random.uniform(-0.2, 0), '%.2f' % random.uniform(50, 150)))
+        elif kind < 0.97:
+            out.append(encode(2, 6, ticker_id, random.choice((0, 3, 5, 8)),
+                random.randint(1, 100000)))
+        else:
+            out.append(encode(7, 8, ticker_id, 'SYM%d' % ticker_id, 'OPT',
+                '20131220', '%.1f' % (ticker_id % 100 + 50), 'C', 100, 'CBOE',
+                'USD', 'SYM%d  131220C00100000' % ticker_id, 'SYM%d' % ticker_id,
+                random.randint(-10, 10), '1.5', '150.0', '140.0', '10.0',
+                '0.0', 'DU000001'))
+    return b''.join(out)
+
+class ReplaySocket(object):
+    """Serves *data* like a socket would, in chunks of at most *chunk*"""
+
+    def __init__(self, data, chunk=1 << 16):
+        self._data = memoryview(data)
+        self._offset = 0
+        self._chunk = chunk
+
+    def recv(self, size):
+        data = self._data[self._offset:self._offset + min(size, self._chunk)]
+        self._offset += len(data)
+        return data.tobytes()
+
+    def recv_into(self, view):
+        size = min(len(view), self._chunk, len(self._data) - self._offset)
+        view[:size] = self._data[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+def client():
+    client = EClientSocket(None)
+    client.m_serverVersion = SERVER_VERSION
+    return client
+
+def run_ibpy(data, listener):
+    dispatcher = Dispatcher()
+    dispatcher.register(
+        listener,
+        *[getattr(message, t) for t in FAST_MESSAGE_TYPES]
+    )
+    receiver = Receiver(dispatcher)
+    parent = client()
+    parent.m_anyWrapper = receiver
+    reader = EReader('EReader', parent, DataInputStream(ReplaySocket(data)))
+    try:
+        while reader.processMsg(reader.readInt()):
+            pass
+    except Exception:
+        # the end of the stream
+        pass
+
+def run_fast(data, listener, reuse_messages=True):
+    listeners = dict((name, (listener,)) for name in FAST_MESSAGE_TYPES)
+    sock = ReplaySocket(data)
+    reader = _FastReader(
+        client(),
+        DataInputStream(sock),
+        _SocketBuffer(sock),
+        listeners,
+        reuse_messages
+    )
+    try:
+        while reader.processMsg(reader.readInt()):
+            pass
+    except EOFError:
+        pass
+
+def snapshot(msg):
+    values = []
+    for name, value in msg.items():
+        if name == 'contract':
+            value = sorted(value.__dict__.items())
+        values.append((name, value))
+    return msg.typeName, values
+
+def check(data):
+    """Both decoders must produce the same messages"""
+    expected, got = [], []
+    run_ibpy(data, lambda msg: expected.append(snapshot(msg)))
+    run_fast(data, lambda msg: got.append(snapshot(msg)))
+    assert expected == got, "the decoders disagree"
+    return len(got)
+
+def bench(run, data, repeat):
+    counted = [0]
+    def listener(msg):
+        counted[0] += 1
+    best = None
+    for i in range(repeat):
+        counted[0] = 0
+        start = default_timer()
+        run(data, listener)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'messages': counted[0],
+        'seconds': best,
+        'messages_per_second': counted[0] / best,
+        'us_per_message': best / counted[0] * 1e6
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--messages', type=int, default=100000,
+        help='number of messages in the stream')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+
+    data = make_stream(args.messages)
+    results = {
+        'python': platform.python_version(),
+        'stream_bytes': len(data),
+        'checked_messages': check(make_stream(5000, seed=1)),
+        'ibpy': bench(run_ibpy, data, args.repeat),
+        'fast': bench(run_fast, data, args.repeat),
+        'fast_no_reuse': bench(
+            lambda data, listener: run_fast(data, listener, False),
+            data,
+            args.repeat
+        )
+    }
+    results['speedup'] = results['ibpy']['seconds'] / \
+        results['fast']['seconds']
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# bench_instruments.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Time taken to build the instruments of a position load.
+
+Builds the instruments of *rows* option positions spread over *contracts*
+distinct contracts and *expiries* distinct expiries, as *get_positions*
+does for each *updatePortfolio* row. Usage:
+
+    python bench/bench_instruments.py [rows] [contracts] [expiries]
+"""
+
+import os
+import sys
+from datetime import datetime, date, timedelta
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from untws import instrument
+
+class FakeContract(object):
+    """The contract fields read when building an instrument"""
+
+    def __init__(self, conid, expiry):
+        self.m_conId = conid
+        self.m_secType = 'OPT'
+        self.m_localSymbol = 'IBM   %sP%08d' % (expiry[2:], conid * 1000)
+        self.m_symbol = 'IBM'
+        self.m_currency = 'USD'
+        self.m_primaryExch = 'CBOE'
+        self.m_multiplier = '100'
+        self.m_right = 'P'
+        self.m_strike = float(conid)
+        self.m_expiry = expiry
+
+class FakeConnection(object):
+    """Stands in for the IBConnection the instruments belong to"""
+
+    contract_cache = None
+
+def strptime_expiry(expiry):
+    return datetime.strptime(expiry, '%Y%m%d').date()
+
+def load(factory, rows, connection):
+    start = default_timer()
+    for row in rows:
+        factory(connection, row)
+    return default_timer() - start
+
+def best(factory, rows, repeat=5, setup=None):
+    # the recently used instruments are kept per connection, as for
+    # get_positions
+    connection = FakeConnection()
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        times.append(load(factory, rows, connection))
+    return min(times)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    expiries = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    first = date(2013, 9, 20)
+    expiry_strings = [
+        (first + timedelta(days=7 * i)).strftime('%Y%m%d')
+        for i in range(expiries)
+    ]
+    contracts = [
+        FakeContract(i + 1, expiry_strings[i % expiries])
+        for i in range(distinct)
+    ]
+    rows = [contracts[i % distinct] for i in range(count)]
+
+    # every row built from scratch, parsing expiries with strptime
+    parse_expiry = instrument.parse_expiry
+    instrument.parse_expiry = strptime_expiry
+    try:
+        baseline = best(instrument._create_instrument, rows)
+    finally:
+        instrument.parse_expiry = parse_expiry
+    # every row built from scratch, with the memoized expiry parsing
+    parsed = best(instrument._create_instrument, rows)
+    # the first load, through the factory cache
+    cold = best(
+        instrument.create_instrument,
+        rows,
+        setup=instrument.clear_instrument_cache
+    )
+    # later loads of the same positions
+    warm = best(instrument.create_instrument, rows)
+
+    print('%d rows, %d contracts, %d expiries' % (count, distinct, expiries))
+    for name, seconds in (
+        ('strptime, no cache', baseline),
+        ('memoized expiries', parsed),
+        ('factory, first load', cold),
+        ('factory, next loads', warm)
+    ):
+        print('%-20s %8.2f ms  %5.1fx' % \
+            (name, seconds * 1000, baseline / seconds))
+
+if __name__ == '__main__':
+    main()
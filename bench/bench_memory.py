@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# bench_memory.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Memory used by positions, with and without instrument interning.
+
+Builds *positions* Position objects spread over *contracts* distinct
+option contracts, and reports the memory allocated per position (requires
+Python 3, for tracemalloc). Usage:
+
+    python bench/bench_memory.py [positions] [contracts]
+"""
+
+import os
+import sys
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from untws import instrument
+from untws.position import Position
+
+class FakeContract(object):
+    """The contract fields read when building an instrument"""
+
+    def __init__(self, conid):
+        self.m_conId = conid
+        self.m_secType = 'OPT'
+        self.m_localSymbol = 'IBM   130921P%08d' % (conid * 1000)
+        self.m_symbol = 'IBM'
+        self.m_currency = 'USD'
+        self.m_primaryExch = 'CBOE'
+        self.m_multiplier = '100'
+        self.m_right = 'P'
+        self.m_strike = float(conid)
+        self.m_expiry = '20130921'
+
+def build(contracts, count):
+    return [
+        Position(None, 'DU%d' % (i % 10), contracts[i % len(contracts)],
+            float(i), 1.0, 1.0, 1.0, 0.0, 0.0)
+        for i in range(count)
+    ]
+
+def measure(contracts, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    positions = build(contracts, count)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    distinct = len(set(id(p.instrument) for p in positions))
+    return used, distinct
+
+def main():
+    if tracemalloc is None:
+        print('bench_memory.py requires Python 3 (for tracemalloc), skipped')
+        return
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    contracts = [FakeContract(i + 1) for i in range(distinct)]
+
+    used, instruments = measure(contracts, count)
+    print('interned: %.0f bytes/position, %d instrument objects' % \
+        (float(used) / count, instruments))
+
+    # the same positions, each with its own instrument object
+    create_instrument = instrument.create_instrument
+    instrument.create_instrument = instrument._create_instrument
+    try:
+        import untws.position
+        untws.position.create_instrument = instrument._create_instrument
+        used, instruments = measure(contracts, count)
+    finally:
+        untws.position.create_instrument = create_instrument
+        instrument.create_instrument = create_instrument
+    print('unshared: %.0f bytes/position, %d instrument objects' % \
+        (float(used) / count, instruments))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# bench_requests.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Latency, throughput and memory of the main requests, against a simulated
+TWS (see *untws.simulator*), so that regressions in the hot paths show up
+before they reach production. Results are printed as JSON. Usage:
+
+    python bench/bench_requests.py [--quick] [--latency SECONDS]
+        [--output FILE]
+
+Memory is only measured on Python 3 (it requires tracemalloc).
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+from timeit import default_timer
+try:
+    from Queue import Queue
+except ImportError:
+    # python 3
+    from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ib.opt import message
+from untws.connection import IBConnection
+from untws.dispatcher import MessageDispatcher
+from untws.simulator import SimulatedTransport, synthetic_portfolio
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def percentiles(samples):
+    """Summarizes a list of durations (in seconds) in milliseconds"""
+    samples = sorted(samples)
+    def at(p):
+        return samples[min(int(p / 100.0 * len(samples)), len(samples) - 1)]
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': at(50) * 1000,
+        'p90_ms': at(90) * 1000,
+        'p99_ms': at(99) * 1000,
+        'max_ms': samples[-1] * 1000
+    }
+
+def connect(latency, portfolio=()):
+    transport = SimulatedTransport(portfolio=portfolio, latency=latency)
+    # no rate limiting: we measure our own overhead, not the pacing
+    return IBConnection(
+        'localhost',
+        0,
+        max_rate=1e9,
+        burst=1000000,
+        timeout=600,
+        transport=transport
+    )
+
+def bench_current_time(latency, count):
+    con = connect(latency)
+    con.get_current_time()
+    samples = []
+    for i in range(count):
+        start = default_timer()
+        con.get_current_time()
+        samples.append(default_timer() - start)
+    con.disconnect()
+    return percentiles(samples)
+
+def bench_snapshots(latency, sizes, repeat):
+    results = {}
+    con = connect(latency)
+    portfolio = synthetic_portfolio(max(sizes))
+    for size in sizes:
+        instruments = [p['contract'] for p in portfolio[:size]]
+        samples = []
+        for i in range(repeat):
+            start = default_timer()
+            quotes = con.get_market_data_many(instruments, max_in_flight=100)
+            samples.append(default_timer() - start)
+            assert None not in quotes
+        summary = percentiles(samples)
+        summary['instruments_per_second'] = size / (summary['p50_ms'] / 1000)
+        results[str(size)] = summary
+    con.disconnect()
+    return results
+
+def bench_positions(latency, sizes, repeat):
+    results = {}
+    for size in sizes:
+        con = connect(latency, synthetic_portfolio(size, ('DU1', 'DU2')))
+        samples = []
+        for i in range(repeat):
+            start = default_timer()
+            positions = con.get_positions()
+            samples.append(default_timer() - start)
+            assert len(positions) == size
+        summary = percentiles(samples)
+        summary['positions_per_second'] = size / (summary['p50_ms'] / 1000)
+        if tracemalloc is not None:
+            del positions
+            gc.collect()
+            tracemalloc.start()
+            positions = con.get_positions()
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            summary['retained_bytes_per_position'] = float(retained) / size
+            summary['peak_bytes'] = peak
+        results[str(size)] = summary
+        con.disconnect()
+    return results
+
+def bench_dispatch(count):
+    """Time spent in the reader thread per message, excluding IbPy"""
+    results = {}
+    ticks = [
+        message.tickPrice(tickerId=1, field=1, price=1.0, canAutoExecute=0)
+        for i in range(1000)
+    ]
+    handlers = (
+        # nobody waiting for the message
+        ('unrouted', None),
+        ('noop', lambda msg: None),
+        # what a blocking request waits on
+        ('mailbox', Queue().put)
+    )
+    for name, handler in handlers:
+        dispatcher = MessageDispatcher()
+        if handler is not None:
+            dispatcher.subscribe(1, handler)
+        start = default_timer()
+        for i in range(count // len(ticks)):
+            for msg in ticks:
+                dispatcher.dispatch(msg)
+        elapsed = default_timer() - start
+        results[name] = {
+            'count': count,
+            'ns_per_message': elapsed / count * 1e9
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--quick', action='store_true',
+        help='smaller sizes, for a smoke test')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='simulated TWS latency, in seconds')
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+
+    if args.quick:
+        snapshot_sizes, position_sizes, repeat = [1, 100, 1000], [100], 3
+        round_trips, messages = 100, 100000
+    else:
+        snapshot_sizes = [1, 100, 10000]
+        position_sizes = [100, 1000, 10000, 50000]
+        repeat, round_trips, messages = 5, 1000, 1000000
+
+    results = {
+        'python': platform.python_version(),
+        'latency_s': args.latency,
+        'get_current_time': bench_current_time(args.latency, round_trips),
+        'get_market_data_many': bench_snapshots(
+            args.latency,
+            snapshot_sizes,
+            repeat
+        ),
+        'get_positions': bench_positions(args.latency, position_sizes, repeat),
+        'dispatch': bench_dispatch(messages)
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# conftest.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Fixtures running *IBConnection* against the simulated TWS.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ib.ext.Contract import Contract
+from ib.ext.ContractDetails import ContractDetails
+from untws.connection import IBConnection
+from untws.simulator import SimulatedTransport, synthetic_portfolio
+
+def make_contract(conid, sec_type='STK', symbol=None):
+    c = Contract()
+    c.m_conId = conid
+    c.m_secType = sec_type
+    c.m_symbol = symbol or 'SYM%d' % conid
+    c.m_localSymbol = c.m_symbol
+    c.m_exchange = 'SMART'
+    c.m_currency = 'USD'
+    return c
+
+class SilentTransport(SimulatedTransport):
+    """Never answers the current time or market data snapshots"""
+
+    def reqCurrentTime(self):
+        self._count('reqCurrentTime')
+
+    def reqMktData(self, tickerId, contract, genericTickList, snapshot):
+        self._count('reqMktData')
+
+class PartialTransport(SimulatedTransport):
+    """Never answers the snapshots of the contracts whose conId is *silent*"""
+
+    def __init__(self, silent, **kwargs):
+        SimulatedTransport.__init__(self, **kwargs)
+        self.silent = set(silent)
+
+    def reqMktData(self, tickerId, contract, genericTickList, snapshot):
+        if contract.m_conId in self.silent:
+            self._count('reqMktData')
+            return
+        SimulatedTransport.reqMktData(
+            self,
+            tickerId,
+            contract,
+            genericTickList,
+            snapshot
+        )
+
+# fields a contract details request is matched on, when it sets them
+DETAILS_FIELDS = (
+    'm_conId', 'm_secType', 'm_symbol', 'm_expiry', 'm_strike', 'm_right',
+    'm_exchange', 'm_currency', 'm_tradingClass'
+)
+
+class DetailsTransport(SimulatedTransport):
+    """
+    Also answers contract details requests, with the *contracts* matching
+    every field the request sets. The time of each request is kept in
+    *detail_requests*.
+    """
+
+    def __init__(self, contracts=(), **kwargs):
+        SimulatedTransport.__init__(self, **kwargs)
+        self.contracts = list(contracts)
+        self.detail_requests = []
+
+    def reqContractDetails(self, reqId, contract):
+        self._count('reqContractDetails')
+        self.detail_requests.append(time.time())
+        for c in self.contracts:
+            if all(getattr(contract, f) in (None, '', 0, 0.0) or
+                    getattr(contract, f) == getattr(c, f)
+                    for f in DETAILS_FIELDS):
+                details = ContractDetails()
+                details.m_summary = c
+                self._deliver(0, 'contractDetails', {
+                    'reqId': reqId,
+                    'contractDetails': details
+                })
+        self._deliver(0, 'contractDetailsEnd', {'reqId': reqId})
+
+def wait_for(condition, timeout=2.0):
+    """Waits for *condition()* to hold, returning its last value"""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+@pytest.fixture
+def transport():
+    return SimulatedTransport(portfolio=synthetic_portfolio(10))
+
+@pytest.fixture
+def connect():
+    """Returns a function connecting to a simulated TWS"""
+    connections = []
+    def connect(transport=None, **kwargs):
+        kwargs.setdefault('timeout', 5)
+        kwargs.setdefault('max_rate', 1000)
+        kwargs.setdefault('burst', 100)
+        con = IBConnection(
+            'localhost',
+            0,
+            transport=transport or SimulatedTransport(),
+            **kwargs
+        )
+        connections.append(con)
+        return con
+    yield connect
+    for con in connections:
+        con.disconnect()
+
+@pytest.fixture
+def connection(connect, transport):
+    return connect(transport)
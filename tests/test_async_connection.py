@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_async_connection.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+from datetime import datetime
+
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from conftest import make_contract, wait_for, SilentTransport
+from untws.async_connection import AsyncIBConnection
+from untws.connection import RequestTimeout
+from untws.simulator import SimulatedTransport, synthetic_portfolio
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture
+def connect_async(loop):
+    """Returns a function connecting to a simulated TWS"""
+    connections = []
+    def connect(transport):
+        con = AsyncIBConnection(
+            'localhost',
+            0,
+            loop=loop,
+            transport=transport,
+            timeout=5,
+            max_rate=1000,
+            burst=100
+        )
+        connections.append(con)
+        return con
+    yield connect
+    for con in connections:
+        con.blocking.disconnect()
+
+def handlers(con):
+    """The keys requests have handlers for"""
+    keys = set(con.blocking._dispatcher._handlers)
+    # the connection's own order updates
+    keys.discard('orders')
+    return keys
+
+def test_requests_are_answered(connect_async, loop):
+    con = connect_async(SimulatedTransport(portfolio=synthetic_portfolio(10)))
+    now, positions, quote = loop.run_until_complete(asyncio.gather(
+        con.get_current_time(),
+        con.get_positions(),
+        con.get_market_data(make_contract(1))
+    ))
+    assert isinstance(now, datetime)
+    assert len(positions) == 10
+    assert quote.last == 51
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not handlers(con)
+
+class LateTransport(SimulatedTransport):
+    """Sends portfolio updates right after the end of the download"""
+
+    def reqAccountUpdates(self, subscribe, acctCode):
+        SimulatedTransport.reqAccountUpdates(self, subscribe, acctCode)
+        if subscribe:
+            for fields in self.portfolio:
+                self._deliver(0, 'updatePortfolio', fields)
+
+def test_positions_are_not_added_after_the_download(connect_async, loop):
+    con = connect_async(LateTransport(portfolio=synthetic_portfolio(10)))
+    future = con.get_positions()
+    # every message reaches the reader thread before the event loop runs
+    time.sleep(0.1)
+    positions = loop.run_until_complete(future)
+    assert len(positions) == 10
+    loop.run_until_complete(asyncio.sleep(0))
+    assert 'account' not in handlers(con)
+    # the account updates subscription was given back
+    assert len(con.blocking.get_positions()) == 10
+
+def test_current_time_times_out(connect_async, loop):
+    con = connect_async(SilentTransport())
+    with pytest.raises(RequestTimeout):
+        loop.run_until_complete(con.get_current_time(timeout=0.05))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert 'currentTime' not in handlers(con)
+
+def test_cancelled_requests_unsubscribe(connect_async, loop):
+    con = connect_async(SilentTransport())
+    futures = [
+        con.get_current_time(),
+        con.get_market_data(make_contract(1))
+    ]
+    requests = con.blocking.connection.requests
+    assert wait_for(lambda: requests.get('reqMktData') == 1)
+    for future in futures:
+        future.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not handlers(con)
+    assert wait_for(lambda: requests.get('cancelMktData', 0) == 1)
+
+def test_snapshot_times_out_and_is_cancelled(connect_async, loop):
+    con = connect_async(SilentTransport())
+    with pytest.raises(RequestTimeout):
+        loop.run_until_complete(
+            con.get_market_data(make_contract(1), timeout=0.05)
+        )
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not handlers(con)
+    requests = con.blocking.connection.requests
+    assert wait_for(lambda: requests.get('cancelMktData', 0) == 1)
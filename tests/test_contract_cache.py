@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_contract_cache.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+
+from conftest import make_contract
+from untws.contract_cache import ContractCache, CONTRACT_FIELDS
+
+def fields(contract):
+    return [getattr(contract, f) for f in CONTRACT_FIELDS]
+
+def test_contracts_survive_a_reload(tmpdir):
+    path = str(tmpdir.join('contracts.db'))
+    cache = ContractCache(path)
+    # an option whose right and multiplier are unset: IbPy decodes empty
+    # fields as None
+    option = make_contract(7, 'OPT', 'IBM')
+    option.m_expiry = '20131018'
+    option.m_strike = 185.0
+    option.m_right = None
+    option.m_multiplier = None
+    request = make_contract(0, 'OPT', 'IBM')
+    request.m_localSymbol = None
+    cache.put(option, request)
+    cache.close()
+
+    cache = ContractCache(path)
+    cached = cache.get(7)
+    assert fields(cached) == fields(option)
+    assert cached.m_right is None
+    assert cached.m_multiplier is None
+    assert type(cached.m_symbol) is str
+    assert cache.lookup(option) is cached
+    assert cache.lookup(request) is cached
+    cache.close()
+
+def test_expired_contracts_are_ignored():
+    cache = ContractCache(ttl=0.05)
+    cache.put(make_contract(1))
+    assert cache.get(1) is not None
+    time.sleep(0.1)
+    assert cache.get(1) is None
+    assert cache.lookup(make_contract(1)) is None
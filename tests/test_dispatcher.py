@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_dispatcher.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+from datetime import datetime
+
+import pytest
+from ib.opt import message
+
+from conftest import make_contract
+from untws.connection import IBError
+from untws.dispatcher import MessageDispatcher, is_warning
+from untws.metrics import Metrics
+from untws.simulator import SimulatedTransport
+
+def test_transport_rejects_listeners_registered_by_name():
+    transport = SimulatedTransport()
+    with pytest.raises(ValueError):
+        transport.register(lambda msg: None, 'tickPrice')
+
+def test_transport_keys_listeners_by_class_name():
+    transport = SimulatedTransport()
+    received = []
+    transport.register(received.append, message.currentTime)
+    transport.register(received.append, 'CurrentTime')
+    transport.connect()
+    try:
+        transport.reqCurrentTime()
+        transport.reqCurrentTime()
+        for i in range(100):
+            if len(received) == 4:
+                break
+            time.sleep(0.01)
+    finally:
+        transport.disconnect()
+    assert [m.typeName for m in received] == ['currentTime'] * 4
+
+def test_requests_are_answered_through_the_transport(connection):
+    assert isinstance(connection.get_current_time(), datetime)
+    assert len(connection.get_positions()) == 10
+
+def test_ticks_are_routed_by_ticker_id(connection):
+    quotes = connection.get_market_data_many(
+        [make_contract(i + 1) for i in range(20)]
+    )
+    assert [round(q.last) for q in quotes] == [51 + i for i in range(20)]
+
+def test_errors_are_routed_to_their_request(connection):
+    connection.connection.market.ticks = lambda *args: None
+    with pytest.raises(IBError) as error:
+        connection.get_market_data(make_contract(1))
+    assert error.value.code == 200
+
+def test_unrouted_messages_are_counted_as_dropped():
+    metrics = Metrics()
+    dispatcher = MessageDispatcher(metrics)
+    received = []
+    dispatcher.subscribe(7, received.append)
+    dispatcher.dispatch(message.tickPrice(tickerId=7, field=1, price=1.0,
+        canAutoExecute=0))
+    dispatcher.dispatch(message.tickPrice(tickerId=8, field=1, price=1.0,
+        canAutoExecute=0))
+    assert len(received) == 1
+    assert metrics.dropped == {'tickPrice': 1}
+
+def test_streams_receive_messages_without_request_ids():
+    dispatcher = MessageDispatcher()
+    with dispatcher.mailbox('account') as mailbox:
+        dispatcher.dispatch(message.accountDownloadEnd(accountName='DU1'))
+        assert mailbox.get(False).typeName == 'accountDownloadEnd'
+
+def test_farm_messages_are_warnings():
+    assert is_warning(message.error(id=-1, errorCode=2104, errorMsg=''))
+    assert not is_warning(message.error(id=1, errorCode=200, errorMsg=''))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_futures.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+from datetime import date, timedelta
+
+from conftest import DetailsTransport, make_contract
+from untws.contract_cache import ContractCache
+from untws.instrument import create_instrument
+
+def make_future(conid, symbol, expiry):
+    c = make_contract(conid, 'FUT', symbol)
+    c.m_expiry = expiry.strftime('%Y%m%d')
+    c.m_exchange = 'GLOBEX'
+    c.m_multiplier = '50'
+    return c
+
+def make_futures():
+    """Three months of ES and two of NQ, listed out of order"""
+    today = date.today()
+    return [
+        make_future(1, 'ES', today + timedelta(days=120)),
+        make_future(2, 'ES', today + timedelta(days=30)),
+        make_future(3, 'ES', today + timedelta(days=210)),
+        make_future(4, 'NQ', today + timedelta(days=30)),
+        make_future(5, 'NQ', today + timedelta(days=120))
+    ]
+
+def test_curves_are_looked_up_together(connect):
+    transport = DetailsTransport(make_futures(), latency=0.2)
+    cache = ContractCache()
+    con = connect(transport, contract_cache=cache)
+    curves = con.get_futures_curves(['ES', 'NQ'])
+    assert transport.requests['reqContractDetails'] == 2
+    # one request waiting for the previous one would be 0.2s behind it
+    requests = transport.detail_requests
+    assert max(requests) - min(requests) < 0.1
+    assert [c.m_conId for c in curves['ES']] == [2, 1, 3]
+    assert [c.m_conId for c in curves['NQ']] == [4, 5]
+    assert curves['ES'].expiries == sorted(curves['ES'].expiries)
+    assert cache.get(3) is curves['ES'][2]
+
+def test_futures_are_created_from_the_cached_curve(connect):
+    transport = DetailsTransport(make_futures())
+    con = connect(transport)
+    curve = con.get_futures_curve('ES')
+    assert con.create_future('ES') is curve[0]
+    assert con.create_future('ES', roll_days=60) is curve[1]
+    assert con.create_future('ES', curve.months[2]) is curve[2]
+    assert con.create_future('ES', curve.expiries[1]) is curve[1]
+    assert transport.requests['reqContractDetails'] == 1
+    con.get_futures_curve('ES', refresh=True)
+    assert transport.requests['reqContractDetails'] == 2
+
+def test_futures_options_are_fully_described(connection):
+    expiry = date.today() + timedelta(days=30)
+    contract = connection.create_future_option(
+        'ES',
+        expiry,
+        2000,
+        'call',
+        multiplier=50
+    )
+    assert (contract.m_secType, contract.m_expiry, contract.m_strike,
+        contract.m_right, contract.m_multiplier) == \
+        ('FOP', expiry.strftime('%Y%m%d'), 2000.0, 'C', '50')
+    assert connection.connection.requests.get('reqContractDetails') is None
+    contract.m_conId = 6
+    option = create_instrument(connection, contract)
+    assert option.contract_size == '50'
+    assert option.option_type == 'call'
+    assert option.expiration_date == expiry
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_historical.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from conftest import make_contract, wait_for
+from untws.connection import RequestTimeout
+from untws.historical import BarCache
+from untws.simulator import SimulatedTransport
+
+# the close of each daily bar is the number of days since this one
+FIRST_DAY = datetime(2010, 1, 1)
+
+class BarsTransport(SimulatedTransport):
+    """
+    Also answers daily historical data requests, starting one bar early so
+    that consecutive requests overlap. Does not answer them at all unless
+    *answer*. The time of each request is kept in *bar_requests*.
+    """
+
+    def __init__(self, answer=True, **kwargs):
+        SimulatedTransport.__init__(self, **kwargs)
+        self.answer = answer
+        self.bar_requests = []
+
+    def reqHistoricalData(self, tickerId, contract, endDateTime, durationStr,
+        barSizeSetting, whatToShow, useRTH, formatDate):
+        self._count('reqHistoricalData')
+        self.bar_requests.append(time.time())
+        if not self.answer:
+            return
+        end = datetime.strptime(endDateTime, '%Y%m%d %H:%M:%S GMT')
+        days = int(durationStr.split()[0])
+        for offset in range(-1, days):
+            day = end - timedelta(days=days - offset)
+            close = float((day - FIRST_DAY).days)
+            self._deliver(0, 'historicalData', {
+                'reqId': tickerId,
+                'date': day.strftime('%Y%m%d'),
+                'open': close,
+                'high': close,
+                'low': close,
+                'close': close,
+                'volume': 100,
+                'count': 10,
+                'WAP': close,
+                'hasGaps': False
+            })
+        self._deliver(0, 'historicalData', {
+            'reqId': tickerId,
+            'date': 'finished-%s' % endDateTime,
+            'open': -1,
+            'high': -1,
+            'low': -1,
+            'close': -1,
+            'volume': -1,
+            'count': -1,
+            'WAP': -1,
+            'hasGaps': False
+        })
+
+    def cancelHistoricalData(self, tickerId):
+        self._count('cancelHistoricalData')
+
+def test_long_ranges_are_split_and_stitched(connect):
+    transport = BarsTransport(latency=0.2)
+    con = connect(transport)
+    end = FIRST_DAY + timedelta(days=800)
+    bars = con.get_historical_data(make_contract(1), FIRST_DAY, end)
+    assert transport.requests['reqHistoricalData'] == 3
+    # one request waiting for the previous one would be 0.2s behind it
+    requests = transport.bar_requests
+    assert max(requests) - min(requests) < 0.1
+    assert list(bars['close']) == list(range(800))
+    assert bars['time'][0] == np.datetime64('2010-01-01T00:00:00')
+    assert (np.diff(bars['time']) == np.timedelta64(86400, 's')).all()
+    assert bars['volume'].dtype == np.int64
+
+def test_cached_bars_are_not_downloaded_again(connect):
+    transport = BarsTransport()
+    con = connect(transport, bar_cache=BarCache())
+    end = FIRST_DAY + timedelta(days=300)
+    first = con.get_historical_data(make_contract(1), FIRST_DAY, end)
+    assert transport.requests['reqHistoricalData'] == 1
+    again = con.get_historical_data(make_contract(1), FIRST_DAY, end)
+    assert transport.requests['reqHistoricalData'] == 1
+    assert list(again['close']) == list(first['close'])
+    # only the 100 days which are not cached yet are requested
+    later = con.get_historical_data(
+        make_contract(1),
+        FIRST_DAY + timedelta(days=200),
+        end + timedelta(days=100)
+    )
+    assert transport.requests['reqHistoricalData'] == 2
+    assert list(later['close']) == list(range(200, 400))
+
+def test_unanswered_bars_time_out_and_are_cancelled(connect):
+    transport = BarsTransport(answer=False)
+    con = connect(transport)
+    end = FIRST_DAY + timedelta(days=800)
+    with pytest.raises(RequestTimeout):
+        con.get_historical_data(make_contract(1), FIRST_DAY, end, timeout=0.1)
+    assert wait_for(
+        lambda: transport.requests.get('cancelHistoricalData') == 3
+    )
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_instrument.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+from datetime import date
+
+import pytest
+
+from conftest import make_contract
+from untws.instrument import create_instrument, parse_expiry, \
+    clear_instrument_cache, _recent
+from untws.simulator import SimulatedTransport, synthetic_portfolio
+
+def test_expiries_are_parsed():
+    assert parse_expiry('20131018') == date(2013, 10, 18)
+
+def test_position_loads_share_instruments(connection):
+    first = dict((p.instrument.conid, p.instrument)
+        for p in connection.get_positions())
+    second = connection.get_positions()
+    assert all(p.instrument is first[p.instrument.conid] for p in second)
+
+def test_recent_instruments_are_kept_per_connection(connect):
+    contract = make_contract(1)
+    first, second = connect(), connect()
+    instrument = create_instrument(first, contract)
+    assert create_instrument(first, contract) is instrument
+    assert create_instrument(second, contract).connection is second
+    clear_instrument_cache()
+    assert _recent(first).get(1) is None
+    assert _recent(None) is None
+
+def test_positions_and_instruments_are_slotted(connection):
+    position = connection.get_positions()[0]
+    for value in (position, position.instrument):
+        assert not hasattr(value, '__dict__')
+        with pytest.raises(AttributeError):
+            value.note = 'not stored'
+
+def test_positions_in_one_contract_share_an_instrument(connect):
+    # the same contracts, held by two accounts
+    portfolio = synthetic_portfolio(4, accounts=('DU1',))
+    portfolio += [dict(p, accountName='DU2') for p in portfolio]
+    connection = connect(SimulatedTransport(portfolio=portfolio))
+    positions = connection.get_all_positions()
+    first = [p.instrument for p in positions['DU1']]
+    assert all(p.instrument is i for p, i in zip(positions['DU2'], first))
+    # still shared while held, once the recent instruments are forgotten
+    clear_instrument_cache()
+    again = connection.get_all_positions()['DU1']
+    assert all(p.instrument is i for p, i in zip(again, first))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_market_data.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+
+import pytest
+
+from conftest import make_contract, wait_for, PartialTransport, \
+    SilentTransport
+from untws.connection import RequestTimeout
+from untws.simulator import SimulatedTransport
+
+def handlers(con):
+    """The keys requests have handlers for"""
+    keys = set(con._dispatcher._handlers)
+    # the connection's own order updates
+    keys.discard('orders')
+    return keys
+
+def test_unanswered_snapshot_times_out_and_is_cancelled(connect):
+    con = connect(SilentTransport())
+    start = time.time()
+    with pytest.raises(RequestTimeout):
+        con.get_market_data(make_contract(1), timeout=0.1)
+    assert 0.1 <= time.time() - start < 1
+    assert wait_for(
+        lambda: con.connection.requests.get('cancelMktData') == 1
+    )
+    assert handlers(con) == set()
+
+def test_connection_timeout_is_the_default(connect):
+    con = connect(SilentTransport(), timeout=0.1)
+    with pytest.raises(RequestTimeout):
+        con.get_current_time()
+    with pytest.raises(RequestTimeout):
+        con.get_market_data(make_contract(1))
+
+def test_late_ticks_do_not_leak_into_later_requests(connect):
+    con = connect(SimulatedTransport(latency=0.2))
+    with pytest.raises(RequestTimeout):
+        con.get_market_data(make_contract(1), timeout=0.05)
+    # the ticks of the first request arrive while this one waits
+    quote = con.get_market_data(make_contract(2))
+    assert quote.bid == pytest.approx(51.99)
+    assert quote.instrument.m_conId == 2
+
+def test_batch_returns_the_quotes_answered_in_time(connect):
+    con = connect(PartialTransport(silent=[2]))
+    contracts = [make_contract(i) for i in (1, 2, 3)]
+    start = time.time()
+    quotes = con.get_market_data_many(contracts, timeout=0.2)
+    assert time.time() - start < 1
+    assert quotes[1] is None
+    assert [q.bid for q in (quotes[0], quotes[2])] == \
+        pytest.approx([50.99, 52.99])
+    assert wait_for(
+        lambda: con.connection.requests.get('cancelMktData') == 1
+    )
+    assert handlers(con) == set()
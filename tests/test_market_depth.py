@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_market_depth.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+from random import Random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from conftest import make_contract
+from untws.connection import SubscriptionLimitExceeded
+from untws.market_depth import DepthBook
+
+INSERT, UPDATE, DELETE = 0, 1, 2
+ASK, BID = 0, 1
+
+def test_insert_update_delete():
+    book = DepthBook(make_contract(1), 1, rows=3)
+    book.update(0, INSERT, BID, 10.0, 1)
+    book.update(0, INSERT, BID, 11.0, 2)
+    book.update(1, INSERT, BID, 10.5, 3)
+    # the book is full: the worst level drops off
+    book.update(0, INSERT, BID, 12.0, 4)
+    book.update(1, DELETE, BID, 0, 0)
+    book.update(0, UPDATE, BID, 12.5, 5)
+    assert book.levels('bid').tolist() == [[12.5, 5], [10.5, 3]]
+    assert book.best_bid == (12.5, 5, None)
+    assert book.best_ask is None
+    assert book.cumulative_size('bid') == 8
+    assert book.cumulative_size('bid', 1) == 5
+
+def test_levels_beyond_the_rows_are_ignored():
+    book = DepthBook(make_contract(1), 1, rows=2)
+    book.update(5, INSERT, ASK, 10.0, 1)
+    assert book.depth('ask') == 0
+
+def test_vwap_walks_the_book():
+    book = DepthBook(make_contract(1), 1, rows=8)
+    random = Random(0)
+    for i in range(2000):
+        depth = book.depth('ask')
+        position = random.randint(0, min(depth, 7))
+        operation = random.choice((INSERT, UPDATE, DELETE)) \
+            if position < depth else INSERT
+        book.update(position, operation, ASK,
+            round(random.uniform(1, 2), 2), random.randint(1, 50))
+        levels = book.levels('ask')
+        size = random.randint(1, 200)
+        expected = float('nan')
+        if len(levels) and size <= levels[:, 1].sum():
+            remaining, notional = size, 0.0
+            for price, available in levels:
+                taken = min(remaining, available)
+                notional += taken * price
+                remaining -= taken
+                if not remaining:
+                    break
+            expected = notional / size
+        assert np.allclose(book.vwap('ask', size), expected, equal_nan=True)
+        assert book.cumulative_size('ask') == levels[:, 1].sum()
+
+def test_snapshot_is_a_consistent_copy():
+    book = DepthBook(make_contract(1), 1, rows=2)
+    book.update(0, INSERT, ASK, 10.0, 1)
+    book.update(0, INSERT, BID, 9.0, 1)
+    snapshot = book.snapshot()
+    book.update(0, UPDATE, ASK, 11.0, 1)
+    assert snapshot.version % 2 == 0
+    assert snapshot.asks.tolist() == [[10.0, 1]]
+    assert snapshot.bids.tolist() == [[9.0, 1]]
+    assert book.mid == 10.0
+
+def test_subscribe_depth(connect):
+    connection = connect(max_depth_subscriptions=1)
+    book = connection.subscribe_depth(make_contract(25), rows=5)
+    assert connection.subscribe_depth(make_contract(25), rows=5) is book
+    with pytest.raises(SubscriptionLimitExceeded):
+        connection.subscribe_depth(make_contract(26))
+    deadline = time.time() + 2
+    while book.depth('ask') < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert book.best_bid[0] == 74.99
+    assert book.best_ask[0] == 75.01
+    assert book.cumulative_size('ask') == 1500
+    connection.unsubscribe_depth(book)
+    assert connection.depth_subscriptions == []
+    requests = connection.connection.requests
+    deadline = time.time() + 2
+    while 'cancelMktDepth' not in requests and time.time() < deadline:
+        time.sleep(0.01)
+    assert requests['cancelMktDepth'] == 1
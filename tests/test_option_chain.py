@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_option_chain.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from conftest import DetailsTransport, make_contract
+from untws.option_chain import OptionChain
+from untws.quote_batch import MISSING_INT
+
+def make_option(conid, right, strike, expiry):
+    c = make_contract(conid, 'OPT', 'IBM')
+    c.m_right = right
+    c.m_strike = strike
+    c.m_expiry = expiry
+    return c
+
+def test_missing_options_are_filled_per_dtype(connection):
+    # no 110 call on the second expiry
+    contracts = [
+        make_option(1, 'C', 100.0, '20131018'),
+        make_option(2, 'C', 110.0, '20131018'),
+        make_option(3, 'C', 100.0, '20131115'),
+        make_option(4, 'P', 100.0, '20131018')
+    ]
+    batch = connection.get_market_data_batch(
+        contracts,
+        fields=['bid', 'bid_size', 'volume']
+    )
+    chain = OptionChain(contracts, batch)
+    assert chain.calls.shape == (2, 2)
+    bid_size = chain.calls.column('bid_size')
+    assert bid_size.dtype == np.int64
+    assert bid_size[1, 1] == MISSING_INT
+    assert (bid_size[[0, 1, 0], [0, 0, 1]] > 0).all()
+    assert np.isnan(chain.calls.bid[1, 1])
+    assert chain.calls.conids[1, 1] == 0
+    assert not chain.calls.available[1, 1]
+
+def test_option_chain_rejects_generic_tick_fields(connection):
+    with pytest.raises(ValueError):
+        connection.get_option_chain('IBM', fields=['implied_vol'])
+    assert 'reqContractDetails' not in connection.connection.requests
+
+def test_option_chain_requests_the_expiries_together(connect):
+    expiries = ['20131018', '20131115', '20131220']
+    contracts = [
+        make_option(10 * i + j + 1, right, strike, expiry)
+        for i, expiry in enumerate(expiries)
+        for j, (right, strike) in enumerate(
+            [('C', 100.0), ('C', 110.0), ('P', 100.0)]
+        )
+    ]
+    # the same call twice, as after an adjustment
+    contracts.append(make_option(99, 'C', 100.0, '20131018'))
+    transport = DetailsTransport(contracts, latency=0.2)
+    con = connect(transport)
+    chain = con.get_option_chain('IBM', expiries=expiries, strikes=[100])
+    assert transport.requests['reqContractDetails'] == 3
+    # one request waiting for the previous one would be 0.2s behind it
+    requests = transport.detail_requests
+    assert max(requests) - min(requests) < 0.1
+    assert [c.m_conId for c in chain.contracts] == [1, 3, 11, 13, 21, 23]
+    assert chain.calls.shape == (1, 3)
+    assert chain.calls.available.all() and chain.puts.available.all()
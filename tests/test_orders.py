@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_orders.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+from conftest import make_contract
+from untws.metrics import Metrics
+from untws.simulator import SimulatedTransport
+
+def test_limit_order_is_filled_at_its_price(connection):
+    order = connection.place_order(
+        make_contract(1),
+        connection.create_order('BUY', 100, limit_price=50.5)
+    )
+    assert order.wait(5)
+    assert order.status == 'Filled'
+    assert order.filled == 100
+    assert order.avg_fill_price == 50.5
+    assert len(order.executions) == 1
+    assert order.ack_latency is not None
+
+def test_order_ids_are_allocated_locally(connection):
+    orders = connection.place_orders([
+        (make_contract(1), connection.create_order('BUY', 1)),
+        (make_contract(2), connection.create_order('SELL', 1))
+    ])
+    assert [o.order_id for o in orders] == [1, 2]
+    assert all(o.wait(5) for o in orders)
+    assert connection.place_order(
+        make_contract(3),
+        connection.create_order('BUY', 1)
+    ).order_id == 3
+
+def test_resting_order_can_be_cancelled(connect):
+    connection = connect(SimulatedTransport(fill_orders=False))
+    order = connection.place_order(
+        make_contract(1),
+        connection.create_order('BUY', 100, limit_price=1.0)
+    )
+    assert not order.wait(0.2)
+    assert order.status == 'Submitted'
+    order.cancel()
+    assert order.wait(5)
+    assert order.status == 'Cancelled'
+    assert order.error is None
+
+class RejectingTransport(SimulatedTransport):
+    """Acknowledges orders, then rejects them"""
+
+    def placeOrder(self, id, contract, order):
+        self._count('placeOrder')
+        self._order_status(id, 'Submitted', 0, order.m_totalQuantity, 0.0)
+        self._deliver(0, 'error', {
+            'id': id,
+            'errorCode': 201,
+            'errorMsg': 'Order rejected - reason:'
+        })
+
+def test_rejection_after_acknowledgement_is_timed_once(connect):
+    metrics = Metrics()
+    # with some latency, as from TWS: the order must be sent (and its
+    # scheduler job known) before it is acknowledged
+    connection = connect(RejectingTransport(latency=0.01), metrics=metrics)
+    order = connection.place_order(
+        make_contract(1),
+        connection.create_order('BUY', 100)
+    )
+    assert order.wait(5)
+    assert order.status == 'Inactive'
+    assert order.error.errorCode == 201
+    requests = metrics.snapshot()['requests']['order_ack']
+    assert requests['total']['count'] == 1
+    assert 'failures' not in requests
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_portfolio.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import pytest
+
+from conftest import wait_for
+from untws.connection import RequestTimeout
+from untws.simulator import SimulatedTransport, synthetic_portfolio
+
+def test_positions_are_served_by_the_tracker(connection):
+    tracker = connection.track_portfolio()
+    assert len(connection.get_positions()) == 10
+    assert len(tracker.changes()) == 10
+    assert connection.connection.requests['reqAccountUpdates'] == 1
+    tracker.stop()
+    assert not tracker.running
+    # a one-shot request again
+    assert len(connection.get_positions()) == 10
+    assert connection.connection.requests['reqAccountUpdates'] >= 3
+
+def test_tracker_is_subscribed_again_after_reconnecting(connect):
+    transport = SimulatedTransport(portfolio=synthetic_portfolio(10))
+    connection = connect(transport)
+    tracker = connection.track_portfolio()
+    tracker.changes()
+    connection.disconnect()
+    # while disconnected, a position is closed and another one changes
+    closed = transport.portfolio.pop()
+    changed = transport.portfolio[0] = \
+        dict(transport.portfolio[0], position=1234)
+    assert connection.reconnect()
+    positions = connection.get_positions()
+    assert transport.requests['reqAccountUpdates'] == 2
+    assert len(positions) == 9
+    account = changed['accountName']
+    assert tracker.position(account, changed['contract'].m_conId).quantity \
+        == 1234
+    assert tracker.position(account, closed['contract'].m_conId) is None
+    changes = dict((p.instrument.conid, p.quantity) for p in tracker.changes())
+    assert changes == {
+        changed['contract'].m_conId: 1234,
+        closed['contract'].m_conId: 0
+    }
+
+def test_tracked_positions_wait_for_the_download(connect):
+    transport = SimulatedTransport(portfolio=synthetic_portfolio(10))
+    connection = connect(transport)
+    connection.track_portfolio()
+    connection.disconnect()
+    transport.latency = 0.5
+    assert connection.reconnect()
+    with pytest.raises(RequestTimeout):
+        connection.get_positions(timeout=0.05)
+    assert len(connection.get_positions(timeout=5)) == 10
+
+def test_all_positions_are_grouped_by_account(connect):
+    portfolio = synthetic_portfolio(12, accounts=('DU1', 'DU2', 'DU3'))
+    transport = SimulatedTransport(portfolio=portfolio)
+    connection = connect(transport)
+    positions = connection.get_all_positions()
+    assert transport.requests['reqPositions'] == 1
+    assert sorted(positions) == ['DU1', 'DU2', 'DU3']
+    for account, held in positions.items():
+        expected = [p for p in portfolio if p['accountName'] == account]
+        assert [(p.instrument.conid, p.quantity, p.average_cost)
+            for p in held] == [(p['contract'].m_conId, p['position'],
+            p['averageCost']) for p in expected]
+        assert all(p.account_name == account and p.price is None
+            for p in held)
+    assert wait_for(lambda: transport.requests.get('cancelPositions') == 1)
+    only = connection.get_all_positions(accounts=['DU2'])
+    assert list(only) == ['DU2'] and len(only['DU2']) == 4
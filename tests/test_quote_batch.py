@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_quote_batch.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from conftest import make_contract, PartialTransport
+from untws.quote_batch import MISSING_INT
+
+def make_option(conid, right, strike):
+    c = make_contract(conid, 'OPT', 'SYM%d' % conid)
+    c.m_right = right
+    c.m_strike = strike
+    c.m_expiry = '20131018'
+    c.m_multiplier = '100'
+    return c
+
+def test_batch_columns_are_typed(connect):
+    con = connect(PartialTransport(silent=[2]))
+    contracts = [make_contract(i) for i in (1, 2, 3)]
+    batch = con.get_market_data_batch(
+        contracts,
+        timeout=0.2,
+        fields=['bid', 'ask', 'last', 'bid_size']
+    )
+    assert list(batch.answered) == [True, False, True]
+    assert list(batch.index) == [1, 2, 3]
+    assert batch.bid[[0, 2]] == pytest.approx([50.99, 52.99])
+    assert np.isnan(batch.bid[1])
+    assert batch.bid_size.dtype == np.int64
+    assert list(batch.bid_size) == [100, MISSING_INT, 100]
+    assert batch.mid[[0, 2]] == pytest.approx(batch.last[[0, 2]])
+    assert batch.spread[[0, 2]] == pytest.approx([0.02, 0.02])
+    assert batch.row(3) == 2
+    with pytest.raises(KeyError):
+        batch.row(4)
+
+def test_batch_rows_read_like_quotes(connection):
+    contract = make_option(7, 'C', 50.0)
+    batch = connection.get_market_data_batch([contract])
+    quote = connection.get_market_data(contract)
+    row = batch[0]
+    assert row.instrument is contract
+    assert sorted(row.available_fields) == sorted(quote.available_fields)
+    assert row.bid == pytest.approx(quote.bid)
+    assert row.option.model.delta == pytest.approx(quote.option.model.delta)
+
+def test_greeks_are_aggregated_over_the_batch(connection):
+    contracts = [make_option(7, 'C', 50.0), make_option(8, 'P', 60.0),
+        make_contract(9)]
+    batch = connection.get_market_data_batch(contracts)
+    delta = batch.greek('delta')
+    assert np.isnan(delta[2])
+    assert delta[0] > 0 > delta[1]
+    assert batch.total('delta', [100, 200, 300]) == \
+        pytest.approx(100 * delta[0] + 200 * delta[1])
+    mid = batch.greek('implied_vol', 'mid')
+    bid = batch.greek('implied_vol', 'bid')
+    assert mid[:2] == pytest.approx(bid[:2] + 0.01)
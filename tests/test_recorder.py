@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_recorder.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from conftest import make_contract
+from untws.recorder import TickRecorder, load_ticks, TICK_PRICE, TICK_SIZE
+from untws.simulator import RecordedMarket, SimulatedTransport
+
+def test_ticks_are_recorded_and_replayed(connect, tmpdir):
+    directory = str(tmpdir)
+    recorder = TickRecorder(directory, flush_interval=0.01)
+    connection = connect(recorder=recorder)
+    contracts = [make_contract(i + 1) for i in range(5)]
+    connection.get_market_data_many(contracts)
+    recorder.close()
+    ticks = load_ticks(directory)
+    assert sorted(set(ticks['conid'])) == [1, 2, 3, 4, 5]
+    last = ticks[(ticks['kind'] == TICK_PRICE) & (ticks['field'] == 4)]
+    assert sorted(last['value']) == [51, 52, 53, 54, 55]
+    assert (ticks['kind'] == TICK_SIZE).any()
+
+    replay = connect(SimulatedTransport(RecordedMarket(ticks)))
+    quotes = replay.get_market_data_many(contracts + [make_contract(99)])
+    assert [q.last for q in quotes[:5]] == [51, 52, 53, 54, 55]
+    assert quotes[5] is None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_risk.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from conftest import wait_for
+from untws.risk import MEASURES
+from untws.simulator import SimulatedTransport, SyntheticMarket, \
+    synthetic_portfolio
+
+def make_portfolio():
+    # two options and two stocks, and the first stock in a second account
+    portfolio = synthetic_portfolio(4, accounts=('DU1', 'DU2'))
+    portfolio.append(dict(portfolio[2], accountName='DU2'))
+    return portfolio
+
+def quotes_by_conid(connection):
+    return dict(
+        (q.instrument.m_conId, q) for q in connection.subscriptions
+    )
+
+def has_ticked(quote):
+    """Whether the quote got its first ticks (the options, their model)"""
+    fields = quote.available_fields
+    if quote.instrument.m_secType == 'OPT':
+        return 'option' in fields and \
+            'model' in quote.option.available_fields
+    return 'bid' in fields and 'ask' in fields
+
+def test_risk_is_joined_with_quotes(connect):
+    connection = connect(SimulatedTransport(portfolio=make_portfolio()))
+    engine = connection.track_risk()
+    quotes = quotes_by_conid(connection)
+    assert sorted(quotes) == [1, 2, 3, 4]
+    # the streams repeat the snapshot the engine started from
+    assert wait_for(lambda: all(map(has_ticked, quotes.values())))
+    assert list(engine.conids) == [1, 2, 3, 4]
+    exposures = engine.exposures
+    for row, position in enumerate(engine.positions):
+        quote = quotes[position.instrument.conid]
+        delta = dict(zip(MEASURES, exposures[row]))['delta']
+        if position.instrument.conid in (1, 2):
+            model = quote.option.model
+            assert delta == pytest.approx(
+                model.delta * position.quantity * 100 *
+                model.underlying_price
+            )
+        else:
+            assert delta == pytest.approx(
+                position.quantity * (quote.bid + quote.ask) / 2
+            )
+    by_underlying = engine.by_underlying()
+    assert by_underlying['SYM2']['delta'] == \
+        pytest.approx(2 * exposures[2][0])
+    by_account = engine.by_account()
+    assert sorted(by_account) == ['DU1', 'DU2']
+    assert sum(t['delta'] for t in by_account.values()) == \
+        pytest.approx(engine.totals()['delta'])
+    assert set(engine.by_expiry()) >= set([None])
+    engine.stop()
+    assert connection.subscriptions == []
+
+def test_ticks_update_the_risk_incrementally(connect):
+    transport = SimulatedTransport(
+        market=SyntheticMarket(updates=5, interval=0.02),
+        portfolio=make_portfolio(),
+        # the listeners are added once the subscriptions are sent
+        latency=0.05
+    )
+    connection = connect(transport)
+    engine = connection.track_risk()
+    updated = []
+    engine.add_listener(lambda engine, conid: updated.append(conid))
+    # the bid, ask and last of each contract, the model computation of
+    # each option, then five bid and ask updates for each contract
+    assert wait_for(lambda: engine.ticks == 4 * 3 + 2 + 4 * 5 * 2)
+    assert updated and set(updated) <= set([1, 2, 3, 4])
+    exposures = engine.exposures
+    totals = engine.totals()
+    stock = quotes_by_conid(connection)[3]
+    assert exposures[2][0] == pytest.approx(
+        engine.positions[2].quantity * (stock.bid + stock.ask) / 2
+    )
+    # the same as computing the whole book again
+    engine.recompute()
+    assert engine.exposures == pytest.approx(exposures)
+    assert [engine.totals()[m] for m in MEASURES] == \
+        pytest.approx([totals[m] for m in MEASURES])
+    engine.stop()
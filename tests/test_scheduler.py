@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# test_scheduler.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+import time
+from threading import Event
+
+import pytest
+
+from conftest import make_contract, wait_for
+from untws.scheduler import *
+
+def test_token_bucket_paces_calls():
+    bucket = TokenBucket(10, 2)
+    now = time.time()
+    bucket.take(now)
+    bucket.take(now)
+    assert abs(bucket.delay(now) - 0.1) < 1e-6
+
+def test_urgent_calls_go_first():
+    scheduler = RequestScheduler(TokenBucket(20, 1))
+    sent = []
+    try:
+        scheduler.submit(PRIORITY_REQUEST, sent.append, 'first')
+        assert wait_for(lambda: sent == ['first'])
+        # queued behind the rate limit
+        scheduler.submit(PRIORITY_HISTORICAL, sent.append, 'historical')
+        scheduler.submit(PRIORITY_MARKET_DATA, sent.append, 'market data')
+        scheduler.submit(PRIORITY_CANCEL, sent.append, 'cancel')
+        assert wait_for(lambda: len(sent) == 4)
+    finally:
+        scheduler.close()
+    assert sent == ['first', 'cancel', 'market data', 'historical']
+
+def test_withdrawn_calls_are_not_sent():
+    scheduler = RequestScheduler(TokenBucket(20, 1))
+    sent = []
+    try:
+        scheduler.submit(PRIORITY_REQUEST, sent.append, 'first')
+        job = scheduler.submit(PRIORITY_REQUEST, sent.append, 'withdrawn')
+        assert scheduler.withdraw(job)
+        scheduler.submit(PRIORITY_REQUEST, sent.append, 'last')
+        assert wait_for(lambda: len(sent) == 2)
+    finally:
+        scheduler.close()
+    assert sent == ['first', 'last']
+
+def test_reopened_scheduler_sends_again():
+    scheduler = RequestScheduler(TokenBucket(1000, 10))
+    done = Event()
+    scheduler.close()
+    scheduler.reopen()
+    scheduler.submit(PRIORITY_REQUEST, done.set)
+    try:
+        assert done.wait(2)
+    finally:
+        scheduler.close()
+
+def test_requests_are_sent_after_reconnecting(connection):
+    connection.disconnect()
+    assert connection.reconnect()
+    assert connection.get_current_time(timeout=2) is not None
+
+def test_closed_scheduler_refuses_calls():
+    scheduler = RequestScheduler(TokenBucket(1000, 10))
+    sent = []
+    job = scheduler.submit(PRIORITY_REQUEST, sent.append, 'sent')
+    assert wait_for(lambda: sent == ['sent'])
+    scheduler.close()
+    with pytest.raises(SchedulerClosed):
+        scheduler.submit(PRIORITY_REQUEST, sent.append, 'closed')
+    # the request ended with the connection: nothing to cancel
+    scheduler.cancel(job, sent.append, 'cancel')
+    scheduler.reopen()
+    try:
+        scheduler.submit(PRIORITY_REQUEST, sent.append, 'reopened')
+        assert wait_for(lambda: len(sent) == 2)
+    finally:
+        scheduler.close()
+    assert sent == ['sent', 'reopened']
+
+def test_requests_made_while_disconnected_are_not_replayed(connection):
+    quote = connection.subscribe(make_contract(1))
+    requests = connection.connection.requests
+    assert wait_for(lambda: requests.get('reqMktData') == 1)
+    connection.disconnect()
+    with pytest.raises(SchedulerClosed):
+        connection.get_current_time()
+    with pytest.raises(SchedulerClosed):
+        connection.place_order(
+            make_contract(2),
+            connection.create_order('BUY', 1)
+        )
+    with pytest.raises(SchedulerClosed):
+        connection.subscribe(make_contract(3))
+    assert connection.subscriptions == [quote]
+    assert connection.orders == []
+    assert connection.reconnect()
+    assert connection.get_current_time() is not None
+    assert requests['reqCurrentTime'] == 1
+    # the subscription is requested again
+    assert wait_for(lambda: requests.get('reqMktData') == 2)
+    assert 'placeOrder' not in requests
@@ -12,18 +12,12 @@
 
 import os
 from untws.connection import IBConnection
+from untws.pool import IBConnectionPool
 
-__all__ = ['ib_connect']
+__all__ = ['ib_connect', 'ib_connect_async']
 
-def ib_connect(hostname=None, port=None):
-    """
-    Returns a connection object to IB TWS.
-    
-    If *hostname* is *None*, it will first look for the *IB_HOSTNAME*
-    environment variable, else it will default to *localhost*.
-    If *port* is *None*, it will first look for the *IB_PORT*
-    environment variable, else it will default to *7496*.
-    """
+def _resolve_address(hostname, port):
+    """Fills in the TWS hostname and port from the environment"""
     if hostname is None:
         if 'IB_HOSTNAME' in os.environ:
             hostname = os.environ['IB_HOSTNAME']
@@ -34,4 +28,58 @@ def ib_connect(hostname=None, port=None):
             port = os.environ['IB_PORT']
         else:
             port = 7496
-    return IBConnection(hostname, port)
+    return hostname, port
+
+def ib_connect(hostname=None, port=None, timeout=None, client_id=None,
+    pool_size=None, worker_index=0):
+    """
+    Returns a connection object to IB TWS.
+    
+    If *hostname* is *None*, it will first look for the *IB_HOSTNAME*
+    environment variable, else it will default to *localhost*.
+    If *port* is *None*, it will first look for the *IB_PORT*
+    environment variable, else it will default to *7496*.
+    *timeout* is the default number of seconds to wait for TWS to answer a
+    request (*None* to wait forever).
+
+    If *client_id* is *None*, it will first look for the *IB_CLIENT_ID*
+    environment variable, else a random client id is used.
+
+    If *pool_size* is given, an *IBConnectionPool* of that many
+    connections is returned instead, with deterministic client ids starting
+    at *client_id* (default *1000*). Each worker process sharing the same
+    TWS must use its own *worker_index*.
+    """
+    hostname, port = _resolve_address(hostname, port)
+    if client_id is None and 'IB_CLIENT_ID' in os.environ:
+        client_id = int(os.environ['IB_CLIENT_ID'])
+    if pool_size is not None:
+        return IBConnectionPool(
+            hostname,
+            port,
+            size=pool_size,
+            client_id_base=1000 if client_id is None else client_id,
+            worker_index=worker_index,
+            timeout=timeout
+        )
+    return IBConnection(hostname, port, timeout=timeout, client_id=client_id)
+
+def ib_connect_async(hostname=None, port=None, loop=None):
+    """
+    Returns a future resolving to an *AsyncIBConnection* to IB TWS (Python 3
+    only). The connection handshake is done in the loop's default executor.
+
+    *hostname* and *port* are handled as in *ib_connect*.
+    """
+    import asyncio
+    from untws.async_connection import AsyncIBConnection
+    hostname, port = _resolve_address(hostname, port)
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop.run_in_executor(
+        None,
+        AsyncIBConnection,
+        hostname,
+        port,
+        loop
+    )
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# async_connection.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+asyncio flavour of the connection to IB TWS.
+
+The methods of *AsyncIBConnection* return *asyncio.Future* objects, which
+are resolved from the IbPy reader thread with *call_soon_threadsafe*. No
+thread is blocked while a request is outstanding, so thousands of requests
+can be issued at once with *asyncio.gather*.
+"""
+
+import asyncio
+from datetime import datetime
+from threading import Event
+from untws.connection import (
+    IBConnection, IBError, RequestTimeout, _apply_tick, _make_quote
+)
+from untws.dispatcher import is_warning
+from untws.scheduler import *
+from untws.position import Position
+
+__all__ = ['AsyncIBConnection']
+
+def _resolve(future, result):
+    """Sets the result of *future*, unless it was cancelled meanwhile"""
+    if not future.done():
+        future.set_result(result)
+
+def _fail(future, exception):
+    """Sets the exception of *future*, unless it was cancelled meanwhile"""
+    if not future.done():
+        future.set_exception(exception)
+
+class AsyncIBConnection(object):
+    """
+    A connection to IB whose requests are awaitable.
+
+    *loop* is the event loop the futures belong to (defaults to the current
+    event loop). Other keyword arguments are passed on to *IBConnection*.
+    """
+
+    def __init__(self, host, port, loop=None, **kwargs):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._blocking = IBConnection(host, port, **kwargs)
+        self._dispatcher = self._blocking._dispatcher
+        self._positions = None
+
+    @property
+    def blocking(self):
+        """The underlying (blocking) *IBConnection*"""
+        return self._blocking
+
+    def create_stock(self, ticker, currency='USD', exchange='SMART'):
+        return self._blocking.create_stock(ticker, currency, exchange)
+
+    def create_option_ticker(self, ticker, currency='USD', exchange='SMART'):
+        return self._blocking.create_option_ticker(ticker, currency, exchange)
+
+    def _expire(self, future, timeout):
+        """
+        Fails *future* with *RequestTimeout* after *timeout* seconds (the
+        connection's *timeout* if *None*). Returns the timer handle, or
+        *None* if there is no timeout.
+        """
+        if timeout is None:
+            timeout = self._blocking.timeout
+        if timeout is None:
+            return None
+        return self._loop.call_later(
+            timeout,
+            _fail,
+            future,
+            RequestTimeout("TWS did not answer in time")
+        )
+
+    def _send(self, future, priority, method, *args):
+        """
+        Queues the request of *future*, as *IBConnection._send* does. If it
+        cannot be sent (*SchedulerClosed*, while disconnected), *future*
+        fails instead. Returns the scheduler job, or *None*.
+        """
+        try:
+            return self._blocking._send(priority, method, *args)
+        except SchedulerClosed as e:
+            _fail(future, e)
+            return None
+
+    def get_current_time(self, timeout=None):
+        """
+        Returns a future resolving to the current TWS server time, as a
+        *datetime.datetime* object. The future fails with *RequestTimeout*
+        if TWS does not answer within *timeout* seconds (the connection's
+        *timeout* if *None*).
+        """
+        future = self._loop.create_future()
+
+        def process_message(msg):
+            self._loop.call_soon_threadsafe(
+                _resolve,
+                future,
+                datetime.fromtimestamp(msg.time)
+            )
+
+        expiry = self._expire(future, timeout)
+
+        def on_done(future):
+            # answered, timed out or cancelled
+            if expiry is not None:
+                expiry.cancel()
+            self._dispatcher.unsubscribe('currentTime', process_message)
+
+        self._dispatcher.subscribe('currentTime', process_message)
+        future.add_done_callback(on_done)
+        self._send(future, PRIORITY_REQUEST, 'reqCurrentTime')
+        return future
+
+    def get_positions(self, timeout=None):
+        """
+        Returns a future resolving to the list of positions. The future
+        fails with *RequestTimeout* if the download does not end within
+        *timeout* seconds (the connection's *timeout* if *None*).
+
+        Concurrent calls share the same account download.
+        """
+        if self._positions is not None and not self._positions.done():
+            return self._positions
+        if not self._blocking._account_lock.acquire(False):
+            # a blocking caller is using the account updates subscription
+            return self._loop.run_in_executor(
+                None,
+                self._blocking.get_positions,
+                timeout
+            )
+        future = self._positions = self._loop.create_future()
+        out = []
+        # set once the download ended: the subscription is only closed
+        # later, from the event loop, and the list was handed out by then
+        downloaded = Event()
+
+        def process_message(msg):
+            if downloaded.is_set():
+                return
+            if msg.typeName == 'accountDownloadEnd':
+                downloaded.set()
+                self._loop.call_soon_threadsafe(_resolve, future, out)
+            elif msg.typeName == 'updatePortfolio':
+                out.append(Position(
+                    self._blocking,
+                    msg.accountName,
+                    msg.contract,
+                    msg.position,
+                    msg.marketPrice,
+                    msg.averageCost,
+                    msg.marketValue,
+                    msg.realizedPNL,
+                    msg.unrealizedPNL
+                ))
+
+        expiry = self._expire(future, timeout)
+
+        def on_done(future):
+            # however the download ended (completed, timed out or
+            # cancelled), the subscription and the lock must be given back
+            if expiry is not None:
+                expiry.cancel()
+            self._dispatcher.unsubscribe('account', process_message)
+            self._blocking._end_subscription('reqAccountUpdates', 0, '')
+            self._blocking._account_lock.release()
+
+        self._dispatcher.subscribe('account', process_message)
+        future.add_done_callback(on_done)
+        self._send(future, PRIORITY_REQUEST, 'reqAccountUpdates', 1, '')
+        return future
+
+    def get_market_data(self, instrument, fields=None, timeout=None):
+        """
+        Returns a future resolving to the current market data for an
+        instrument, as a *MarketDataQuoteInstrument*. The future fails with
+        *IBError* if TWS rejects the request, and with *RequestTimeout* if
+        the snapshot does not end within *timeout* seconds (the connection's
+        *timeout* if *None*). Cancelling the future, or its timing out,
+        cancels the request. *fields* are as for
+        *IBConnection.get_market_data*.
+        """
+        fields = self._blocking._snapshot_fields(fields)
+        future = self._loop.create_future()
+        ticker_id = self._blocking._next_request_id()
+        data = {}
+        opts = {}
+        # set once TWS ended the request (with the snapshot, or an error)
+        ended = Event()
+
+        def process_tick(msg):
+            if msg.typeName == 'tickSnapshotEnd':
+                ended.set()
+                self._dispatcher.unsubscribe(ticker_id, process_tick)
+                self._loop.call_soon_threadsafe(
+                    _resolve,
+                    future,
+                    _make_quote(instrument, data, opts)
+                )
+            elif msg.typeName == 'error':
+                if not is_warning(msg):
+                    ended.set()
+                    self._dispatcher.unsubscribe(ticker_id, process_tick)
+                    self._loop.call_soon_threadsafe(
+                        _fail,
+                        future,
+                        IBError(msg)
+                    )
+            else:
+                _apply_tick(data, opts, msg, fields)
+
+        expiry = self._expire(future, timeout)
+
+        def on_done(future):
+            if expiry is not None:
+                expiry.cancel()
+            if not ended.is_set():
+                # cancelled, timed out, or never sent
+                self._dispatcher.unsubscribe(ticker_id, process_tick)
+                self._blocking._cancel(job, 'cancelMktData', ticker_id)
+
+        self._dispatcher.subscribe(ticker_id, process_tick)
+        future.add_done_callback(on_done)
+        # request a "non-subscription" market data quote
+        job = self._send(
+            future,
+            PRIORITY_MARKET_DATA,
+            'reqMktData',
+            ticker_id,
+            instrument,
+            '',
+            True
+        )
+        return future
@@ -6,15 +6,31 @@
 # Created by Maan Bsat on 2013-09-02.
 # Copyright (c) 2013 Maan Bsat. All rights reserved.
 
-from Queue import Queue
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    # python 3
+    from queue import Queue, Empty
 from random import randint
+from time import time, sleep
+from itertools import count
+from threading import Event, Lock
+from contextlib import contextmanager
 from datetime import datetime
 import ib.opt
 from ib.opt import message
 from ib.ext.Contract import Contract
+from ib.ext.Order import Order
+from untws.dispatcher import MessageDispatcher, is_warning, REQUEST_ID_BASE
+from untws.metrics import NullTimer
+from untws.scheduler import *
 from untws.position import Position
+from untws.orders import OrderHandle
 from untws.market_data import *
+from untws.tick_fields import FieldMap, field_map, known_tick_types
 
+# tick type -> name of the default price fields (see *tick_fields* for all
+# the fields quotes may have)
 MKT_DATA_FIELDS = {
     1: 'bid',
     2: 'ask',
@@ -31,126 +47,1272 @@ OPT_DATA_FIELDS = {
     13: 'model'
 }
 
+class IBError(Exception):
+    """An error reported by TWS in response to a request"""
+
+    def __init__(self, msg):
+        super(IBError, self).__init__(
+            "TWS error %d: %s" % (msg.errorCode, msg.errorMsg)
+        )
+        self.code = msg.errorCode
+
+# the fields of quotes, unless told otherwise
+_DEFAULT_FIELDS = FieldMap()
+
+def _apply_tick(data, opts, msg, fields=_DEFAULT_FIELDS):
+    """
+    Records a tick message into the fields (*data*) and option fields
+    (*opts*) of a quote being built. Ticks of fields which are not in
+    *fields* (a *FieldMap*) are ignored.
+    """
+    if msg.typeName == 'tickOptionComputation':
+        if msg.field not in OPT_DATA_FIELDS:
+            # we ignore fields that we don't know of
+            return
+        opts[OPT_DATA_FIELDS[msg.field]] = MarketDataQuoteBase({
+            'price': msg.optPrice,
+            'delta': msg.delta,
+            'gamma': msg.gamma,
+            'vega': msg.vega,
+            'theta': msg.theta,
+            'underlying_price': msg.undPrice,
+            'pv_dividends': msg.pvDividend,
+            'implied_vol': msg.impliedVol
+        })
+        # the mid point is cached, and may now be stale
+        opts.pop('mid', None)
+    else:
+        fields.decode(data, msg)
+
+def _make_quote(instrument, data, opts):
+    """Builds the quote object out of the collected fields"""
+    if len(opts) > 0:
+        data['option'] = OptionDataQuote(opts)
+    return MarketDataQuoteInstrument(instrument, data)
+
+def _wait(mailbox, deadline):
+    """
+    Returns the next message in *mailbox*, waiting until *deadline* (as
+    returned by *time()*, or *None* to wait forever). Raises
+    *RequestTimeout* if no message arrived in time.
+    """
+    if deadline is None:
+        return mailbox.get()
+    try:
+        return mailbox.get(True, max(deadline - time(), 0))
+    except Empty:
+        raise RequestTimeout("TWS did not answer in time")
+
+def _acquire(lock, deadline):
+    """
+    Acquires *lock*, waiting until *deadline* (as returned by *time()*, or
+    *None* to wait forever). Raises *RequestTimeout* if it is still held
+    by then.
+    """
+    if deadline is None:
+        lock.acquire()
+        return
+    # python 2 locks cannot be acquired with a timeout
+    while not lock.acquire(False):
+        if time() >= deadline:
+            raise RequestTimeout("Another request is using the subscription")
+        sleep(0.01)
+
+def _contract_key(contract):
+    """Returns a hashable key identifying a contract"""
+    return (
+        contract.m_conId,
+        contract.m_secType,
+        contract.m_localSymbol,
+        contract.m_exchange,
+        contract.m_currency
+    )
+
+class RequestTimeout(Exception):
+    """Raised when TWS does not answer a request in time"""
+
+class SubscriptionLimitExceeded(Exception):
+    """Raised when subscribing would exceed the market data lines limit"""
+
 class IBConnection(object):
-    """This is the core object which represents a connection to IB."""
+    """
+    This is the core object which represents a connection to IB.
+
+    *timeout* is the default number of seconds to wait for TWS to answer a
+    request (*None* to wait forever). Each request method also accepts its
+    own *timeout*, which overrides it.
+
+    Outgoing requests are sent at no more than *max_rate* messages per
+    second, in bursts of at most *burst* messages. The defaults keep any
+    one-second window under the 50 messages TWS accepts.
 
-    def __init__(self, host, port):
-        self.connection = ib.opt.ibConnection(
-            host=host,
-            port=port,
-            clientId=randint(1000, 99999)
+    *client_id* identifies the connection to TWS, and must not be shared
+    with another connection; a random one is picked if it is *None*.
+
+    If *contract_cache* (a *ContractCache*) is given, contracts created with
+    *create_stock* and *create_option_ticker* are resolved through it, and
+    instruments are built from the fully populated cached contracts.
+
+    If *bar_cache* (a *BarCache*) is given, *get_historical_data* only
+    downloads the bars which are not in it yet.
+
+    If *recorder* (a *TickRecorder*) is given, every market data tick
+    received is recorded with it.
+
+    *transport* replaces the IbPy connection to TWS at *host* and *port*;
+    it must offer the same methods (e.g. a *simulator.SimulatedTransport*,
+    to run without TWS). If *fast_decoder* is *True*, the connection uses a
+    *fast_decoder.FastTransport*, which decodes ticks and portfolio updates
+    without going through IbPy.
+
+    If *metrics* (a *metrics.Metrics*) is given, the latency of each
+    request, the messages received and the request queue are instrumented
+    into it.
+
+    *fields* are the market data fields quotes are decoded into (a
+    *tick_fields.FieldMap*, or a list of field names), unless a request asks
+    for others; *tick_fields.DEFAULT_FIELDS* if *None*.
+
+    At most *max_subscriptions* streaming quotes and *max_depth_subscriptions*
+    market depth books may be open at once (TWS allows 3 depth requests by
+    default).
+    """
+
+    def __init__(self, host, port, max_subscriptions=100, timeout=None,
+        max_rate=45, burst=5, client_id=None, contract_cache=None,
+        bar_cache=None, recorder=None, transport=None, metrics=None,
+        fast_decoder=False, max_depth_subscriptions=3, fields=None):
+        if client_id is None:
+            client_id = randint(1000, 99999)
+        self.client_id = client_id
+        self.contract_cache = contract_cache
+        self.bar_cache = bar_cache
+        self.recorder = recorder
+        self.fields = _DEFAULT_FIELDS if fields is None else field_map(fields)
+        if transport is None and fast_decoder:
+            from untws.fast_decoder import FastTransport
+            transport = FastTransport(host, port, client_id)
+        elif transport is None:
+            transport = ib.opt.ibConnection(
+                host=host,
+                port=port,
+                clientId=client_id
+            )
+        self.connection = transport
+        self.metrics = metrics
+        self._dispatcher = MessageDispatcher(metrics)
+        self._listen(self._dispatcher.dispatch, self._dispatcher.message_types)
+        if recorder is not None:
+            from untws.recorder import TICK_TYPES
+            self._listen(recorder.record, TICK_TYPES)
+
+        # orders: TWS sends the next valid order id as soon as we connect,
+        # and we count up from there locally
+        self._next_order_id = None
+        self._order_id_lock = Lock()
+        self._order_ids_ready = Event()
+        # order id -> OrderHandle
+        self._orders = {}
+        self._dispatcher.subscribe('orders', self._process_order_message)
+
+        self.connection.connect()
+        self.timeout = timeout
+        self._scheduler = RequestScheduler(
+            TokenBucket(max_rate, burst),
+            # TWS accepts at most 60 historical data requests in any ten
+            # minutes, and at most 6 for the same contract in two seconds
+            {PRIORITY_HISTORICAL: TokenBucket(54 / 600.0, 6)}
         )
+        if metrics is not None:
+            metrics.known_fields.update(known_tick_types())
+            metrics.known_fields['tickOptionComputation'] = OPT_DATA_FIELDS
+            metrics.add_gauge('scheduler', self._scheduler.metrics)
+
+        self._request_ids = count(REQUEST_ID_BASE)
+        self._request_id_lock = Lock()
+        # the account updates subscription is shared by the whole
+        # connection, so only one caller may use it at a time
+        self._account_lock = Lock()
+        self.portfolio_tracker = None
+        # likewise for the positions subscription
+        self._positions_lock = Lock()
+
+        # streaming market data: contract key -> LiveQuote
+        self.max_subscriptions = max_subscriptions
+        self._subscriptions = {}
+        self._subscriptions_lock = Lock()
+        # market depth: contract key -> DepthBook
+        self.max_depth_subscriptions = max_depth_subscriptions
+        self._depth_books = {}
+        # ticker id -> scheduler job of the streaming request
+        self._streams = {}
+
+        # curve key -> FuturesCurve
+        self._futures_curves = {}
+
+    def _listen(self, listener, types):
+        """
+        Registers *listener* with the IbPy connection for the message types
+        named *types* (e.g. 'tickPrice'). IbPy looks listeners up by the
+        name of the message class ('TickPrice'), so the names alone would
+        never match: the classes are registered instead.
+        """
+        self.connection.register(
+            listener,
+            *[getattr(message, t) for t in types]
+        )
+
+    def _next_request_id(self):
+        """Allocates a new request id, unique for the life of the connection"""
+        with self._request_id_lock:
+            return next(self._request_ids)
+
+    def is_connected(self):
+        """Returns *True* if the connection to TWS is up"""
+        return bool(self.connection.isConnected())
+
+    def reconnect(self):
+        """
+        Drops the connection to TWS (if it is still up) and establishes it
+        again, with the same client id. Streaming subscriptions, and the
+        account updates of the *portfolio_tracker*, are requested again.
+        Returns *True* if connected.
+        """
+        self.connection.disconnect()
         self.connection.connect()
-        
-        self._messages = Queue()
-    
-    def _process_message(self, msg):
-        """Callback for ibpy"""
-        self._messages.put(msg)
+        if not self.is_connected():
+            return False
+        # requests stop being sent on disconnect
+        self._scheduler.reopen()
+        with self._subscriptions_lock:
+            for quote in self._subscriptions.values():
+                self._streams[quote.ticker_id] = self._send(
+                    PRIORITY_MARKET_DATA,
+                    'reqMktData',
+                    quote.ticker_id,
+                    quote.instrument,
+                    quote.fields.generic_ticks,
+                    False
+                )
+            for book in self._depth_books.values():
+                # TWS sends the whole book again
+                book.clear()
+                self._streams[book.ticker_id] = self._send(
+                    PRIORITY_MARKET_DATA,
+                    'reqMktDepth',
+                    book.ticker_id,
+                    book.instrument,
+                    book.rows
+                )
+        if self.portfolio_tracker is not None:
+            self.portfolio_tracker._resubscribe()
+        return True
+
+    def disconnect(self):
+        """
+        Closes the connection to TWS, dropping the requests not sent yet.
+        Until *reconnect* opens it again, new requests raise
+        *SchedulerClosed*.
+        """
+        self._scheduler.close()
+        self.connection.disconnect()
+
+    def _track(self, ticker_id, instrument):
+        """Records the ticks of *ticker_id*, if there is a recorder"""
+        if self.recorder is not None:
+            self.recorder.track(ticker_id, instrument.m_conId)
+
+    def _untrack(self, ticker_id):
+        if self.recorder is not None:
+            self.recorder.untrack(ticker_id)
+
+    def _call(self, method, *args):
+        """Calls the IbPy request method named *method*"""
+        getattr(self.connection, method)(*args)
+
+    def _send(self, priority, method, *args):
+        """
+        Queues a call to the IbPy request method named *method* in the request
+        scheduler. Returns the scheduler job.
+        """
+        return self._scheduler.submit(priority, self._call, method, *args)
+
+    def _cancel(self, job, method, *args):
+        """
+        Cancels the request queued as *job*, by withdrawing it if it was not
+        sent yet, or by sending the IbPy cancel method named *method*.
+        """
+        self._scheduler.cancel(job, self._call, method, *args)
 
-    def get_current_time(self):
+    def _end_subscription(self, method, *args):
+        """
+        Sends the IbPy method named *method* ending a subscription (e.g.
+        *reqAccountUpdates(0, '')*) ahead of everything else. Nothing is
+        sent while disconnected: the subscription ended with the connection.
+        """
+        try:
+            self._send(PRIORITY_CANCEL, method, *args)
+        except SchedulerClosed:
+            pass
+
+    def _timer(self, kind):
+        """Starts timing a request of type *kind*, if there are metrics"""
+        if self.metrics is None:
+            return NullTimer()
+        return self.metrics.timer(kind)
+
+    @contextmanager
+    def _timed(self, kind):
+        """
+        Context manager timing the request made in the block, which fails
+        if the block raises.
+        """
+        timer = self._timer(kind)
+        try:
+            yield timer
+        except Exception:
+            timer.failed()
+            raise
+        timer.done()
+
+    @property
+    def scheduler_metrics(self):
+        """
+        The request scheduler's queue depth, number of requests sent, and
+        average and maximum time (in seconds) requests spent queued.
+        """
+        return self._scheduler.metrics()
+
+    def _deadline(self, timeout):
+        """
+        Returns the time by which a request with the given *timeout* must be
+        answered (*None* if it may wait forever).
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time() + timeout
+
+    def get_current_time(self, timeout=None):
         """
         Returns the current TWS server time, as a *datetime.date* object.
         """
-        self.connection.register(self._process_message, message.currentTime)
-        self.connection.reqCurrentTime()
-        msg = self._messages.get()
-        assert isinstance(msg, message.currentTime)
-        self.connection.unregister(self._process_message, message.currentTime)
+        deadline = self._deadline(timeout)
+        with self._timed('current_time') as timer, \
+                self._dispatcher.mailbox('currentTime', timer) as mailbox:
+            timer.job = self._send(PRIORITY_REQUEST, 'reqCurrentTime')
+            msg = _wait(mailbox, deadline)
         return datetime.fromtimestamp(msg.time)
         
-    def get_positions(self):
+    def get_positions(self, timeout=None):
         """
-        Returns a list of positions.
+        Returns a list of positions. If the portfolio is tracked (see
+        *track_portfolio*), they are served from memory, once TWS has sent
+        them (again, after *reconnect*).
         """
-        self.connection.register(
-            self._process_message,
-            'UpdatePortfolio',
-            'AccountDownloadEnd'
-        )
-        self.connection.reqAccountUpdates(1, '')
+        deadline = self._deadline(timeout)
+        tracker = self.portfolio_tracker
+        if tracker is not None and tracker.running:
+            remaining = None if deadline is None else max(deadline - time(), 0)
+            if not tracker.wait(remaining):
+                raise RequestTimeout("TWS did not send the portfolio in time")
+            return tracker.positions()
         out = []
-        while True:
-            msg = self._messages.get()
-            if msg.typeName == 'accountDownloadEnd':
-                break
-            assert msg.typeName == 'updatePortfolio'
-            out.append(Position(
-                self,
-                msg.accountName,
-                msg.contract,
-                msg.position,
-                msg.marketPrice,
-                msg.averageCost,
-                msg.marketValue,
-                msg.realizedPNL,
-                msg.unrealizedPNL
-            ))
-        self.connection.reqAccountUpdates(0, '')
-        self.connection.unregister(
-            self._process_message,
-            'UpdatePortfolio',
-            'AccountDownloadEnd'
-        )
+        with self._account_lock, \
+                self._timed('positions') as timer, \
+                self._dispatcher.mailbox('account', timer) as mailbox:
+            timer.job = self._send(
+                PRIORITY_REQUEST,
+                'reqAccountUpdates',
+                1,
+                ''
+            )
+            try:
+                while True:
+                    msg = _wait(mailbox, deadline)
+                    if msg.typeName == 'accountDownloadEnd':
+                        break
+                    elif msg.typeName != 'updatePortfolio':
+                        # account values and update times are not needed
+                        continue
+                    out.append(Position(
+                        self,
+                        msg.accountName,
+                        msg.contract,
+                        msg.position,
+                        msg.marketPrice,
+                        msg.averageCost,
+                        msg.marketValue,
+                        msg.realizedPNL,
+                        msg.unrealizedPNL
+                    ))
+            finally:
+                self._end_subscription('reqAccountUpdates', 0, '')
         return out
     
-    def get_market_data(self, instrument):
+    def get_all_positions(self, accounts=None, timeout=None):
+        """
+        Returns the positions of every account (or only of *accounts*, a list
+        of account codes) in a single request, as a dictionary mapping
+        account codes to lists of positions.
+
+        Unlike *get_positions*, TWS only sends the quantity and average cost
+        of each position: the price, market value and P&L are *None*.
+        """
+        deadline = self._deadline(timeout)
+        if accounts is not None:
+            accounts = set(accounts)
+        out = {}
+        with self._positions_lock, \
+                self._timed('all_positions') as timer, \
+                self._dispatcher.mailbox('positions', timer) as mailbox:
+            timer.job = self._send(PRIORITY_REQUEST, 'reqPositions')
+            try:
+                while True:
+                    msg = _wait(mailbox, deadline)
+                    if msg.typeName == 'positionEnd':
+                        break
+                    if accounts is not None and msg.account not in accounts:
+                        continue
+                    out.setdefault(msg.account, []).append(Position(
+                        self,
+                        msg.account,
+                        msg.contract,
+                        msg.pos,
+                        None,
+                        msg.avgCost,
+                        None,
+                        None,
+                        None
+                    ))
+            finally:
+                self._end_subscription('cancelPositions')
+        return out
+
+    def track_portfolio(self, account='', timeout=None):
+        """
+        Starts tracking the portfolio of *account* (the default account if
+        empty) incrementally, and returns the *PortfolioTracker*. While it
+        runs, *get_positions* is served from it. Call its *stop* method to
+        stop tracking.
+        """
+        from untws.portfolio import PortfolioTracker
+        tracker = self.portfolio_tracker
+        if tracker is not None and tracker.running:
+            return tracker
+        tracker = PortfolioTracker(self, account)
+        tracker.start(timeout)
+        self.portfolio_tracker = tracker
+        return tracker
+
+    def track_risk(self, positions=None, side='model', timeout=None):
+        """
+        Starts aggregating the risk of *positions* (by default, those
+        returned by *get_positions*) from streaming quotes, and returns the
+        *RiskEngine* (requires NumPy). Call its *stop* method to stop
+        tracking.
+        """
+        from untws.risk import RiskEngine
+        if positions is None:
+            positions = self.get_positions(timeout)
+        engine = RiskEngine(self, positions, side)
+        engine.start(timeout=timeout)
+        return engine
+
+    def get_contract_details(self, contract, timeout=None):
+        """
+        Returns the list of *ContractDetails* for the contracts matching
+        *contract* (which may be partially specified, e.g. an option contract
+        with only a symbol matches the whole option chain).
+        """
+        deadline = self._deadline(timeout)
+        req_id = self._next_request_id()
+        out = []
+        with self._timed('contract_details') as timer, \
+                self._dispatcher.mailbox(req_id, timer) as mailbox:
+            timer.job = self._send(
+                PRIORITY_REQUEST,
+                'reqContractDetails',
+                req_id,
+                contract
+            )
+            while True:
+                try:
+                    msg = _wait(mailbox, deadline)
+                except RequestTimeout:
+                    self._scheduler.withdraw(timer.job)
+                    raise
+                if msg.typeName == 'contractDetailsEnd':
+                    break
+                elif msg.typeName == 'error':
+                    if not is_warning(msg):
+                        raise IBError(msg)
+                else:
+                    out.append(msg.contractDetails)
+        return out
+
+    def _get_contract_details_many(self, contracts, deadline):
+        """
+        Same as *get_contract_details* for several contracts at once: the
+        requests are all queued together, rather than each waiting for the
+        previous one. Returns the lists of *ContractDetails*, in the same
+        order as *contracts*.
+        """
+        out = [[] for contract in contracts]
+        # (index, error message or None) of each request as it completes
+        completed = Queue()
+        requests = {}
+        def handler(index, timer):
+            def process(msg):
+                timer.message()
+                if msg.typeName == 'contractDetailsEnd':
+                    timer.done()
+                    completed.put((index, None))
+                elif msg.typeName == 'error':
+                    if not is_warning(msg):
+                        timer.failed()
+                        completed.put((index, msg))
+                else:
+                    out[index].append(msg.contractDetails)
+            return process
+        try:
+            for index, contract in enumerate(contracts):
+                req_id = self._next_request_id()
+                timer = self._timer('contract_details')
+                requests[req_id] = timer
+                self._dispatcher.subscribe(req_id, handler(index, timer))
+                timer.job = self._send(
+                    PRIORITY_REQUEST,
+                    'reqContractDetails',
+                    req_id,
+                    contract
+                )
+            for i in range(len(contracts)):
+                index, error = _wait(completed, deadline)
+                if error is not None:
+                    raise IBError(error)
+        finally:
+            for req_id, timer in requests.items():
+                self._dispatcher.unsubscribe_all(req_id)
+                self._scheduler.withdraw(timer.job)
+        return out
+
+    def get_historical_data(self, instrument, start, end, bar_size='1 day',
+        what_to_show='TRADES', use_rth=True, timeout=None):
+        """
+        Returns the historical bars of an instrument between *start* and *end*
+        (naive UTC *datetime* objects), as a dictionary of NumPy arrays: 'time'
+        (*datetime64[s]*), 'open', 'high', 'low', 'close', 'volume', 'count'
+        and 'wap'.
+
+        *bar_size* is one of *untws.historical.BAR_SIZES* (e.g. '1 min'),
+        and *what_to_show* one of 'TRADES', 'MIDPOINT', 'BID', 'ASK', etc.
+        Long ranges are split into several requests, which are sent
+        concurrently within the historical data pacing limits.
+        """
+        from untws.historical import (
+            BAR_SIZES, split_range, duration_string, end_date_time,
+            to_timestamp, bar_row, to_columns
+        )
+        deadline = self._deadline(timeout)
+        start = to_timestamp(start)
+        end = to_timestamp(end)
+        series = (
+            instrument.m_conId or repr(_contract_key(instrument)),
+            bar_size,
+            what_to_show,
+            bool(use_rth)
+        )
+        if self.bar_cache is not None:
+            gaps = self.bar_cache.missing(series, start, end)
+        else:
+            gaps = [(start, end)]
+        chunks = []
+        for gap_start, gap_end in gaps:
+            chunks.extend(split_range(gap_start, gap_end, bar_size))
+
+        # request id -> (chunk, bars received, scheduler job, timer)
+        pending = {}
+        # receives (request id, error message or None) as requests end
+        completed = Queue()
+
+        def process_bar(msg):
+            if msg.typeName == 'error':
+                if msg.errorCode == 162 and 'no data' in msg.errorMsg:
+                    # nothing traded in this chunk
+                    completed.put((msg.id, None))
+                elif not is_warning(msg):
+                    completed.put((msg.id, msg))
+            elif msg.date.startswith('finished'):
+                completed.put((msg.reqId, None))
+            else:
+                request = pending[msg.reqId]
+                request[3].message()
+                request[1].append(bar_row(msg))
+
+        rows = []
+        try:
+            for chunk in chunks:
+                req_id = self._next_request_id()
+                timer = self._timer('historical_data')
+                bars = []
+                # bars may arrive before _send returns
+                pending[req_id] = (chunk, bars, None, timer)
+                self._dispatcher.subscribe(req_id, process_bar)
+                timer.job = self._send(
+                    PRIORITY_HISTORICAL,
+                    'reqHistoricalData',
+                    req_id,
+                    instrument,
+                    end_date_time(chunk[1]),
+                    duration_string(chunk[1] - chunk[0]),
+                    bar_size,
+                    what_to_show,
+                    1 if use_rth else 0,
+                    2
+                )
+                pending[req_id] = (chunk, bars, timer.job, timer)
+            while pending:
+                req_id, error = _wait(completed, deadline)
+                if req_id not in pending:
+                    continue
+                self._dispatcher.unsubscribe(req_id, process_bar)
+                chunk, bars, job, timer = pending.pop(req_id)
+                if error is not None:
+                    timer.failed()
+                    raise IBError(error)
+                timer.done()
+                rows.extend(bars)
+                if self.bar_cache is not None:
+                    # the last bar may still be forming, do not cache it
+                    covered_end = min(chunk[1], time() - BAR_SIZES[bar_size][0])
+                    self.bar_cache.store(
+                        series,
+                        chunk[0],
+                        covered_end,
+                        [r for r in bars if r[0] < covered_end]
+                    )
+        finally:
+            for req_id, request in pending.items():
+                self._dispatcher.unsubscribe(req_id, process_bar)
+                request[3].failed()
+                self._cancel(request[2], 'cancelHistoricalData', req_id)
+        if self.bar_cache is not None:
+            rows.extend(self.bar_cache.load(series, start, end))
+        rows = [r for r in rows if start <= r[0] < end]
+        return to_columns(rows)
+
+    def _snapshot_fields(self, fields):
+        """
+        The *FieldMap* of a snapshot request asking for *fields* (*None* for
+        the connection's)
+        """
+        fields = self.fields if fields is None else field_map(fields)
+        if fields.generic_ticks:
+            # TWS rejects snapshots asking for generic ticks (error 321)
+            raise ValueError(
+                "Fields needing generic ticks (%s) are only sent to "
+                "streaming subscriptions" % fields.generic_ticks
+            )
+        return fields
+
+    def get_market_data(self, instrument, timeout=None, fields=None):
         """
         Request the current market data for an instrument (contract). Instrument
         can be obtained by *create_stock* and *create_option_ticker*.
+
+        *fields* (a *tick_fields.FieldMap* or a list of field names) overrides
+        the fields of the connection. Fields which need generic ticks (e.g.
+        'implied_vol') are only available from *subscribe*.
         """
-        self.connection.register(
-            self._process_message,
-            message.tickPrice,
-            message.tickSnapshotEnd,
-            message.tickOptionComputation
+        quotes, errors = self._get_snapshots(
+            [instrument],
+            1,
+            self._deadline(timeout),
+            self._snapshot_fields(fields)
+        )
+        if errors[0] is not None:
+            raise IBError(errors[0])
+        if quotes[0] is None:
+            raise RequestTimeout("TWS did not answer in time")
+        return quotes[0]
+
+    def get_market_data_many(self, instruments, max_in_flight=50,
+        timeout=None, fields=None):
+        """
+        Request the current market data for several instruments at once.
+
+        Each instrument gets its own ticker id, and up to *max_in_flight*
+        snapshot requests are outstanding at any given time. Returns a list
+        of *MarketDataQuoteInstrument* objects, in the same order as
+        *instruments*. Instruments for which TWS returned an error are
+        returned as *None*.
+
+        *timeout* applies to the batch as a whole: once it expires, the
+        outstanding requests are cancelled, and the instruments which did not
+        answer are returned as *None*.
+
+        *fields* are as for *get_market_data*.
+        """
+        return self._get_snapshots(
+            instruments,
+            max_in_flight,
+            self._deadline(timeout),
+            self._snapshot_fields(fields)
+        )[0]
+
+    def get_market_data_batch(self, instruments, max_in_flight=50,
+        timeout=None, fields=None):
+        """
+        Same as *get_market_data_many*, but returns the quotes as a
+        *QuoteBatch*, whose fields are NumPy columns (requires NumPy). Ticks
+        are written straight into the columns, without building a quote
+        object per instrument.
+        """
+        return self._get_batch(
+            instruments,
+            max_in_flight,
+            self._deadline(timeout),
+            self._snapshot_fields(fields)
+        )
+
+    def _get_batch(self, instruments, max_in_flight, deadline, fields):
+        """
+        Requests market data snapshots of *fields* (as returned by
+        *_snapshot_fields*) into a *QuoteBatch*
+        """
+        from untws.quote_batch import QuoteBatch
+        batch = QuoteBatch(instruments, fields)
+        outcomes = self._request_snapshots(
+            batch.instruments,
+            max_in_flight,
+            deadline,
+            batch.record
         )
-        # request a "non-subscription" market data quote
-        self.connection.reqMktData(1, instrument, '', True)
-        data = {}
-        opts = {}
-        while True:
-            msg = self._messages.get()
-            if isinstance(msg, message.tickSnapshotEnd):
-                break
-            elif isinstance(msg, message.tickPrice):
-                if msg.field not in MKT_DATA_FIELDS:
-                    # we ignore fields that we don't know of
+        batch.answered[:] = [outcome is True for outcome in outcomes]
+        return batch
+
+    def get_option_chain(self, underlying, expiries=None, strikes=None,
+        currency='USD', exchange='SMART', trading_class=None,
+        max_in_flight=50, timeout=None, fields=None):
+        """
+        Downloads the option chain of *underlying* (a symbol, or a contract)
+        along with a market data snapshot of every option, and returns it
+        as an *OptionChain*, whose *calls* and *puts* are strike x expiry
+        surfaces of NumPy arrays (requires NumPy).
+
+        The chain can be restricted to some *expiries* ('YYYYMMDD' strings or
+        *date* objects), *strikes* and *trading_class*. When several options
+        share a right, strike and expiry (e.g. after an adjustment), the
+        first one TWS returns is kept. The expiries are requested
+        concurrently.
+
+        *timeout* applies to the download as a whole; options which did not
+        answer in time are *False* in the *available* surfaces.
+
+        *fields* are as for *get_market_data*.
+        """
+        from untws.option_chain import OptionChain, chain_key
+        fields = self._snapshot_fields(fields)
+        deadline = self._deadline(timeout)
+        c = Contract()
+        c.m_secType = 'OPT'
+        c.m_symbol = getattr(underlying, 'm_symbol', underlying)
+        c.m_currency = currency
+        c.m_exchange = exchange
+        if trading_class is not None:
+            c.m_tradingClass = trading_class
+        if expiries is None:
+            requests = [c]
+        else:
+            # one request per expiry, rather than the whole chain
+            requests = []
+            for expiry in expiries:
+                r = Contract()
+                r.__dict__.update(c.__dict__)
+                if hasattr(expiry, 'strftime'):
+                    expiry = expiry.strftime('%Y%m%d')
+                r.m_expiry = expiry
+                requests.append(r)
+        if strikes is not None:
+            strikes = set(float(s) for s in strikes)
+        contracts = []
+        seen = set()
+        # the expiries are requested together, and read back in order
+        for found in self._get_contract_details_many(requests, deadline):
+            for details in found:
+                contract = details.m_summary
+                key = chain_key(contract)
+                if key in seen or \
+                        strikes is not None and contract.m_strike not in strikes:
                     continue
-                data[MKT_DATA_FIELDS[msg.field]] = msg.price
-            elif isinstance(msg, message.tickOptionComputation):
-                if msg.field not in OPT_DATA_FIELDS:
-                    # we ignore fields that we don't know of
+                seen.add(key)
+                contracts.append(contract)
+        batch = self._get_batch(contracts, max_in_flight, deadline, fields)
+        return OptionChain(contracts, batch)
+
+    def _get_snapshots(self, instruments, max_in_flight, deadline, fields):
+        """
+        Requests market data snapshots, returning the list of quotes and the
+        list of error messages (*None* where the request succeeded). Stops
+        at *deadline*, leaving the remaining quotes as *None*.
+        """
+        instruments = list(instruments)
+        # (fields, option fields) of each instrument
+        values = [({}, {}) for i in instruments]
+
+        def record(index, msg):
+            _apply_tick(values[index][0], values[index][1], msg, fields)
+
+        outcomes = self._request_snapshots(
+            instruments,
+            max_in_flight,
+            deadline,
+            record
+        )
+        quotes = [None] * len(instruments)
+        errors = [None] * len(instruments)
+        for index, outcome in enumerate(outcomes):
+            if outcome is True:
+                quotes[index] = _make_quote(
+                    instruments[index],
+                    values[index][0],
+                    values[index][1]
+                )
+            elif outcome is not None:
+                errors[index] = outcome
+        return quotes, errors
+
+    def _request_snapshots(self, instruments, max_in_flight, deadline,
+        record):
+        """
+        Requests market data snapshots, keeping up to *max_in_flight* of
+        them outstanding, and calls *record(index, msg)* (from the reader
+        thread) for each tick received for *instruments[index]*. Stops at
+        *deadline*.
+
+        Returns the outcome of each request: *True* if it completed, the
+        error message if TWS rejected it, *None* if it did not answer.
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        outcomes = [None] * len(instruments)
+        # ticker id -> (index in instruments, scheduler job, timer)
+        pending = {}
+        # receives (ticker id, error message or None) as requests end
+        completed = Queue()
+
+        def process_tick(msg):
+            if msg.typeName == 'tickSnapshotEnd':
+                completed.put((msg.reqId, None))
+            elif msg.typeName == 'error':
+                if not is_warning(msg):
+                    completed.put((msg.id, msg))
+            else:
+                request = pending.get(msg.tickerId)
+                if request is not None:
+                    request[2].message()
+                    record(request[0], msg)
+
+        next_index = 0
+        try:
+            while next_index < len(instruments) or pending:
+                while next_index < len(instruments) and \
+                        len(pending) < max_in_flight:
+                    ticker_id = self._next_request_id()
+                    self._dispatcher.subscribe(ticker_id, process_tick)
+                    self._track(ticker_id, instruments[next_index])
+                    timer = self._timer('market_data')
+                    # ticks may arrive before _send returns
+                    pending[ticker_id] = (next_index, None, timer)
+                    # request a "non-subscription" market data quote
+                    job = self._send(
+                        PRIORITY_MARKET_DATA,
+                        'reqMktData',
+                        ticker_id,
+                        instruments[next_index],
+                        '',
+                        True
+                    )
+                    timer.job = job
+                    pending[ticker_id] = (next_index, job, timer)
+                    next_index += 1
+                try:
+                    ticker_id, error = _wait(completed, deadline)
+                except RequestTimeout:
+                    break
+                if ticker_id not in pending:
+                    # e.g. a snapshot end following an error
                     continue
-                opts[OPT_DATA_FIELDS[msg.field]] = MarketDataQuoteBase({
-                    'price': msg.optPrice,
-                    'delta': msg.delta,
-                    'gamma': msg.gamma,
-                    'vega': msg.vega,
-                    'theta': msg.theta,
-                    'underlying_price': msg.undPrice,
-                    'pv_dividends': msg.pvDividend,
-                    'implied_vol': msg.impliedVol
-                })
+                self._dispatcher.unsubscribe(ticker_id, process_tick)
+                self._untrack(ticker_id)
+                index, job, timer = pending.pop(ticker_id)
+                if error is None:
+                    timer.done()
+                    outcomes[index] = True
+                else:
+                    timer.failed()
+                    outcomes[index] = error
+        finally:
+            # cancel whatever is still outstanding
+            for ticker_id, request in pending.items():
+                self._dispatcher.unsubscribe(ticker_id, process_tick)
+                self._untrack(ticker_id)
+                request[2].failed()
+                self._cancel(request[1], 'cancelMktData', ticker_id)
+        return outcomes
+
+    def subscribe(self, instrument, fields=None):
+        """
+        Opens a streaming market data subscription for an instrument, and
+        returns a *LiveQuote* which is updated in place as ticks arrive.
+        Subscribing to an instrument which is already subscribed returns the
+        existing quote.
+
+        *fields* (a *tick_fields.FieldMap* or a list of field names)
+        overrides the fields of the connection; the generic ticks they need
+        are requested along.
+
+        Each subscription uses one TWS market data line; at most
+        *max_subscriptions* may be open at once.
+        """
+        key = _contract_key(instrument)
+        with self._subscriptions_lock:
+            quote = self._subscriptions.get(key)
+            if quote is not None:
+                return quote
+            if len(self._subscriptions) >= self.max_subscriptions:
+                raise SubscriptionLimitExceeded(
+                    "Cannot have more than %d market data subscriptions" % \
+                    self.max_subscriptions
+                )
+            quote = LiveQuote(
+                instrument,
+                self._next_request_id(),
+                self.fields if fields is None else field_map(fields)
+            )
+            self._subscriptions[key] = quote
+
+        data = quote._data_points
+        opts = quote._options
+        fields = quote.fields
+        def process_tick(msg):
+            if msg.typeName == 'error':
+                if not is_warning(msg):
+                    quote._error = msg
             else:
-                raise Exception("Unexpected message type: %s" % msg.typeName)
-        self.connection.unregister(
-            self._process_message,
-            message.tickPrice,
-            message.tickSnapshotEnd,
-            message.tickOptionComputation
+                _apply_tick(data, opts, msg, fields)
+                if opts and 'option' not in data:
+                    data['option'] = OptionDataQuote(opts)
+                for listener in quote._listeners:
+                    listener(quote, msg)
+
+        self._dispatcher.subscribe(quote.ticker_id, process_tick)
+        self._track(quote.ticker_id, instrument)
+        try:
+            self._streams[quote.ticker_id] = self._send(
+                PRIORITY_MARKET_DATA,
+                'reqMktData',
+                quote.ticker_id,
+                instrument,
+                fields.generic_ticks,
+                False
+            )
+        except Exception:
+            self.unsubscribe(quote)
+            raise
+        return quote
+
+    def unsubscribe(self, quote):
+        """
+        Cancels the streaming subscription behind a *LiveQuote* returned by
+        *subscribe*. The quote stops being updated.
+        """
+        with self._subscriptions_lock:
+            key = _contract_key(quote.instrument)
+            if self._subscriptions.get(key) is not quote:
+                return
+            del self._subscriptions[key]
+        self._dispatcher.unsubscribe_all(quote.ticker_id)
+        self._untrack(quote.ticker_id)
+        self._cancel(
+            self._streams.pop(quote.ticker_id, None),
+            'cancelMktData',
+            quote.ticker_id
         )
-        if len(opts) > 0:
-            data['option'] = OptionDataQuote(opts)
-        return MarketDataQuoteInstrument(instrument, data)
-    
+
+    @property
+    def subscriptions(self):
+        """The list of quotes with an open streaming subscription"""
+        return list(self._subscriptions.values())
+
+    def subscribe_depth(self, instrument, rows=10):
+        """
+        Opens a market depth subscription for an instrument, *rows* levels
+        deep on each side, and returns a *market_depth.DepthBook* which is
+        updated in place (requires NumPy). Subscribing to an instrument
+        which is already subscribed returns the existing book.
+
+        At most *max_depth_subscriptions* may be open at once.
+        """
+        from untws.market_depth import DepthBook
+        key = _contract_key(instrument)
+        with self._subscriptions_lock:
+            book = self._depth_books.get(key)
+            if book is not None:
+                return book
+            if len(self._depth_books) >= self.max_depth_subscriptions:
+                raise SubscriptionLimitExceeded(
+                    "Cannot have more than %d market depth subscriptions" % \
+                    self.max_depth_subscriptions
+                )
+            book = DepthBook(instrument, self._next_request_id(), rows)
+            self._depth_books[key] = book
+
+        def process_depth(msg):
+            if msg.typeName == 'error':
+                if not is_warning(msg):
+                    book._error = msg
+                return
+            book.update(
+                msg.position,
+                msg.operation,
+                msg.side,
+                msg.price,
+                msg.size,
+                getattr(msg, 'marketMaker', None)
+            )
+            for listener in book._listeners:
+                listener(book, msg)
+
+        self._dispatcher.subscribe(book.ticker_id, process_depth)
+        try:
+            self._streams[book.ticker_id] = self._send(
+                PRIORITY_MARKET_DATA,
+                'reqMktDepth',
+                book.ticker_id,
+                instrument,
+                rows
+            )
+        except Exception:
+            self.unsubscribe_depth(book)
+            raise
+        return book
+
+    def unsubscribe_depth(self, book):
+        """
+        Cancels the market depth subscription behind a *DepthBook* returned
+        by *subscribe_depth*. The book stops being updated.
+        """
+        with self._subscriptions_lock:
+            key = _contract_key(book.instrument)
+            if self._depth_books.get(key) is not book:
+                return
+            del self._depth_books[key]
+        self._dispatcher.unsubscribe_all(book.ticker_id)
+        self._cancel(
+            self._streams.pop(book.ticker_id, None),
+            'cancelMktDepth',
+            book.ticker_id
+        )
+
+    @property
+    def depth_subscriptions(self):
+        """The list of books with an open market depth subscription"""
+        return list(self._depth_books.values())
+
+    @property
+    def orders(self):
+        """The orders placed through this connection"""
+        return list(self._orders.values())
+
+    def _process_order_message(self, msg):
+        name = msg.typeName
+        if name == 'nextValidId':
+            with self._order_id_lock:
+                # never go back on ids we already used
+                if self._next_order_id is None or \
+                        msg.orderId > self._next_order_id:
+                    self._next_order_id = msg.orderId
+            self._order_ids_ready.set()
+            return
+        elif name == 'openOrderEnd':
+            return
+        elif name == 'execDetails':
+            order_id = msg.execution.m_orderId
+        elif name == 'error':
+            order_id = msg.id
+        else:
+            order_id = msg.orderId
+        handle = self._orders.get(order_id)
+        if handle is not None:
+            handle._process_message(msg)
+
+    def _allocate_order_ids(self, number, timeout=None):
+        """
+        Reserves *number* consecutive order ids, waiting (up to *timeout*
+        seconds) for TWS to send the first valid one if it has not yet.
+        """
+        deadline = self._deadline(timeout)
+        remaining = None if deadline is None else max(deadline - time(), 0)
+        if not self._order_ids_ready.wait(remaining):
+            raise RequestTimeout("TWS did not send the next valid order id")
+        with self._order_id_lock:
+            first = self._next_order_id
+            self._next_order_id += number
+        return range(first, first + number)
+
+    def create_order(self, action, quantity, limit_price=None,
+        order_type=None, tif='DAY'):
+        """
+        Creates an order to 'BUY' or 'SELL' (*action*) *quantity* units,
+        at *limit_price* if given (a limit order) or at market. *order_type*
+        overrides the IB order type (e.g. 'MOC').
+        """
+        o = Order()
+        o.m_action = action
+        o.m_totalQuantity = quantity
+        if limit_price is not None:
+            o.m_lmtPrice = limit_price
+            o.m_orderType = 'LMT'
+        else:
+            o.m_orderType = 'MKT'
+        if order_type is not None:
+            o.m_orderType = order_type
+        o.m_tif = tif
+        return o
+
+    def _place(self, order_id, instrument, order):
+        handle = OrderHandle(
+            self,
+            order_id,
+            instrument,
+            order,
+            self._timer('order_ack')
+        )
+        order.m_orderId = order_id
+        order.m_clientId = self.client_id
+        self._orders[order_id] = handle
+        try:
+            handle.job = handle._timer.job = self._send(
+                PRIORITY_ORDER,
+                'placeOrder',
+                order_id,
+                instrument,
+                order
+            )
+        except Exception:
+            # e.g. SchedulerClosed: the order was never sent
+            del self._orders[order_id]
+            handle._timer.failed()
+            raise
+        return handle
+
+    def place_order(self, instrument, order, timeout=None):
+        """
+        Places *order* (e.g. from *create_order*) on *instrument*, and returns
+        an *OrderHandle* tracking it, without waiting for TWS. Order ids are
+        allocated locally; only the first order placed on a connection may
+        wait (up to *timeout*) for TWS to send the first valid id.
+        """
+        order_id = self._allocate_order_ids(1, timeout)[0]
+        return self._place(order_id, instrument, order)
+
+    def place_orders(self, batch, timeout=None):
+        """
+        Places several orders at once, *batch* being a list of
+        (instrument, order) pairs. They are queued together and sent as fast
+        as the rate limits allow, orders going ahead of any other request.
+        Returns their *OrderHandle* objects, in the same order.
+        """
+        batch = list(batch)
+        order_ids = self._allocate_order_ids(len(batch), timeout)
+        return [
+            self._place(order_id, instrument, order)
+            for order_id, (instrument, order) in zip(order_ids, batch)
+        ]
+
+    def cancel_order(self, handle):
+        """
+        Cancels an order placed with *place_order*. If it was still queued,
+        it is never sent, and is cancelled right away. Raises
+        *SchedulerClosed* while disconnected, since the order stays live in
+        TWS.
+        """
+        if self._scheduler.withdraw(handle.job):
+            handle._withdrawn()
+        else:
+            self._send(PRIORITY_CANCEL, 'cancelOrder', handle.order_id)
+
+    def get_futures_curves(self, symbols, exchange='GLOBEX', currency='USD',
+        trading_class=None, refresh=False, timeout=None):
+        """
+        Returns the *FuturesCurve* (the listed contracts, by expiry) of
+        several futures symbols, as a dictionary keyed by symbol.
+
+        Curves are cached for *FUTURES_CURVE_TTL* seconds (unless *refresh*
+        is *True*). Those which are not are looked up together, with a
+        single *reqContractDetails* request per symbol, all queued at once;
+        their contracts are stored in the contract cache, if there is one.
+        """
+        from untws.futures import FuturesCurve, curve_key, FUTURES_CURVE_TTL
+        deadline = self._deadline(timeout)
+        out = {}
+        missing = []
+        for symbol in symbols:
+            key = curve_key(symbol, exchange, currency, trading_class)
+            curve = self._futures_curves.get(key)
+            if not refresh and curve is not None and \
+                    time() - curve.resolved <= FUTURES_CURVE_TTL:
+                out[symbol] = curve
+            elif symbol not in missing:
+                missing.append(symbol)
+        requests = []
+        for symbol in missing:
+            c = Contract()
+            c.m_secType = 'FUT'
+            c.m_symbol = symbol
+            c.m_exchange = exchange
+            c.m_currency = currency
+            if trading_class is not None:
+                c.m_tradingClass = trading_class
+            requests.append(c)
+        details = self._get_contract_details_many(requests, deadline)
+        for symbol, symbol_details in zip(missing, details):
+            curve = FuturesCurve(symbol, symbol_details)
+            key = curve_key(symbol, exchange, currency, trading_class)
+            self._futures_curves[key] = out[symbol] = curve
+            if self.contract_cache is not None:
+                for contract in curve.contracts:
+                    self.contract_cache.put(contract)
+        return out
+
+    def get_futures_curve(self, symbol, exchange='GLOBEX', currency='USD',
+        trading_class=None, refresh=False, timeout=None):
+        """Same as *get_futures_curves*, for a single symbol"""
+        return self.get_futures_curves(
+            [symbol],
+            exchange,
+            currency,
+            trading_class,
+            refresh,
+            timeout
+        )[symbol]
+
+    def _resolve(self, contract):
+        """Resolves *contract* through the contract cache, if there is one"""
+        if self.contract_cache is None:
+            return contract
+        return self.contract_cache.resolve(self, contract)
+
     def create_stock(self, ticker, currency='USD', exchange='SMART'):
         c = Contract()
         c.m_secType = 'STK'
         c.m_localSymbol = ticker
         c.m_currency = currency
         c.m_exchange = exchange
-        return c
+        return self._resolve(c)
         
     def create_option_ticker(self, ticker, currency='USD', exchange='SMART'):
         c = Contract()
@@ -158,6 +1320,52 @@ class IBConnection(object):
         c.m_localSymbol = ticker
         c.m_currency = currency
         c.m_exchange = exchange
+        return self._resolve(c)
+
+    def create_future(self, symbol, expiry=None, exchange='GLOBEX',
+        currency='USD', trading_class=None, roll_days=0, timeout=None):
+        """
+        Returns the futures contract of *symbol* for the contract month
+        *expiry* ('YYYYMM', or a 'YYYYMMDD' string or *date* in that month),
+        or the front month if it is *None* (see *FuturesCurve.front*). It
+        is taken from the futures curve, so that creating the contracts of
+        every month of a symbol takes a single lookup.
+        """
+        curve = self.get_futures_curve(
+            symbol,
+            exchange,
+            currency,
+            trading_class,
+            timeout=timeout
+        )
+        if expiry is None:
+            return curve.front(roll_days=roll_days)
+        return curve.contract(expiry)
+
+    def create_future_option(self, symbol, expiry, strike, right,
+        exchange='GLOBEX', currency='USD', multiplier=None,
+        trading_class=None):
+        """
+        Creates a futures option contract on *symbol*, expiring on *expiry*
+        ('YYYYMMDD' or a *date*), with *right* 'C' or 'P'. The contract is
+        fully described by its fields, so TWS accepts it without a lookup;
+        *trading_class* tells apart the weekly and monthly options of
+        symbols which have both.
+        """
+        c = Contract()
+        c.m_secType = 'FOP'
+        c.m_symbol = symbol
+        if hasattr(expiry, 'strftime'):
+            expiry = expiry.strftime('%Y%m%d')
+        c.m_expiry = expiry
+        c.m_strike = float(strike)
+        c.m_right = right[0].upper()
+        c.m_currency = currency
+        c.m_exchange = exchange
+        if multiplier is not None:
+            c.m_multiplier = str(multiplier)
+        if trading_class is not None:
+            c.m_tradingClass = trading_class
         return c
         
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# contract_cache.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+A persistent cache of fully resolved contracts.
+"""
+
+import json
+import sqlite3
+from threading import Lock
+from time import time
+from ib.ext.Contract import Contract
+
+__all__ = ['ContractCache']
+
+try:
+    _text = unicode
+except NameError:
+    # Python 3: json and sqlite already hand back str
+    _text = str
+
+# the contract fields which are stored in the cache
+CONTRACT_FIELDS = (
+    'm_conId', 'm_symbol', 'm_secType', 'm_expiry', 'm_strike', 'm_right',
+    'm_multiplier', 'm_exchange', 'm_currency', 'm_localSymbol',
+    'm_tradingClass', 'm_primaryExch'
+)
+
+def lookup_key(contract):
+    """
+    Returns the key under which a contract is looked up by description:
+    (secType, localSymbol, exchange, currency).
+    """
+    return (
+        contract.m_secType,
+        contract.m_localSymbol,
+        contract.m_exchange,
+        contract.m_currency
+    )
+
+def _dump(contract):
+    return json.dumps(dict((f, getattr(contract, f)) for f in CONTRACT_FIELDS))
+
+def _native(value):
+    """
+    *value* as IbPy expects it: json and sqlite hand back unicode strings,
+    IbPy expects str (*None* and numbers are kept as they are)
+    """
+    if isinstance(value, _text):
+        return str(value)
+    return value
+
+def _load(fields):
+    contract = Contract()
+    for name, value in json.loads(fields).items():
+        setattr(contract, str(name), _native(value))
+    return contract
+
+class ContractCache(object):
+    """
+    Contracts resolved through *reqContractDetails*, indexed by conId and by
+    (secType, localSymbol, exchange, currency).
+
+    The cache is persisted in the SQLite database *path* (in memory only if
+    it is *None*), so that later runs start warm. Entries older than *ttl*
+    seconds are ignored, and resolved again when needed.
+    """
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._db = sqlite3.connect(
+            ':memory:' if path is None else path,
+            check_same_thread=False
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS contracts ('
+            'conid INTEGER PRIMARY KEY, '
+            'fields TEXT NOT NULL, '
+            'updated REAL NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS lookups ('
+            'sec_type TEXT, local_symbol TEXT, exchange TEXT, currency TEXT, '
+            'conid INTEGER NOT NULL, '
+            'PRIMARY KEY (sec_type, local_symbol, exchange, currency))'
+        )
+        self._db.commit()
+        # conid -> (contract, time it was resolved)
+        self._by_conid = {}
+        # lookup key -> conid
+        self._by_key = {}
+        self._load()
+
+    def _load(self):
+        """Loads the entries which have not expired from the database"""
+        self.evict_expired()
+        for conid, fields, updated in self._db.execute(
+            'SELECT conid, fields, updated FROM contracts'
+        ):
+            self._by_conid[conid] = (_load(fields), updated)
+        for row in self._db.execute('SELECT * FROM lookups'):
+            if row[4] in self._by_conid:
+                self._by_key[tuple(_native(f) for f in row[:4])] = row[4]
+
+    def __len__(self):
+        return len(self._by_conid)
+
+    def _fresh(self, entry):
+        return entry is not None and time() - entry[1] <= self.ttl
+
+    def get(self, conid):
+        """Returns the cached contract with this conId, or *None*"""
+        entry = self._by_conid.get(conid)
+        if self._fresh(entry):
+            return entry[0]
+        return None
+
+    def lookup(self, contract):
+        """
+        Returns the cached contract matching the secType, localSymbol,
+        exchange and currency of *contract*, or *None*.
+        """
+        conid = self._by_key.get(lookup_key(contract))
+        if conid is None:
+            return None
+        return self.get(conid)
+
+    def put(self, contract, request=None):
+        """
+        Stores a resolved contract. If given, *request* is the (partial)
+        contract it was resolved from, which is indexed as well.
+        """
+        now = time()
+        keys = [lookup_key(contract)]
+        if request is not None:
+            keys.append(lookup_key(request))
+        with self._lock:
+            self._by_conid[contract.m_conId] = (contract, now)
+            for key in keys:
+                self._by_key[key] = contract.m_conId
+            self._db.execute(
+                'INSERT OR REPLACE INTO contracts VALUES (?, ?, ?)',
+                (contract.m_conId, _dump(contract), now)
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)',
+                [key + (contract.m_conId,) for key in keys]
+            )
+            self._db.commit()
+
+    def resolve(self, connection, contract, timeout=None):
+        """
+        Returns the fully populated contract matching *contract*, from the
+        cache if possible, else by looking it up with *connection* (and
+        caching the result).
+        """
+        if contract.m_conId:
+            cached = self.get(contract.m_conId)
+        else:
+            cached = self.lookup(contract)
+        if cached is not None:
+            return cached
+        details = connection.get_contract_details(contract, timeout=timeout)
+        if len(details) != 1:
+            raise Exception(
+                "Expected one contract matching %s, got %d" % \
+                (contract.m_localSymbol or contract.m_symbol, len(details))
+            )
+        resolved = details[0].m_summary
+        self.put(resolved, contract)
+        return resolved
+
+    def evict_expired(self):
+        """Removes the entries older than *ttl* seconds"""
+        cutoff = time() - self.ttl
+        with self._lock:
+            for conid, entry in list(self._by_conid.items()):
+                if entry[1] < cutoff:
+                    del self._by_conid[conid]
+            for key, conid in list(self._by_key.items()):
+                if conid not in self._by_conid:
+                    del self._by_key[key]
+            self._db.execute(
+                'DELETE FROM lookups WHERE conid IN '
+                '(SELECT conid FROM contracts WHERE updated < ?)',
+                (cutoff,)
+            )
+            self._db.execute('DELETE FROM contracts WHERE updated < ?', (cutoff,))
+            self._db.commit()
+
+    def close(self):
+        """Closes the database"""
+        self._db.close()
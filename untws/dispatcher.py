@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# dispatcher.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Routing of incoming IbPy messages to the requests waiting for them
+"""
+
+from contextlib import contextmanager
+from threading import Lock
+try:
+    from Queue import Queue
+except ImportError:
+    # python 3
+    from queue import Queue
+
+__all__ = ['MessageDispatcher', 'is_warning', 'REQUEST_ID_BASE']
+
+# request ids start here, so that they never collide with order ids (which
+# TWS counts up from 1): both come back in the id of error messages
+REQUEST_ID_BASE = 1 << 30
+
+# message type -> name of the attribute holding the request (ticker) id
+REQUEST_ID_FIELDS = {
+    'tickPrice': 'tickerId',
+    'tickSize': 'tickerId',
+    'tickGeneric': 'tickerId',
+    'tickString': 'tickerId',
+    'tickOptionComputation': 'tickerId',
+    'updateMktDepth': 'tickerId',
+    'updateMktDepthL2': 'tickerId',
+    'tickSnapshotEnd': 'reqId',
+    'contractDetails': 'reqId',
+    'bondContractDetails': 'reqId',
+    'contractDetailsEnd': 'reqId',
+    'historicalData': 'reqId',
+    'error': 'id'
+}
+
+# message type -> name of the stream it belongs to, for messages which
+# are not tied to a request id
+STREAMS = {
+    'currentTime': 'currentTime',
+    'updatePortfolio': 'account',
+    'updateAccountValue': 'account',
+    'updateAccountTime': 'account',
+    'accountDownloadEnd': 'account',
+    'position': 'positions',
+    'positionEnd': 'positions',
+    'nextValidId': 'orders',
+    'orderStatus': 'orders',
+    'openOrder': 'orders',
+    'openOrderEnd': 'orders',
+    'execDetails': 'orders'
+}
+
+def is_warning(msg):
+    """
+    Returns *True* if an *error* message is merely informational (e.g.
+    "market data farm connection is OK"), and does not end the request
+    it refers to.
+    """
+    return 2100 <= msg.errorCode < 2200 or msg.errorCode in (10090, 10167)
+
+class MessageDispatcher(object):
+    """
+    Routes incoming messages to handlers.
+
+    Messages carrying a request id (e.g. *tickPrice*) are handed to the
+    handlers subscribed to that id. Other messages are handed to the
+    handlers of the stream they belong to (e.g. 'account' for
+    *updatePortfolio*), as are errors about orders ('orders'). Messages
+    nobody is subscribed to are dropped.
+    """
+
+    def __init__(self, metrics=None):
+        self._handlers = {}
+        self._lock = Lock()
+        # counts the messages, if set (see untws.metrics)
+        self.metrics = metrics
+
+    @property
+    def message_types(self):
+        """The message types this dispatcher knows how to route"""
+        return list(REQUEST_ID_FIELDS) + list(STREAMS)
+
+    def subscribe(self, key, handler):
+        """
+        Hands every message for *key* (a request id or a stream name) to
+        *handler*. Handlers are called from the IbPy reader thread.
+        """
+        with self._lock:
+            # copy on write, so that dispatch never needs the lock
+            handlers = dict(self._handlers)
+            handlers[key] = handlers.get(key, ()) + (handler,)
+            self._handlers = handlers
+
+    def unsubscribe(self, key, handler):
+        """Stops handing messages for *key* to *handler*"""
+        with self._lock:
+            handlers = dict(self._handlers)
+            remaining = tuple(h for h in handlers.get(key, ()) if h != handler)
+            if remaining:
+                handlers[key] = remaining
+            else:
+                handlers.pop(key, None)
+            self._handlers = handlers
+
+    def unsubscribe_all(self, key):
+        """Stops handing messages for *key* to any handler"""
+        with self._lock:
+            handlers = dict(self._handlers)
+            handlers.pop(key, None)
+            self._handlers = handlers
+
+    @contextmanager
+    def mailbox(self, key, timer=None):
+        """
+        Context manager yielding a *Queue* which receives the messages
+        for *key* until the block exits. If given, *timer* (a
+        *metrics.RequestTimer*) is told of each message as it arrives.
+        """
+        mailbox = Queue()
+        if timer is None or not timer.enabled:
+            handler = mailbox.put
+        else:
+            def handler(msg):
+                timer.message()
+                mailbox.put(msg)
+        self.subscribe(key, handler)
+        try:
+            yield mailbox
+        finally:
+            self.unsubscribe(key, handler)
+
+    def dispatch(self, msg):
+        """Callback for ibpy"""
+        name = msg.typeName
+        if name in REQUEST_ID_FIELDS:
+            key = getattr(msg, REQUEST_ID_FIELDS[name])
+            if name == 'error' and 0 <= key < REQUEST_ID_BASE:
+                key = 'orders'
+        else:
+            key = STREAMS.get(name)
+        handlers = self._handlers.get(key, ())
+        if self.metrics is not None:
+            self.metrics.count(msg, bool(handlers))
+        for handler in handlers:
+            handler(msg)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# fast_decoder.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+A drop-in replacement for the IbPy connection, which decodes the hot
+message types itself.
+
+IbPy reads the socket one byte at a time, and hands each message through
+its *Receiver* and *Dispatcher*, which build a dictionary and a new
+message object for every tick. Here the socket is read in large chunks
+with *recv_into*, *tickPrice*, *tickSize*, *tickOptionComputation* and
+*updatePortfolio* are decoded directly and handed to the listeners, and
+every other message goes through IbPy as before.
+"""
+
+import logging
+from ib.ext.Contract import Contract
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.EReader import EReader
+from ib.lib import Double
+from ib.opt import message
+from ib.opt.connection import Connection
+from ib.opt.dispatcher import Dispatcher
+from ib.opt.receiver import Receiver
+from ib.opt.sender import Sender
+
+__all__ = ['FastTransport', 'FAST_MESSAGE_TYPES']
+
+log = logging.getLogger(__name__)
+
+# the message types decoded without IbPy
+FAST_MESSAGE_TYPES = (
+    'tickPrice', 'tickSize', 'tickOptionComputation', 'updatePortfolio'
+)
+
+# tickPrice fields -> the tickSize field sent along with them
+_SIZE_FIELDS = {1: 0, 2: 3, 4: 5}
+
+_MAX = Double.MAX_VALUE
+
+if bytes is str:
+    _text = str
+else:
+    # python 3
+    def _text(field):
+        return field.decode('utf-8')
+
+class _SocketBuffer(object):
+    """
+    Reads the socket into a preallocated buffer, and splits what it
+    receives into the null-terminated fields TWS sends. *field* returns the
+    next field, as bytes.
+    """
+
+    def __init__(self, sock, size=1 << 16):
+        self._sock = sock
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        fields = self._fields()
+        self.field = getattr(fields, 'next', None) or fields.__next__
+
+    def _fields(self):
+        # the beginning of a field cut in two by recv
+        partial = b''
+        while True:
+            received = self._sock.recv_into(self._buffer)
+            if not received:
+                raise EOFError("TWS closed the connection")
+            fields = (partial + self._view[:received].tobytes()).split(b'\0')
+            partial = fields.pop()
+            for field in fields:
+                yield field
+
+def _int(field):
+    return int(field) if field else 0
+
+def _float(field):
+    return float(field) if field else 0.0
+
+def _str(field):
+    return _text(field) if field else None
+
+class _FastReader(EReader):
+    """
+    An IbPy reader thread decoding the hot message types itself.
+
+    *listeners* maps message types to the listeners they are handed to.
+    Unless *reuse_messages* is *False*, the same message object is reused
+    for all the ticks of a type, so listeners must not keep them.
+    """
+
+    def __init__(self, parent, dis, buffer, listeners, reuse_messages=True):
+        # EReader's constructor is overloaded on the types of its arguments
+        EReader.__init__(self, 'EReader', parent, dis)
+        self._buffer = buffer
+        self._listeners = listeners
+        self._reuse = reuse_messages
+        self._messages = {}
+        self._decoders = {
+            self.TICK_PRICE: self._tick_price,
+            self.TICK_SIZE: self._tick_size,
+            self.TICK_OPTION_COMPUTATION: self._tick_option_computation,
+            self.PORTFOLIO_VALUE: self._portfolio_value
+        }
+        self.decoded = 0
+
+    def readStr(self):
+        return _str(self._buffer.field())
+
+    def readInt(self):
+        return _int(self._buffer.field())
+
+    def processMsg(self, msgId):
+        decode = self._decoders.get(msgId)
+        if decode is None:
+            return EReader.processMsg(self, msgId)
+        decode()
+        self.decoded += 1
+        return True
+
+    def _message(self, name):
+        """An empty message object of type *name*"""
+        if self._reuse:
+            msg = self._messages.get(name)
+            if msg is None:
+                msg = self._messages[name] = message.registry[name][0]()
+            return msg
+        return message.registry[name][0]()
+
+    def _dispatch(self, listeners, msg):
+        for listener in listeners:
+            try:
+                listener(msg)
+            except Exception:
+                log.exception("Handler %r failed on %s", listener, msg.typeName)
+
+    def _tick_price(self):
+        read = self._buffer.field
+        version = _int(read())
+        ticker_id = _int(read())
+        field = _int(read())
+        price = _float(read())
+        size = _int(read()) if version >= 2 else 0
+        can_auto_execute = _int(read()) if version >= 3 else 0
+        listeners = self._listeners.get('tickPrice')
+        if listeners:
+            msg = self._message('tickPrice')
+            msg.tickerId = ticker_id
+            msg.field = field
+            msg.price = price
+            msg.canAutoExecute = can_auto_execute
+            self._dispatch(listeners, msg)
+        if version >= 2 and field in _SIZE_FIELDS:
+            self._size(ticker_id, _SIZE_FIELDS[field], size)
+
+    def _tick_size(self):
+        read = self._buffer.field
+        read()
+        ticker_id = _int(read())
+        field = _int(read())
+        self._size(ticker_id, field, _int(read()))
+
+    def _size(self, ticker_id, field, size):
+        listeners = self._listeners.get('tickSize')
+        if listeners:
+            msg = self._message('tickSize')
+            msg.tickerId = ticker_id
+            msg.field = field
+            msg.size = size
+            self._dispatch(listeners, msg)
+
+    def _tick_option_computation(self):
+        read = self._buffer.field
+        version = _int(read())
+        ticker_id = _int(read())
+        field = _int(read())
+        # the same "not computed yet" conventions as IbPy
+        implied_vol = _float(read())
+        if implied_vol < 0:
+            implied_vol = _MAX
+        delta = _float(read())
+        if abs(delta) > 1:
+            delta = _MAX
+        opt_price = pv_dividend = gamma = vega = theta = und_price = _MAX
+        if version >= 6 or field == 13:
+            opt_price = _float(read())
+            if opt_price < 0:
+                opt_price = _MAX
+            pv_dividend = _float(read())
+            if pv_dividend < 0:
+                pv_dividend = _MAX
+        if version >= 6:
+            gamma = _float(read())
+            if abs(gamma) > 1:
+                gamma = _MAX
+            vega = _float(read())
+            if abs(vega) > 1:
+                vega = _MAX
+            theta = _float(read())
+            if abs(theta) > 1:
+                theta = _MAX
+            und_price = _float(read())
+            if und_price < 0:
+                und_price = _MAX
+        listeners = self._listeners.get('tickOptionComputation')
+        if listeners:
+            msg = self._message('tickOptionComputation')
+            msg.tickerId = ticker_id
+            msg.field = field
+            msg.impliedVol = implied_vol
+            msg.delta = delta
+            msg.optPrice = opt_price
+            msg.pvDividend = pv_dividend
+            msg.gamma = gamma
+            msg.vega = vega
+            msg.theta = theta
+            msg.undPrice = und_price
+            self._dispatch(listeners, msg)
+
+    def _portfolio_value(self):
+        read = self._buffer.field
+        version = _int(read())
+        # positions are kept, so they always get a message of their own
+        msg = message.registry['updatePortfolio'][0]()
+        c = msg.contract = Contract()
+        if version >= 6:
+            c.m_conId = _int(read())
+        c.m_symbol = _str(read())
+        c.m_secType = _str(read())
+        c.m_expiry = _str(read())
+        c.m_strike = _float(read())
+        c.m_right = _str(read())
+        if version >= 7:
+            c.m_multiplier = _str(read())
+            c.m_primaryExch = _str(read())
+        c.m_currency = _str(read())
+        if version >= 2:
+            c.m_localSymbol = _str(read())
+        if version >= 8:
+            c.m_tradingClass = _str(read())
+        msg.position = _int(read())
+        msg.marketPrice = _float(read())
+        msg.marketValue = _float(read())
+        msg.averageCost = msg.unrealizedPNL = msg.realizedPNL = 0.0
+        if version >= 3:
+            msg.averageCost = _float(read())
+            msg.unrealizedPNL = _float(read())
+            msg.realizedPNL = _float(read())
+        msg.accountName = _str(read()) if version >= 4 else None
+        if version == 6 and self.m_parent.serverVersion() == 39:
+            c.m_primaryExch = _str(read())
+        listeners = self._listeners.get('updatePortfolio')
+        if listeners:
+            self._dispatch(listeners, msg)
+
+class _FastClientSocket(EClientSocket):
+    """An IbPy client socket whose reader thread is a *_FastReader*"""
+
+    def __init__(self, wrapper, transport):
+        EClientSocket.__init__(self, wrapper)
+        self._transport = transport
+
+    def createReader(self, parent, dis):
+        buffer = _SocketBuffer(dis.stream, self._transport.buffer_size)
+        self._transport.reader = _FastReader(
+            parent,
+            dis,
+            buffer,
+            self._transport._fast_listeners,
+            self._transport.reuse_messages
+        )
+        return self._transport.reader
+
+class FastTransport(Connection):
+    """
+    An IbPy connection (see *ib.opt.ibConnection*) whose reader decodes the
+    hot message types (*FAST_MESSAGE_TYPES*) itself. Use it as the
+    *transport* of an *IBConnection*, or pass *fast_decoder=True* to it.
+
+    The tick messages handed to the listeners are reused from one tick to
+    the next (unless *reuse_messages* is *False*): listeners must read
+    what they need from them before returning, rather than keep them.
+    """
+
+    def __init__(self, host='localhost', port=7496, clientId=0,
+        reuse_messages=True, buffer_size=1 << 16):
+        dispatcher = Dispatcher()
+        Connection.__init__(
+            self,
+            host,
+            port,
+            clientId,
+            Receiver(dispatcher),
+            Sender(dispatcher),
+            dispatcher
+        )
+        self.reuse_messages = reuse_messages
+        self.buffer_size = buffer_size
+        # message type -> listeners of the types we decode
+        self._fast_listeners = {}
+        self.reader = None
+
+    def connect(self):
+        return self.sender.connect(
+            self.host,
+            self.port,
+            self.clientId,
+            self.receiver,
+            lambda wrapper: _FastClientSocket(wrapper, self)
+        )
+
+    def register(self, listener, *types):
+        # like IbPy, listeners are registered for message classes: a type
+        # name on its own is handed to IbPy's dispatcher, which ignores it
+        others = []
+        for t in types:
+            name = getattr(t, 'typeName', None)
+            if name in FAST_MESSAGE_TYPES:
+                listeners = self._fast_listeners.get(name, ())
+                if listener not in listeners:
+                    # copy on write, the reader iterates without a lock
+                    self._fast_listeners[name] = listeners + (listener,)
+            else:
+                others.append(t)
+        return self.dispatcher.register(listener, *others)
+
+    def registerAll(self, listener):
+        self.register(
+            listener,
+            *[getattr(message, t) for t in FAST_MESSAGE_TYPES]
+        )
+        return self.dispatcher.registerAll(listener)
+
+    def unregister(self, listener, *types):
+        others = []
+        for t in types:
+            name = getattr(t, 'typeName', None)
+            if name in FAST_MESSAGE_TYPES:
+                self._fast_listeners[name] = tuple(
+                    l for l in self._fast_listeners.get(name, ())
+                    if l != listener
+                )
+            else:
+                others.append(t)
+        return self.dispatcher.unregister(listener, *others)
+
+    def unregisterAll(self, listener):
+        self.unregister(
+            listener,
+            *[getattr(message, t) for t in FAST_MESSAGE_TYPES]
+        )
+        return self.dispatcher.unregisterAll(listener)
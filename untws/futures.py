@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# futures.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Futures curves: the listed contracts of a futures, and which of them is
+the front month on a given day.
+"""
+
+from datetime import date, timedelta
+from time import time
+from untws.instrument import parse_expiry
+
+__all__ = ['FuturesCurve', 'curve_key', 'FUTURES_CURVE_TTL']
+
+# the number of seconds a curve is cached for: contracts are only listed
+# once in a while
+FUTURES_CURVE_TTL = 24 * 3600
+
+def curve_key(symbol, exchange, currency, trading_class=None):
+    """The key under which the curve of a futures is cached"""
+    return (symbol, exchange, currency, trading_class or '')
+
+def _month(expiry):
+    """The 'YYYYMM' contract month of *expiry* ('YYYYMM[DD]' or a *date*)"""
+    if hasattr(expiry, 'strftime'):
+        return expiry.strftime('%Y%m')
+    return expiry[:6]
+
+class FuturesCurve(object):
+    """
+    The contracts of a futures which are listed, ordered by expiry, as
+    returned by a single *reqContractDetails* request. *contracts*,
+    *months* ('YYYYMM' contract months) and *expiries* (*date* objects of
+    the last trading days) are parallel lists.
+    """
+
+    def __init__(self, symbol, details):
+        self.symbol = symbol
+        details = sorted(details, key=lambda d: d.m_summary.m_expiry)
+        self.contracts = [d.m_summary for d in details]
+        # the contract month may differ from the month of the last trading
+        # day (e.g. crude oil expires the month before)
+        self.months = [
+            d.m_contractMonth or d.m_summary.m_expiry[:6] for d in details
+        ]
+        self.expiries = [parse_expiry(c.m_expiry[:8]) for c in self.contracts]
+        # when the curve was looked up
+        self.resolved = time()
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def __iter__(self):
+        return iter(self.contracts)
+
+    def __getitem__(self, index):
+        return self.contracts[index]
+
+    def contract(self, month):
+        """
+        The contract of the contract month *month* ('YYYYMM', or a
+        'YYYYMMDD' string or *date* in that month)
+        """
+        month = _month(month)
+        for m, contract in zip(self.months, self.contracts):
+            if m == month:
+                return contract
+        raise KeyError(
+            "%s has no contract for month %s" % (self.symbol, month)
+        )
+
+    def front(self, on=None, roll_days=0):
+        """
+        The front month contract on the day *on* (today if *None*): the
+        first one whose last trading day is more than *roll_days* days
+        later, so that positions are rolled *roll_days* days before expiry.
+        This is how a continuous contract is mapped to a listed one.
+        """
+        return self.contracts[self._front_index(on, roll_days)]
+
+    def next_month(self, on=None, roll_days=0):
+        """The contract after the front month (see *front*)"""
+        index = self._front_index(on, roll_days) + 1
+        if index >= len(self.contracts):
+            raise IndexError("%s has no second month listed" % self.symbol)
+        return self.contracts[index]
+
+    def _front_index(self, on, roll_days):
+        if on is None:
+            on = date.today()
+        cutoff = on + timedelta(days=roll_days)
+        for index, expiry in enumerate(self.expiries):
+            if expiry > cutoff:
+                return index
+        raise IndexError(
+            "%s has no contract listed after %s" % (self.symbol, cutoff)
+        )
+
+    def __repr__(self):
+        return "<FuturesCurve(%s, %s)>" % (self.symbol, ', '.join(self.months))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# historical.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Helpers for historical data requests: splitting long ranges into requests
+TWS accepts, stitching the bars back into NumPy columns, and a local cache
+of the bars already downloaded.
+"""
+
+import calendar
+import sqlite3
+from datetime import datetime
+from threading import Lock
+import numpy as np
+
+__all__ = ['BAR_SIZES', 'BarCache', 'split_range', 'duration_string']
+
+# bar size -> (bar length, longest range TWS accepts in one request), both
+# in seconds
+BAR_SIZES = {
+    '1 secs': (1, 1800),
+    '5 secs': (5, 3600),
+    '10 secs': (10, 14400),
+    '15 secs': (15, 14400),
+    '30 secs': (30, 28800),
+    '1 min': (60, 86400),
+    '2 mins': (120, 2 * 86400),
+    '3 mins': (180, 7 * 86400),
+    '5 mins': (300, 7 * 86400),
+    '15 mins': (900, 14 * 86400),
+    '30 mins': (1800, 30 * 86400),
+    '1 hour': (3600, 30 * 86400),
+    '1 day': (86400, 365 * 86400)
+}
+
+# the columns of a bar, in the order they are stored
+COLUMNS = ('time', 'open', 'high', 'low', 'close', 'volume', 'count', 'wap')
+
+def to_timestamp(value):
+    """Converts a (naive, UTC) *datetime* to seconds since the epoch"""
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+def end_date_time(timestamp):
+    """Formats a timestamp as a *reqHistoricalData* end date"""
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d %H:%M:%S GMT')
+
+def duration_string(seconds):
+    """Formats a range length as a *reqHistoricalData* duration"""
+    if seconds <= 86400:
+        return '%d S' % seconds
+    return '%d D' % -(-seconds // 86400)
+
+def split_range(start, end, bar_size):
+    """
+    Splits [*start*, *end*) (in seconds since the epoch) into the list of
+    (start, end) ranges which each fit in one request for *bar_size* bars.
+    """
+    if bar_size not in BAR_SIZES:
+        raise ValueError("Unsupported bar size: %s" % bar_size)
+    step = BAR_SIZES[bar_size][1]
+    chunks = []
+    chunk_end = end
+    while chunk_end > start:
+        chunks.append((max(start, chunk_end - step), chunk_end))
+        chunk_end -= step
+    chunks.reverse()
+    return chunks
+
+def parse_bar_time(date):
+    """
+    Converts the date of a *historicalData* message (seconds since the epoch
+    for intraday bars, 'YYYYMMDD' for daily bars) to seconds since the epoch.
+    """
+    if len(date) == 8:
+        return calendar.timegm(datetime.strptime(date, '%Y%m%d').timetuple())
+    return int(date)
+
+def bar_row(msg):
+    """Converts a *historicalData* message to a tuple of COLUMNS"""
+    return (
+        parse_bar_time(msg.date),
+        msg.open,
+        msg.high,
+        msg.low,
+        msg.close,
+        msg.volume,
+        msg.count,
+        msg.WAP
+    )
+
+def to_columns(rows):
+    """
+    Converts bar tuples to a dictionary of NumPy arrays, one per column,
+    sorted by time and without duplicate bars. The 'time' column holds
+    *datetime64[s]* values.
+    """
+    if rows:
+        data = np.array(rows, dtype=np.float64)
+    else:
+        data = np.empty((0, len(COLUMNS)), dtype=np.float64)
+    times, first = np.unique(data[:, 0], return_index=True)
+    data = data[first]
+    columns = dict(
+        (name, data[:, i]) for i, name in enumerate(COLUMNS) if i > 0
+    )
+    columns['time'] = times.astype('int64').astype('datetime64[s]')
+    columns['volume'] = columns['volume'].astype('int64')
+    columns['count'] = columns['count'].astype('int64')
+    return columns
+
+def missing_ranges(start, end, covered):
+    """
+    Returns the parts of [*start*, *end*) which are not in the *covered*
+    (start, end) ranges.
+    """
+    gaps = []
+    position = start
+    for covered_start, covered_end in sorted(covered):
+        if covered_end <= position:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > position:
+            gaps.append((position, covered_start))
+        position = max(position, covered_end)
+    if position < end:
+        gaps.append((position, end))
+    return gaps
+
+class BarCache(object):
+    """
+    Historical bars already downloaded, along with the time ranges they
+    cover, stored in the SQLite database *path* (in memory only if it is
+    *None*). Series are identified by a key such as
+    (conId, bar size, what to show, regular trading hours only).
+    """
+
+    def __init__(self, path=None):
+        self._lock = Lock()
+        self._db = sqlite3.connect(
+            ':memory:' if path is None else path,
+            check_same_thread=False
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS bars ('
+            'series TEXT, time INTEGER, open REAL, high REAL, low REAL, '
+            'close REAL, volume INTEGER, count INTEGER, wap REAL, '
+            'PRIMARY KEY (series, time))'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS ranges ('
+            'series TEXT, start INTEGER, end INTEGER)'
+        )
+        self._db.commit()
+
+    def missing(self, series, start, end):
+        """Returns the parts of [*start*, *end*) not in the cache"""
+        with self._lock:
+            covered = self._db.execute(
+                'SELECT start, end FROM ranges '
+                'WHERE series = ? AND end > ? AND start < ?',
+                (repr(series), start, end)
+            ).fetchall()
+        return missing_ranges(start, end, covered)
+
+    def store(self, series, start, end, rows):
+        """Stores the bars *rows*, covering [*start*, *end*)"""
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(repr(series),) + tuple(row) for row in rows]
+            )
+            self._db.execute(
+                'INSERT INTO ranges VALUES (?, ?, ?)',
+                (repr(series), start, end)
+            )
+            self._db.commit()
+
+    def load(self, series, start, end):
+        """Returns the cached bars of [*start*, *end*), as tuples"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT time, open, high, low, close, volume, count, wap '
+                'FROM bars WHERE series = ? AND time >= ? AND time < ? '
+                'ORDER BY time',
+                (repr(series), start, end)
+            ).fetchall()
+
+    def close(self):
+        """Closes the database"""
+        self._db.close()
@@ -7,10 +7,123 @@
 # Copyright (c) 2013 Maan Bsat. All rights reserved.
 
 from datetime import datetime, date
+from threading import Lock
+from weakref import WeakSet, WeakValueDictionary
 
 __all__ = ['create_instrument', 'Instrument', 'Stock', 'StockOption']
 
+# roughly how many recently used instruments are kept alive between position
+# loads
+INSTRUMENT_CACHE_SIZE = 10000
+
+# (id of the connection, conId) -> Instrument, so that positions in the same
+# contract share one instrument object. The instrument keeps its connection
+# alive, so the id cannot be reused while the entry exists.
+_interned = WeakValueDictionary()
+
+class _LRUCache(object):
+    """
+    A mapping holding on to roughly the *size* most recently used values.
+
+    Entries live in two generations: hits in the old one are promoted to the
+    current one, and once the current generation holds *size* entries it
+    becomes the old one, dropping whatever was not used since. Hits in the
+    current generation are a plain dictionary lookup.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = Lock()
+        self._current = {}
+        self._old = {}
+
+    def get(self, key):
+        value = self._current.get(key)
+        if value is None:
+            value = self._old.get(key)
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._current[key] = value
+            if len(self._current) >= self.size:
+                self._old, self._current = self._current, {}
+
+    def clear(self):
+        with self._lock:
+            self._current, self._old = {}, {}
+
+# the caches of recently used instruments of every connection (see
+# _recent), so that they can all be cleared
+_recent_caches = WeakSet()
+
+def _recent(connection):
+    """
+    The instruments *connection* built last, so that loading the same
+    positions again does not rebuild them once the previous positions have
+    been released. The cache belongs to the connection: instruments keep
+    their connection alive, so a global one would keep every connection
+    ever used alive too. *None* if the connection cannot hold one.
+    """
+    if not hasattr(connection, '__dict__'):
+        # e.g. no connection at all
+        return None
+    recent = connection.__dict__.get('_recent_instruments')
+    if recent is None:
+        recent = _LRUCache(INSTRUMENT_CACHE_SIZE)
+        connection._recent_instruments = recent
+        _recent_caches.add(recent)
+    return recent
+
+# expiry string -> date; a book only holds a few hundred distinct expiries
+_expiries = {}
+
+def parse_expiry(expiry):
+    """Converts an IB expiry ('YYYYMMDD') to a *date*"""
+    try:
+        return _expiries[expiry]
+    except KeyError:
+        pass
+    if len(expiry) == 8 and expiry.isdigit():
+        parsed = date(int(expiry[:4]), int(expiry[4:6]), int(expiry[6:]))
+    else:
+        # anything unusual gets strptime's validation and error message
+        parsed = datetime.strptime(expiry, '%Y%m%d').date()
+    if len(_expiries) < INSTRUMENT_CACHE_SIZE:
+        _expiries[expiry] = parsed
+    return parsed
+
 def create_instrument(connection, instrument):
+    if instrument.m_conId:
+        recent = _recent(connection)
+        if recent is not None:
+            interned = recent.get(instrument.m_conId)
+            if interned is not None:
+                return interned
+        key = (id(connection), instrument.m_conId)
+        interned = _interned.get(key)
+        if interned is None:
+            interned = _interned.setdefault(
+                key,
+                _create_instrument(connection, instrument)
+            )
+        if recent is not None:
+            recent.put(instrument.m_conId, interned)
+        return interned
+    return _create_instrument(connection, instrument)
+
+def clear_instrument_cache():
+    """Forgets the recently used instruments (e.g. after contract changes)"""
+    for recent in list(_recent_caches):
+        recent.clear()
+
+def _create_instrument(connection, instrument):
+    cache = getattr(connection, 'contract_cache', None)
+    if cache is not None and instrument.m_conId:
+        # prefer the fully populated contract, if we have it
+        instrument = cache.get(instrument.m_conId) or instrument
     if instrument.m_secType == 'STK':
         return Stock(connection, instrument)
     elif instrument.m_secType == 'OPT':
@@ -27,6 +140,11 @@ def create_instrument(connection, instrument):
 
 class Instrument(object):
     """Represents an (abstract) instrument"""
+
+    __slots__ = (
+        '_connection', '_ticker', '_conid', '_currency', '_exchange',
+        '__weakref__'
+    )
     
     def __init__(self, connection, instrument):
         self._connection = connection
@@ -65,12 +183,19 @@ class Instrument(object):
         
 class Stock(Instrument):
     """Represents a stock (IB sectype: STK)"""
+
+    __slots__ = ()
     
     def __init__(self, connection, instrument):
         super(Stock, self).__init__(connection, instrument)
 
 class StockOption(Instrument):
     """Represents a stock option (IB sectype: OPT)"""
+
+    __slots__ = (
+        '_underlying', '_contract_size', '_option_type', '_strike_price',
+        '_expiration_date'
+    )
     
     def __init__(self, connection, instrument):
         super(StockOption, self).__init__(connection, instrument)
@@ -78,10 +203,7 @@ class StockOption(Instrument):
         self._contract_size = instrument.m_multiplier
         self._option_type = 'call' if instrument.m_right == 'C' else 'put'
         self._strike_price = instrument.m_strike
-        self._expiration_date = datetime.strptime(
-            instrument.m_expiry,
-            '%Y%m%d'
-        ).date()
+        self._expiration_date = parse_expiry(instrument.m_expiry)
     
     @property
     def underlying(self):
@@ -110,15 +232,14 @@ class StockOption(Instrument):
 
 class Futures(Instrument):
     """Represents a futures (IB sectype: FUT)"""
+
+    __slots__ = ('_underlying', '_point_value', '_expiration_date')
     
     def __init__(self, connection, instrument):
         super(Futures, self).__init__(connection, instrument)
         self._underlying = instrument.m_symbol
         self._point_value = instrument.m_multiplier
-        self._expiration_date = datetime.strptime(
-            instrument.m_expiry,
-            '%Y%m%d'
-        ).date()
+        self._expiration_date = parse_expiry(instrument.m_expiry)
     
     @property
     def underlying(self):
@@ -130,11 +251,6 @@ class Futures(Instrument):
         """The point value (i.e. multiplier)"""
         return self._point_value
 
-    @property
-    def option_type(self):
-        """The futures' type ('call' or 'put')"""
-        return self._option_type
-        
     @property
     def expiration_date(self):
         """The futures expiration date"""
@@ -142,17 +258,20 @@ class Futures(Instrument):
 
 class FuturesOption(Instrument):
     """Represents a futures option (IB sectype: FOP)"""
+
+    __slots__ = (
+        '_underlying', '_point_value', '_contract_size', '_option_type',
+        '_strike_price', '_expiration_date'
+    )
     
     def __init__(self, connection, instrument):
         super(FuturesOption, self).__init__(connection, instrument)
         self._underlying = instrument.m_symbol
         self._point_value = instrument.m_multiplier
+        self._contract_size = instrument.m_multiplier
         self._option_type = 'call' if instrument.m_right == 'C' else 'put'
         self._strike_price = instrument.m_strike
-        self._expiration_date = datetime.strptime(
-            instrument.m_expiry,
-            '%Y%m%d'
-        ).date()
+        self._expiration_date = parse_expiry(instrument.m_expiry)
     
     @property
     def underlying(self):
@@ -7,7 +7,8 @@
 # Copyright (c) 2013 Maan Bsat. All rights reserved.
 
 __all__ = [
-    'MarketDataQuoteBase', 'MarketDataQuoteInstrument', 'OptionDataQuote'
+    'MarketDataQuoteBase', 'MarketDataQuoteInstrument', 'OptionDataQuote',
+    'LiveQuote'
 ]
 
 class MarketDataQuoteBase(object):
@@ -44,6 +45,43 @@ class MarketDataQuoteInstrument(MarketDataQuoteBase):
         """The instrument object"""
         return self._instrument
 
+class LiveQuote(MarketDataQuoteInstrument):
+    """
+    A market data quote which is kept up to date by a streaming subscription
+    (see *IBConnection.subscribe*). Fields are updated in place as ticks
+    arrive, so reading them does not involve TWS.
+    """
+
+    def __init__(self, instrument, ticker_id, fields=None):
+        super(LiveQuote, self).__init__(instrument, {})
+        self._ticker_id = ticker_id
+        # the FieldMap the ticks are decoded with
+        self.fields = fields
+        self._options = {}
+        self._error = None
+        self._listeners = ()
+
+    @property
+    def ticker_id(self):
+        """The ticker id of the subscription"""
+        return self._ticker_id
+
+    @property
+    def error(self):
+        """The last error TWS reported for the subscription, if any"""
+        return self._error
+
+    def add_listener(self, listener):
+        """
+        Calls *listener(quote, msg)* (from the IbPy reader thread) after each
+        tick applied to the quote.
+        """
+        self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """Stops calling *listener*"""
+        self._listeners = tuple(l for l in self._listeners if l != listener)
+
 class OptionDataQuote(MarketDataQuoteBase):
     def __init__(self, data_points):
         super(OptionDataQuote, self).__init__(data_points)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# market_depth.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Market depth (level 2) order books, backed by NumPy arrays.
+"""
+
+from time import sleep
+import numpy as np
+
+__all__ = ['DepthBook', 'DepthSnapshot', 'SIDES']
+
+# side name -> the side number TWS uses in depth messages
+SIDES = {'ask': 0, 'bid': 1}
+
+# depth operations
+_INSERT, _UPDATE, _DELETE = 0, 1, 2
+
+class DepthSnapshot(object):
+    """
+    A copy of a *DepthBook* at *version*. *bids* and *asks* are (levels, 2)
+    arrays of prices and sizes, best level first.
+    """
+
+    def __init__(self, version, bids, asks):
+        self.version = version
+        self.bids = bids
+        self.asks = asks
+
+    def __repr__(self):
+        return "<DepthSnapshot(version %d, %d bids, %d asks)>" % (
+            self.version, len(self.bids), len(self.asks)
+        )
+
+class DepthBook(object):
+    """
+    The order book of an instrument, up to *rows* levels deep on each side,
+    kept up to date by a market depth subscription (see
+    *IBConnection.subscribe_depth*).
+
+    Levels are stored in preallocated arrays, along with the cumulative size
+    and notional from the best level down, so the best levels, the size
+    available down to a level and the VWAP to fill a size are read without
+    walking the book. *side* arguments are 'bid' or 'ask'.
+
+    The book is updated from the IbPy reader thread. Each update increments
+    *version* twice, and it is odd while an update is in progress: *read*
+    uses it to run a function on a consistent book, and *snapshot* to copy
+    it, without locking out the updates.
+    """
+
+    def __init__(self, instrument, ticker_id, rows=10):
+        self.instrument = instrument
+        self._ticker_id = ticker_id
+        self.rows = rows
+        # [side, level], with the sides as TWS numbers them
+        self._prices = np.full((2, rows), np.nan)
+        self._sizes = np.zeros((2, rows), dtype=np.int64)
+        self._cum_sizes = np.zeros((2, rows), dtype=np.int64)
+        self._cum_notional = np.zeros((2, rows))
+        self._makers = np.empty((2, rows), dtype=object)
+        # the number of levels filled on each side
+        self._levels = [0, 0]
+        self.version = 0
+        self._error = None
+        self._listeners = ()
+
+    @property
+    def ticker_id(self):
+        """The ticker id of the subscription"""
+        return self._ticker_id
+
+    @property
+    def error(self):
+        """The last error TWS reported for the subscription, if any"""
+        return self._error
+
+    def add_listener(self, listener):
+        """
+        Calls *listener(book, msg)* (from the IbPy reader thread) after each
+        update applied to the book.
+        """
+        self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """Stops calling *listener*"""
+        self._listeners = tuple(l for l in self._listeners if l != listener)
+
+    def update(self, position, operation, side, price, size,
+        market_maker=None):
+        """
+        Applies an *updateMktDepth* or *updateMktDepthL2* operation (insert,
+        update or delete the level at *position* of *side*, which are TWS
+        numbers). Levels deeper than *rows* are ignored.
+        """
+        if not 0 <= position < self.rows or side not in (0, 1):
+            return
+        prices = self._prices[side]
+        sizes = self._sizes[side]
+        makers = self._makers[side]
+        levels = self._levels[side]
+        self.version += 1
+        try:
+            if operation == _INSERT:
+                # shift the deeper levels down, dropping the last one
+                prices[position + 1:] = prices[position:-1]
+                sizes[position + 1:] = sizes[position:-1]
+                makers[position + 1:] = makers[position:-1]
+                levels = min(max(levels + 1, position + 1), self.rows)
+            elif operation == _DELETE:
+                prices[position:-1] = prices[position + 1:]
+                sizes[position:-1] = sizes[position + 1:]
+                makers[position:-1] = makers[position + 1:]
+                prices[-1] = np.nan
+                sizes[-1] = 0
+                makers[-1] = None
+                if position < levels:
+                    levels -= 1
+            else:
+                levels = max(levels, position + 1)
+            if operation != _DELETE:
+                prices[position] = price
+                sizes[position] = size
+                makers[position] = market_maker
+            self._levels[side] = levels
+            self._accumulate(side, position, levels)
+        finally:
+            self.version += 1
+
+    def _accumulate(self, side, start, end):
+        """Recomputes the running totals of *side* from level *start*"""
+        if start >= end:
+            return
+        cum_sizes = self._cum_sizes[side]
+        cum_notional = self._cum_notional[side]
+        np.cumsum(self._sizes[side, start:end], out=cum_sizes[start:end])
+        np.cumsum(
+            self._prices[side, start:end] * self._sizes[side, start:end],
+            out=cum_notional[start:end]
+        )
+        if start > 0:
+            cum_sizes[start:end] += cum_sizes[start - 1]
+            cum_notional[start:end] += cum_notional[start - 1]
+
+    def clear(self):
+        """Empties the book, e.g. before TWS sends it again"""
+        self.version += 1
+        try:
+            self._prices.fill(np.nan)
+            self._sizes.fill(0)
+            self._cum_sizes.fill(0)
+            self._cum_notional.fill(0)
+            self._makers.fill(None)
+            self._levels = [0, 0]
+        finally:
+            self.version += 1
+
+    def read(self, func):
+        """
+        Returns *func(book)*, computed on a consistent book: it is computed
+        again if the book was updated meanwhile. *func* should be quick, and
+        must not keep references to the arrays of the book.
+        """
+        while True:
+            version = self.version
+            if not version & 1:
+                result = func(self)
+                if self.version == version:
+                    return result
+            # let the reader thread finish its update
+            sleep(0)
+
+    def snapshot(self):
+        """A consistent copy of the book, as a *DepthSnapshot*"""
+        def copy(book):
+            bids, asks = book.levels('bid'), book.levels('ask')
+            return DepthSnapshot(book.version, bids, asks)
+        return self.read(copy)
+
+    def depth(self, side):
+        """The number of levels of *side* in the book"""
+        return self._levels[SIDES[side]]
+
+    def levels(self, side):
+        """A copy of the levels of *side*, as a (levels, 2) array"""
+        s = SIDES[side]
+        n = self._levels[s]
+        return np.column_stack((self._prices[s, :n], self._sizes[s, :n]))
+
+    def level(self, side, position=0):
+        """
+        The (price, size, market maker) of a level of *side*, *None* if the
+        book is not that deep
+        """
+        s = SIDES[side]
+        if position >= self._levels[s]:
+            return None
+        return (
+            float(self._prices[s, position]),
+            int(self._sizes[s, position]),
+            self._makers[s, position]
+        )
+
+    @property
+    def best_bid(self):
+        """The (price, size, market maker) of the best bid, or *None*"""
+        return self.level('bid')
+
+    @property
+    def best_ask(self):
+        """The (price, size, market maker) of the best ask, or *None*"""
+        return self.level('ask')
+
+    @property
+    def mid(self):
+        """The mid point of the best bid and ask (*nan* if either is missing)"""
+        if not (self._levels[0] and self._levels[1]):
+            return np.nan
+        return (self._prices[0, 0] + self._prices[1, 0]) / 2
+
+    @property
+    def spread(self):
+        """The best ask less the best bid (*nan* if either is missing)"""
+        if not (self._levels[0] and self._levels[1]):
+            return np.nan
+        return self._prices[0, 0] - self._prices[1, 0]
+
+    def cumulative_size(self, side, levels=None):
+        """
+        The total size of the first *levels* levels of *side* (all of them
+        if *None*)
+        """
+        s = SIDES[side]
+        n = self._levels[s] if levels is None else min(levels, self._levels[s])
+        if n <= 0:
+            return 0
+        return int(self._cum_sizes[s, n - 1])
+
+    def vwap(self, side, size):
+        """
+        The average price of filling *size* against *side* (e.g. 'ask' to
+        buy), walking down the book. *nan* if the book is not deep enough.
+        """
+        s = SIDES[side]
+        n = self._levels[s]
+        cum_sizes = self._cum_sizes[s, :n]
+        if size <= 0 or n == 0 or size > cum_sizes[-1]:
+            return np.nan
+        # the level at which *size* is reached
+        i = int(np.searchsorted(cum_sizes, size))
+        notional = size * self._prices[s, i]
+        if i > 0:
+            notional += self._cum_notional[s, i - 1] - \
+                cum_sizes[i - 1] * self._prices[s, i]
+        return notional / size
+
+    def __repr__(self):
+        return "<DepthBook(%s, %d bids, %d asks)>" % (
+            self.instrument.m_symbol,
+            self._levels[1],
+            self._levels[0]
+        )
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# metrics.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Instrumentation of the requests and messages of a connection.
+"""
+
+import json
+import logging
+from threading import Event, Lock, Thread
+from time import time
+
+__all__ = ['Metrics', 'LatencyHistogram', 'log_exporter', 'JsonLinesExporter']
+
+log = logging.getLogger(__name__)
+
+# values under 2 ** _SUB_BITS microseconds get a bucket each; above that,
+# every power of two is split into 2 ** (_SUB_BITS - 1) buckets, which keeps
+# the error under 3%
+_SUB_BITS = 6
+_SUB_COUNT = 1 << _SUB_BITS
+_HALF = _SUB_COUNT >> 1
+
+def _index(value):
+    """The bucket of *value* (in microseconds)"""
+    if value < _SUB_COUNT:
+        return value
+    shift = value.bit_length() - _SUB_BITS
+    return _SUB_COUNT + (shift - 1) * _HALF + (value >> shift) - _HALF
+
+def _highest(index):
+    """The highest value (in microseconds) in bucket *index*"""
+    if index < _SUB_COUNT:
+        return index
+    shift = (index - _SUB_COUNT) // _HALF + 1
+    top = (index - _SUB_COUNT) % _HALF + _HALF
+    return ((top + 1) << shift) - 1
+
+class LatencyHistogram(object):
+    """
+    A histogram of durations with logarithmic buckets (in the manner of HDR
+    histograms): recording is constant time and memory stays small, at the
+    cost of reporting percentiles within 3%.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # bucket -> number of values
+        self._buckets = {}
+
+    def record(self, seconds):
+        """Adds a duration, in seconds"""
+        index = _index(max(int(seconds * 1e6), 0))
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """The duration (in seconds) *percent* % of the values are under"""
+        if not self.count:
+            return 0.0
+        rank = max(percent / 100.0 * self.count, 1)
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                break
+        return min(_highest(index) / 1e6, self.max)
+
+    def summary(self):
+        """The count, mean, percentiles and maximum, in seconds"""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max
+        }
+
+class RequestTimer(object):
+    """
+    Times one request, through the scheduler *job* which sends it: how long
+    it was queued, how long TWS took to send the first message back, and
+    how long it took from there to complete it.
+    """
+
+    __slots__ = ('_metrics', 'kind', 'job', 'first_message')
+
+    enabled = True
+
+    def __init__(self, metrics, kind):
+        self._metrics = metrics
+        self.kind = kind
+        self.job = None
+        self.first_message = None
+
+    def message(self, msg=None):
+        """To be called (from the reader thread) for each message received"""
+        if self.first_message is None:
+            self.first_message = time()
+
+    def done(self):
+        """To be called once the request completed"""
+        self._metrics._record(self, time())
+
+    def failed(self):
+        """To be called if the request failed or timed out"""
+        self._metrics._fail(self.kind)
+
+class NullTimer(object):
+    """Stands in for a *RequestTimer* when there are no metrics"""
+
+    __slots__ = ('job',)
+
+    enabled = False
+
+    def __init__(self):
+        self.job = None
+
+    def message(self, msg=None):
+        pass
+
+    def done(self):
+        pass
+
+    def failed(self):
+        pass
+
+class Metrics(object):
+    """
+    Collects the instrumentation of an *IBConnection* (see its *metrics*
+    argument):
+
+    - per request type, latency histograms of the time spent queued in the
+      request scheduler ('queued'), waiting for the first message from TWS
+      ('first_message'), from there to completion ('completion'), and end
+      to end ('total'), along with the number of failures;
+    - the number of messages received per type, those nobody was waiting
+      for ('dropped'), and the ticks of fields we do not know of
+      ('unknown_fields');
+    - gauges, such as the depth of the request queue.
+
+    *snapshot* returns all of it as a dictionary. Exporters added with
+    *add_exporter* are handed a snapshot every *interval* seconds once
+    *start* is called.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (request type, phase) -> LatencyHistogram
+        self._histograms = {}
+        self._failures = {}
+        # counters, only updated from the IbPy reader thread
+        self.messages = {}
+        self.dropped = {}
+        self.unknown_fields = {}
+        # message type -> the fields we know of, for messages with a field
+        self.known_fields = {}
+        # name -> function returning the gauge's value
+        self._gauges = {}
+        self._exporters = []
+        self._stopped = Event()
+        self._thread = None
+
+    def timer(self, kind):
+        """Starts timing a request of type *kind*"""
+        return RequestTimer(self, kind)
+
+    def _histogram(self, kind, phase):
+        histogram = self._histograms.get((kind, phase))
+        if histogram is None:
+            histogram = self._histograms.setdefault(
+                (kind, phase),
+                LatencyHistogram()
+            )
+        return histogram
+
+    def _record(self, timer, now):
+        job = timer.job
+        with self._lock:
+            if job is None or not job.sent:
+                # nothing was sent to TWS
+                return
+            self._histogram(timer.kind, 'queued').record(
+                job.sent - job.submitted
+            )
+            if timer.first_message is not None:
+                self._histogram(timer.kind, 'first_message').record(
+                    timer.first_message - job.sent
+                )
+                self._histogram(timer.kind, 'completion').record(
+                    now - timer.first_message
+                )
+            self._histogram(timer.kind, 'total').record(now - job.submitted)
+
+    def _fail(self, kind):
+        with self._lock:
+            self._failures[kind] = self._failures.get(kind, 0) + 1
+
+    def count(self, msg, routed):
+        """
+        Counts a message received; *routed* is *False* if nobody was
+        waiting for it.
+        """
+        name = msg.typeName
+        self.messages[name] = self.messages.get(name, 0) + 1
+        if not routed:
+            self.dropped[name] = self.dropped.get(name, 0) + 1
+        fields = self.known_fields.get(name)
+        if fields is None:
+            return
+        # tickGeneric and tickString call it the tick type
+        field = getattr(msg, 'field', None)
+        if field is None:
+            field = msg.tickType
+        if field not in fields:
+            key = '%s.%s' % (name, field)
+            self.unknown_fields[key] = self.unknown_fields.get(key, 0) + 1
+
+    def add_gauge(self, name, function):
+        """Reports *function()* under *name* in the snapshots"""
+        self._gauges[name] = function
+
+    def snapshot(self):
+        """Returns all the metrics, as a dictionary"""
+        with self._lock:
+            requests = {}
+            for (kind, phase), histogram in self._histograms.items():
+                requests.setdefault(kind, {})[phase] = histogram.summary()
+            for kind, failures in self._failures.items():
+                requests.setdefault(kind, {})['failures'] = failures
+        return {
+            'time': time(),
+            'requests': requests,
+            'messages': dict(self.messages),
+            'dropped': dict(self.dropped),
+            'unknown_fields': dict(self.unknown_fields),
+            'gauges': dict(
+                (name, function()) for name, function in self._gauges.items()
+            )
+        }
+
+    def add_exporter(self, exporter):
+        """Hands the snapshots to *exporter(snapshot)*"""
+        self._exporters.append(exporter)
+
+    def export(self):
+        """Hands a snapshot to every exporter now"""
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            try:
+                exporter(snapshot)
+            except Exception:
+                log.exception("Exporting metrics to %s failed", exporter)
+
+    def start(self, interval=60):
+        """Exports the metrics every *interval* seconds, from a thread"""
+        def run():
+            while not self._stopped.wait(interval):
+                self.export()
+        self._stopped.clear()
+        self._thread = Thread(target=run, name='untws-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops exporting the metrics"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def log_exporter(snapshot):
+    """Logs the metrics as JSON"""
+    log.info("%s", json.dumps(snapshot, sort_keys=True))
+
+class JsonLinesExporter(object):
+    """Appends the metrics to the file *path*, one JSON object per line"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, snapshot):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(snapshot, sort_keys=True) + '\n')
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# option_chain.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Option chains, as strike x expiry surfaces of NumPy arrays.
+"""
+
+import numpy as np
+from untws.instrument import parse_expiry
+from untws.quote_batch import MISSING_INT
+
+__all__ = ['OptionChain', 'OptionSurface']
+
+def chain_key(contract):
+    """The (right, strike, expiry) of an option contract"""
+    return (contract.m_right, contract.m_strike, contract.m_expiry)
+
+class OptionSurface(object):
+    """
+    The options of one right (calls or puts) of an *OptionChain*, laid out
+    on its strike x expiry grid: each field is a NumPy array with one row
+    per strike (*chain.strikes*) and one column per expiry
+    (*chain.expiries*), *NaN* where there is no such option or no data
+    (*MISSING_INT* for the integer fields, such as sizes).
+
+    Option computations (*implied_vol*, *delta*, *gamma*, *vega*, *theta*)
+    are taken at the mid point of the bid and ask computations, for the
+    whole surface at once; use *greek* for another side.
+    """
+
+    def __init__(self, chain, right, rows, strike_index, expiry_index):
+        self._chain = chain
+        self.right = right
+        # the batch row of each option, and its position on the grid
+        self._rows = rows
+        self._cells = (strike_index, expiry_index)
+
+    @property
+    def shape(self):
+        return (len(self._chain.strikes), len(self._chain.expiries))
+
+    def _grid(self, column, fill=None):
+        if fill is None:
+            # NaN does not fit an integer column
+            fill = MISSING_INT if column.dtype.kind in 'iu' else np.nan
+        grid = np.full(self.shape, fill, dtype=column.dtype)
+        grid[self._cells] = column[self._rows]
+        return grid
+
+    @property
+    def conids(self):
+        """The conId of each option (0 where there is none)"""
+        return self._grid(self._chain.batch.index, 0)
+
+    @property
+    def available(self):
+        """*True* where there is an option which answered"""
+        return self._grid(self._chain.batch.answered, False)
+
+    def contract(self, strike, expiry):
+        """The contract of the option at *strike* and *expiry*, or *None*"""
+        return self._chain.contract(self.right, strike, expiry)
+
+    def column(self, field):
+        """The surface of a field (e.g. 'bid', or 'bid_size')"""
+        return self._grid(self._chain.batch.column(field))
+
+    @property
+    def bid(self):
+        return self.column('bid')
+
+    @property
+    def ask(self):
+        return self.column('ask')
+
+    @property
+    def last(self):
+        return self.column('last')
+
+    @property
+    def mid(self):
+        return self._grid(self._chain.batch.mid)
+
+    def greek(self, name, side='mid'):
+        """
+        The surface of an option computation field (one of
+        *quote_batch.GREEKS*), computed from the *side* price ('bid', 'ask',
+        'last', 'model' or 'mid').
+        """
+        return self._grid(self._chain.batch.greek(name, side))
+
+    @property
+    def implied_vol(self):
+        return self.greek('implied_vol')
+
+    @property
+    def delta(self):
+        return self.greek('delta')
+
+    @property
+    def gamma(self):
+        return self.greek('gamma')
+
+    @property
+    def vega(self):
+        return self.greek('vega')
+
+    @property
+    def theta(self):
+        return self.greek('theta')
+
+class OptionChain(object):
+    """
+    The options on an underlying, along with their market data.
+
+    *strikes* (a NumPy array) and *expiries* (a list of *date* objects) are
+    sorted, and give the rows and columns of the *calls* and *puts*
+    surfaces. *batch* is the *QuoteBatch* of the options, in the order of
+    *contracts*.
+
+    Use *IBConnection.get_option_chain* to create one.
+    """
+
+    def __init__(self, contracts, batch):
+        self.contracts = list(contracts)
+        self.batch = batch
+        expiry_strings = sorted(set(c.m_expiry for c in self.contracts))
+        self.expiries = [parse_expiry(e) for e in expiry_strings]
+        self.strikes = np.unique(
+            np.array([c.m_strike for c in self.contracts], dtype=np.float64)
+        )
+        strike_index = np.searchsorted(
+            self.strikes,
+            [c.m_strike for c in self.contracts]
+        )
+        expiry_columns = dict((e, i) for i, e in enumerate(expiry_strings))
+        expiry_index = np.array(
+            [expiry_columns[c.m_expiry] for c in self.contracts],
+            dtype=np.intp
+        )
+        rights = np.array([c.m_right for c in self.contracts])
+        # (right, strike, expiry) -> index in contracts
+        self._keys = dict(
+            (chain_key(c), i) for i, c in enumerate(self.contracts)
+        )
+        surfaces = []
+        for right in ('C', 'P'):
+            rows = np.flatnonzero(rights == right)
+            surfaces.append(OptionSurface(
+                self,
+                right,
+                rows,
+                strike_index[rows],
+                expiry_index[rows]
+            ))
+        self.calls, self.puts = surfaces
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def contract(self, right, strike, expiry):
+        """
+        The contract of the option of *right* ('C' or 'P') at *strike* and
+        *expiry* (a *date* or a 'YYYYMMDD' string), or *None*.
+        """
+        if hasattr(expiry, 'strftime'):
+            expiry = expiry.strftime('%Y%m%d')
+        index = self._keys.get((right, strike, expiry))
+        if index is None:
+            return None
+        return self.contracts[index]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# orders.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Tracking of the orders placed through a connection.
+"""
+
+from threading import Event, Lock
+from time import time
+from untws.dispatcher import is_warning
+
+__all__ = ['OrderHandle', 'FINAL_STATUSES']
+
+# order statuses after which nothing more happens to an order
+FINAL_STATUSES = ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+
+# order errors which are informational, and do not end the order (e.g.
+# "order will not be placed until the market opens")
+_ORDER_WARNINGS = (399,)
+
+# "order canceled": TWS confirming a cancellation, not an error
+_ORDER_CANCELLED = 202
+
+class OrderHandle(object):
+    """
+    An order placed with *IBConnection.place_order*. Its attributes are kept
+    up to date (from the IbPy reader thread) as TWS sends *orderStatus*,
+    *openOrder* and *execDetails* messages for it:
+
+    - *status* ('PendingSubmit' until TWS acknowledges the order), *filled*,
+      *remaining*, *avg_fill_price*, *last_fill_price* and *perm_id*;
+    - *order_state*, the last *OrderState* received;
+    - *executions*, the list of *Execution* objects of its fills;
+    - *error*, the error message which ended the order, if any.
+
+    *sent* and *acknowledged* are the times the order was sent to TWS and
+    first acknowledged by it.
+    """
+
+    def __init__(self, connection, order_id, instrument, order, timer):
+        self._connection = connection
+        self.order_id = order_id
+        self.instrument = instrument
+        self.order = order
+        self.status = 'PendingSubmit'
+        self.filled = 0
+        self.remaining = order.m_totalQuantity
+        self.avg_fill_price = 0.0
+        self.last_fill_price = 0.0
+        self.perm_id = None
+        self.order_state = None
+        self.executions = []
+        self.error = None
+        self.acknowledged = None
+        # the scheduler job sending the order
+        self.job = None
+        self._timer = timer
+        self._exec_ids = set()
+        self._listeners = []
+        self._lock = Lock()
+        self._done = Event()
+
+    @property
+    def connection(self):
+        """Returns the connection object"""
+        return self._connection
+
+    @property
+    def sent(self):
+        """The time the order was sent to TWS, or *None* if it is queued"""
+        if self.job is None or not self.job.sent:
+            return None
+        return self.job.sent
+
+    @property
+    def ack_latency(self):
+        """
+        The number of seconds TWS took to acknowledge the order, or *None*
+        if it did not yet.
+        """
+        if self.acknowledged is None or self.sent is None:
+            return None
+        return self.acknowledged - self.sent
+
+    @property
+    def done(self):
+        """*True* once the order is filled, cancelled or rejected"""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits up to *timeout* seconds (forever if *None*) for the order to
+        be done. Returns *done*.
+        """
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        """Cancels the order (see *IBConnection.cancel_order*)"""
+        self._connection.cancel_order(self)
+
+    def add_listener(self, listener):
+        """
+        Calls *listener(handle, msg)* (from the IbPy reader thread) after
+        each message received for the order.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Stops calling *listener*"""
+        self._listeners.remove(listener)
+
+    def _acknowledge(self):
+        if self.acknowledged is None:
+            self.acknowledged = time()
+            self._timer.message()
+            self._timer.done()
+
+    def _finish(self, status):
+        self.status = status
+        self._done.set()
+
+    def _process_message(self, msg):
+        name = msg.typeName
+        with self._lock:
+            if name == 'orderStatus':
+                self._acknowledge()
+                self.filled = msg.filled
+                self.remaining = msg.remaining
+                self.avg_fill_price = msg.avgFillPrice
+                self.last_fill_price = msg.lastFillPrice
+                self.perm_id = msg.permId
+                if msg.status in FINAL_STATUSES:
+                    self._finish(msg.status)
+                elif not self.done:
+                    self.status = msg.status
+            elif name == 'openOrder':
+                self._acknowledge()
+                self.order_state = msg.orderState
+            elif name == 'execDetails':
+                execution = msg.execution
+                # TWS may send the same execution again
+                if execution.m_execId in self._exec_ids:
+                    return
+                self._exec_ids.add(execution.m_execId)
+                self.executions.append(execution)
+            elif name == 'error':
+                if is_warning(msg) or msg.errorCode in _ORDER_WARNINGS:
+                    return
+                if msg.errorCode == _ORDER_CANCELLED:
+                    # TWS did handle the order
+                    self._acknowledge()
+                    if not self.done:
+                        self._finish('Cancelled')
+                else:
+                    self.error = msg
+                    # an order acknowledged already was timed as done
+                    if self.acknowledged is None:
+                        self._timer.failed()
+                    if not self.done:
+                        self._finish('Inactive')
+        for listener in self._listeners:
+            listener(self, msg)
+
+    def _withdrawn(self):
+        """The order was cancelled before it was sent"""
+        with self._lock:
+            self._finish('Cancelled')
+
+    def __repr__(self):
+        return '<OrderHandle %d %s %s/%s>' % (
+            self.order_id,
+            self.status,
+            self.filled,
+            self.order.m_totalQuantity
+        )
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# pool.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+A pool of warm connections to IB TWS.
+"""
+
+import logging
+from contextlib import contextmanager
+from threading import Condition
+from time import time, sleep
+from untws.connection import IBConnection
+
+__all__ = ['IBConnectionPool']
+
+log = logging.getLogger(__name__)
+
+class IBConnectionPool(object):
+    """
+    Hands out up to *size* connections to TWS, which are connected on first
+    use and then kept open for reuse.
+
+    Client ids are deterministic: connection *n* of the pool uses
+    *client_id_base + worker_index \\* size + n*. Giving each worker process
+    its own *worker_index* guarantees their client ids never collide.
+
+    A connection which was idle for more than *health_check_interval*
+    seconds, or whose last user hit an error, is checked with
+    *get_current_time* before being handed out again. Broken connections
+    are reconnected, waiting *initial_backoff* seconds after the first
+    failure and doubling the wait after each further one (up to
+    *max_backoff*), for at most *max_attempts* attempts.
+
+    Other keyword arguments are passed on to *IBConnection*.
+    """
+
+    def __init__(self, host, port, size=4, client_id_base=1000,
+        worker_index=0, health_check_interval=30, health_check_timeout=5,
+        initial_backoff=0.5, max_backoff=30, max_attempts=5, **kwargs):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.client_id_base = client_id_base
+        self.worker_index = worker_index
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._connection_args = kwargs
+        self._condition = Condition()
+        # free slots (whose connection is not created yet), and idle
+        # connections as (connection, last released, healthy)
+        self._free_slots = list(range(size - 1, -1, -1))
+        self._idle = []
+        self._connections = []
+        self._closed = False
+
+    def client_id(self, slot):
+        """The client id used by connection number *slot* of the pool"""
+        return self.client_id_base + self.worker_index * self.size + slot
+
+    def _connect(self, slot):
+        """Creates the connection for *slot*, retrying with backoff"""
+        backoff = self.initial_backoff
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            try:
+                connection = IBConnection(
+                    self.host,
+                    self.port,
+                    client_id=self.client_id(slot),
+                    **self._connection_args
+                )
+            except Exception:
+                log.exception(
+                    "Connecting client %d failed",
+                    self.client_id(slot)
+                )
+                continue
+            if connection.is_connected():
+                return connection
+            connection.disconnect()
+        raise Exception(
+            "Could not connect client %d to %s:%s" % \
+            (self.client_id(slot), self.host, self.port)
+        )
+
+    def _is_healthy(self, connection):
+        """Checks that *connection* is up and answering requests"""
+        if not connection.is_connected():
+            return False
+        try:
+            connection.get_current_time(timeout=self.health_check_timeout)
+        except Exception:
+            return False
+        return True
+
+    def _repair(self, connection):
+        """Reconnects a broken connection, retrying with backoff"""
+        backoff = self.initial_backoff
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            try:
+                if connection.reconnect() and self._is_healthy(connection):
+                    return
+            except Exception:
+                log.exception(
+                    "Reconnecting client %d failed",
+                    connection.client_id
+                )
+        raise Exception(
+            "Could not reconnect client %d to %s:%s" % \
+            (connection.client_id, self.host, self.port)
+        )
+
+    def acquire(self, timeout=None):
+        """
+        Returns a connection from the pool, waiting up to *timeout* seconds
+        (forever if *None*) for one to become available. It must be given
+        back with *release*.
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise Exception("The connection pool is closed")
+                if self._idle or self._free_slots:
+                    break
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("No connection available in the pool")
+                self._condition.wait(remaining)
+            if self._idle:
+                connection, released, healthy = self._idle.pop()
+                slot = None
+            else:
+                slot = self._free_slots.pop()
+        if slot is not None:
+            try:
+                connection = self._connect(slot)
+            except Exception:
+                self._give_back_slot(slot)
+                raise
+            with self._condition:
+                self._connections.append(connection)
+            return connection
+        try:
+            if not healthy or \
+                    time() - released > self.health_check_interval:
+                if not self._is_healthy(connection):
+                    self._repair(connection)
+        except Exception:
+            self.release(connection, healthy=False)
+            raise
+        return connection
+
+    def _give_back_slot(self, slot):
+        with self._condition:
+            self._free_slots.append(slot)
+            self._condition.notify()
+
+    def release(self, connection, healthy=True):
+        """
+        Gives a connection back to the pool. Pass *healthy=False* if using it
+        failed, so that it is checked before being handed out again.
+        """
+        with self._condition:
+            self._idle.append((connection, time(), healthy))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager acquiring a connection from the pool, and releasing it
+        when the block exits.
+        """
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except Exception:
+            self.release(connection, healthy=False)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """Disconnects every connection of the pool"""
+        with self._condition:
+            self._closed = True
+            connections, self._connections = self._connections, []
+            self._idle = []
+            self._condition.notify_all()
+        for connection in connections:
+            connection.disconnect()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# portfolio.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Incremental tracking of the portfolio.
+"""
+
+from threading import Condition, Event
+from time import time
+from untws.connection import RequestTimeout, _acquire
+from untws.position import Position
+from untws.scheduler import PRIORITY_REQUEST
+
+__all__ = ['PortfolioTracker']
+
+class PortfolioTracker(object):
+    """
+    Keeps the positions of an account in memory, from a standing account
+    updates subscription. Each *updatePortfolio* message is applied in
+    place to the position it refers to, keyed by (account, conId), so
+    reading the positions does not involve TWS.
+
+    Use *IBConnection.track_portfolio* to create one. *IBConnection.reconnect*
+    subscribes it again.
+    """
+
+    def __init__(self, connection, account=''):
+        self._connection = connection
+        self._account = account
+        # (account, conId) -> Position
+        self._positions = {}
+        # (account, key, currency) -> value
+        self._account_values = {}
+        self._listeners = []
+        # positions changed since the last call to changes()
+        self._changed = {}
+        self._condition = Condition()
+        self._downloaded = Event()
+        # positions TWS did not send again since reconnecting (see
+        # _resubscribe)
+        self._stale = set()
+        self._running = False
+
+    @property
+    def connection(self):
+        """Returns the connection object"""
+        return self._connection
+
+    @property
+    def running(self):
+        """*True* while the account updates subscription is open"""
+        return self._running
+
+    def start(self, timeout=None):
+        """
+        Subscribes to the account updates, and waits for the initial download
+        of the portfolio. Raises *RequestTimeout* if another request holds
+        the account updates subscription, or if the download does not end,
+        within *timeout* seconds.
+        """
+        deadline = self._connection._deadline(timeout)
+        # the account updates subscription is ours until stop() is called
+        _acquire(self._connection._account_lock, deadline)
+        try:
+            self._connection._dispatcher.subscribe(
+                'account',
+                self._process_message
+            )
+            self._connection._send(
+                PRIORITY_REQUEST,
+                'reqAccountUpdates',
+                1,
+                self._account
+            )
+        except Exception:
+            self._connection._dispatcher.unsubscribe(
+                'account',
+                self._process_message
+            )
+            self._connection._account_lock.release()
+            raise
+        self._running = True
+        remaining = None if deadline is None else max(deadline - time(), 0)
+        if not self._downloaded.wait(remaining):
+            self.stop()
+            raise RequestTimeout("TWS did not send the portfolio in time")
+
+    def stop(self):
+        """Closes the account updates subscription"""
+        if not self._running:
+            return
+        self._running = False
+        self._connection._end_subscription(
+            'reqAccountUpdates',
+            0,
+            self._account
+        )
+        self._connection._dispatcher.unsubscribe(
+            'account',
+            self._process_message
+        )
+        self._connection._account_lock.release()
+
+    def _resubscribe(self):
+        """
+        Requests the account updates again, after *IBConnection.reconnect*.
+        TWS sends the whole portfolio again: positions it no longer sends
+        were closed in the meantime.
+        """
+        if not self._running:
+            return
+        self._downloaded.clear()
+        self._stale = set(self._positions)
+        self._connection._send(
+            PRIORITY_REQUEST,
+            'reqAccountUpdates',
+            1,
+            self._account
+        )
+
+    def wait(self, timeout=None):
+        """
+        Waits up to *timeout* seconds (forever if *None*) for TWS to finish
+        sending the portfolio, e.g. after a reconnection. Returns *True* once
+        it has.
+        """
+        return self._downloaded.wait(timeout)
+
+    def positions(self):
+        """Returns the list of (non-zero) positions"""
+        return list(self._positions.values())
+
+    def position(self, account_name, conid):
+        """Returns the position in the contract *conid*, or *None*"""
+        return self._positions.get((account_name, conid))
+
+    @property
+    def account_values(self):
+        """
+        The account values (e.g. 'NetLiquidation'), as a dictionary keyed by
+        (account, key, currency).
+        """
+        return dict(self._account_values)
+
+    def add_listener(self, listener):
+        """
+        Calls *listener(position)* (from the IbPy reader thread) each time a
+        position changes. Closed positions are reported with a zero quantity.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Stops calling *listener*"""
+        self._listeners.remove(listener)
+
+    def changes(self, timeout=0):
+        """
+        Returns the positions which changed since the last call, waiting up
+        to *timeout* seconds (forever if *None*) for at least one change.
+        Several changes to a position are reported once.
+        """
+        with self._condition:
+            if not self._changed and timeout != 0:
+                self._condition.wait(timeout)
+            changed, self._changed = self._changed, {}
+        return list(changed.values())
+
+    def _process_message(self, msg):
+        if msg.typeName == 'updatePortfolio':
+            self._apply(msg)
+        elif msg.typeName == 'updateAccountValue':
+            key = (msg.accountName, msg.key, msg.currency)
+            self._account_values[key] = msg.value
+        elif msg.typeName == 'accountDownloadEnd':
+            self._close_stale(msg.accountName)
+            self._downloaded.set()
+
+    def _apply(self, msg):
+        """Applies an *updatePortfolio* message"""
+        key = (msg.accountName, msg.contract.m_conId)
+        self._stale.discard(key)
+        position = self._positions.get(key)
+        if position is None:
+            position = Position(
+                self._connection,
+                msg.accountName,
+                msg.contract,
+                msg.position,
+                msg.marketPrice,
+                msg.averageCost,
+                msg.marketValue,
+                msg.realizedPNL,
+                msg.unrealizedPNL
+            )
+        elif not position._update(
+            msg.position,
+            msg.marketPrice,
+            msg.averageCost,
+            msg.marketValue,
+            msg.realizedPNL,
+            msg.unrealizedPNL
+        ):
+            return
+        if msg.position == 0:
+            self._positions.pop(key, None)
+        else:
+            self._positions[key] = position
+        self._report(key, position)
+
+    def _close_stale(self, account_name):
+        """
+        Closes the positions of *account_name* which TWS did not send again
+        after a reconnection
+        """
+        for key in [k for k in self._stale if k[0] == account_name]:
+            self._stale.discard(key)
+            position = self._positions.pop(key, None)
+            if position is not None:
+                position._update(
+                    0,
+                    position.price,
+                    position.average_cost,
+                    0.0,
+                    position.realized_pnl,
+                    position.unrealized_pnl
+                )
+                self._report(key, position)
+
+    def _report(self, key, position):
+        """Reports a changed position to *changes* and the listeners"""
+        with self._condition:
+            self._changed[key] = position
+            self._condition.notify_all()
+        for listener in self._listeners:
+            listener(position)
@@ -11,6 +11,11 @@ from untws.instrument import create_instrument
 
 class Position(object):
     """Represents a single position"""
+
+    __slots__ = (
+        '_connection', '_account_name', '_instrument', '_quantity', '_price',
+        '_average_cost', '_market_value', '_realized_pnl', '_unrealized_pnl'
+    )
     
     def __init__(self, connection, account_name, instrument, quantity, price,
         average_cost, market_value, realized_pnl, unrealized_pnl):
@@ -24,6 +29,20 @@ class Position(object):
         self._realized_pnl = realized_pnl
         self._unrealized_pnl = unrealized_pnl
     
+    def _update(self, quantity, price, average_cost, market_value,
+        realized_pnl, unrealized_pnl):
+        """
+        Updates the position in place. Returns *True* if anything changed.
+        """
+        values = (quantity, price, average_cost, market_value, realized_pnl,
+            unrealized_pnl)
+        if values == (self._quantity, self._price, self._average_cost,
+                self._market_value, self._realized_pnl, self._unrealized_pnl):
+            return False
+        (self._quantity, self._price, self._average_cost, self._market_value,
+            self._realized_pnl, self._unrealized_pnl) = values
+        return True
+
     def __repr__(self):
         return "<Position(%s, %s, %f)>" % \
             (self.account_name, self.instrument.ticker, self.quantity)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# quote_batch.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Columnar market data quotes, backed by NumPy arrays.
+"""
+
+import numpy as np
+from untws.connection import OPT_DATA_FIELDS
+from untws.market_data import *
+from untws.tick_fields import FieldMap, field_map
+
+__all__ = ['QuoteBatch', 'GREEKS', 'MISSING_INT']
+
+# the option computation fields, in column order
+GREEKS = (
+    'price', 'delta', 'gamma', 'vega', 'theta', 'underlying_price',
+    'pv_dividends', 'implied_vol'
+)
+
+OPTION_SIDES = tuple(OPT_DATA_FIELDS[f] for f in sorted(OPT_DATA_FIELDS))
+
+# the value of missing integer fields (sizes, volumes and timestamps)
+MISSING_INT = -1
+
+# tick type -> column
+_OPTION_COLUMNS = dict(
+    (f, OPTION_SIDES.index(name)) for f, name in OPT_DATA_FIELDS.items()
+)
+
+class QuoteBatch(object):
+    """
+    The quotes of several instruments, one row per instrument (in the order
+    they were requested), one NumPy column per field of *fields* (a
+    *tick_fields.FieldMap*, or a list of field names). Columns are typed:
+    prices and volatilities are floats, *NaN* when missing, and sizes,
+    volumes and timestamps are 64 bit integers, *MISSING_INT* when missing.
+
+    Fields (e.g. 'bid') are read with *column* (or as attributes), option
+    computations with *greek*. *batch[i]* returns row *i* as a
+    *MarketDataQuoteInstrument*.
+    """
+
+    def __init__(self, instruments, fields=None):
+        self.instruments = list(instruments)
+        self.fields = FieldMap() if fields is None else field_map(fields)
+        n = len(self.instruments)
+        self.index = np.array(
+            [i.m_conId for i in self.instruments],
+            dtype=np.int64
+        )
+        self.answered = np.zeros(n, dtype=bool)
+        names = self.fields.fields
+        floats = [f for f in names if self.fields.kind(f) is float]
+        ints = [f for f in names if self.fields.kind(f) is not float]
+        self._floats = np.full((n, len(floats)), np.nan)
+        self._ints = np.full((n, len(ints)), MISSING_INT, dtype=np.int64)
+        # field name -> (array, column)
+        self._columns = dict(
+            [(f, (self._floats, i)) for i, f in enumerate(floats)] +
+            [(f, (self._ints, i)) for i, f in enumerate(ints)]
+        )
+        # message type -> (tick type attribute, value attribute,
+        # {tick type: (array, column, type)}), from the field map's table
+        self._table = {}
+        for name, (tick, value, ticks) in self.fields.table.items():
+            self._table[name] = (tick, value, dict(
+                (t, self._columns[f] + (kind,))
+                for t, (f, kind) in ticks.items()
+            ))
+        self._options = np.full((n, len(OPTION_SIDES), len(GREEKS)), np.nan)
+
+    def record(self, row, msg):
+        """Records a tick message in *row*"""
+        entry = self._table.get(msg.typeName)
+        if entry is not None:
+            column = entry[2].get(getattr(msg, entry[0]))
+            if column is not None:
+                column[0][row, column[1]] = column[2](getattr(msg, entry[1]))
+        elif msg.typeName == 'tickOptionComputation':
+            side = _OPTION_COLUMNS.get(msg.field)
+            if side is not None:
+                self._options[row, side] = (
+                    msg.optPrice,
+                    msg.delta,
+                    msg.gamma,
+                    msg.vega,
+                    msg.theta,
+                    msg.undPrice,
+                    msg.pvDividend,
+                    msg.impliedVol
+                )
+
+    def __len__(self):
+        return len(self.instruments)
+
+    def __getattr__(self, field):
+        if field in self.__dict__.get('_columns', ()):
+            return self.column(field)
+        raise AttributeError('QuoteBatch has no field "%s"' % field)
+
+    def column(self, field):
+        """The column of a field (e.g. 'bid')"""
+        if field not in self._columns:
+            raise KeyError('QuoteBatch has no field "%s"' % field)
+        array, column = self._columns[field]
+        return array[:, column]
+
+    def greek(self, name, side='model'):
+        """
+        The column of an option computation field (e.g. 'delta'), computed
+        from the *side* price ('bid', 'ask', 'last', 'model' or 'mid').
+        """
+        if side == 'mid':
+            return self.option_mid[:, GREEKS.index(name)]
+        return self._options[:, OPTION_SIDES.index(side), GREEKS.index(name)]
+
+    @property
+    def mid(self):
+        """The mid price column"""
+        return (self.column('bid') + self.column('ask')) / 2
+
+    @property
+    def spread(self):
+        """The bid/ask spread column"""
+        return self.column('ask') - self.column('bid')
+
+    @property
+    def option_mid(self):
+        """
+        The option computations at the mid point, as an array with one row
+        per instrument and one column per field of *GREEKS*.
+        """
+        bid = self._options[:, OPTION_SIDES.index('bid')]
+        ask = self._options[:, OPTION_SIDES.index('ask')]
+        return (bid + ask) / 2
+
+    def total(self, name, weights, side='model'):
+        """
+        The sum of an option computation field over all instruments,
+        weighted by *weights* (e.g. quantity times multiplier), ignoring
+        missing values.
+        """
+        return np.nansum(self.greek(name, side) * np.asarray(weights))
+
+    def row(self, conid):
+        """The row number of the instrument with this conId"""
+        rows = np.flatnonzero(self.index == conid)
+        if len(rows) == 0:
+            raise KeyError(conid)
+        return rows[0]
+
+    def __getitem__(self, row):
+        data = {}
+        for name in self.fields.fields:
+            array, column = self._columns[name]
+            value = array[row, column]
+            if array is self._floats:
+                if not np.isnan(value):
+                    data[name] = value
+            elif value != MISSING_INT:
+                data[name] = int(value)
+        opts = {}
+        for i, side in enumerate(OPTION_SIDES):
+            values = self._options[row, i]
+            if not np.isnan(values).all():
+                opts[side] = MarketDataQuoteBase(dict(zip(GREEKS, values)))
+        if opts:
+            data['option'] = OptionDataQuote(opts)
+        return MarketDataQuoteInstrument(self.instruments[row], data)
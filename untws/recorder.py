@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# recorder.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Recording of the market data ticks received from TWS, into append-only
+files of fixed-width records which can be memory-mapped as NumPy arrays.
+"""
+
+import glob
+import logging
+import os
+import struct
+from collections import deque
+from threading import Event, Lock, Thread
+from time import time, strftime
+
+__all__ = ['TickRecorder', 'read_ticks', 'load_ticks', 'recorded_files']
+
+log = logging.getLogger(__name__)
+
+# the kind of a record (the IB message id of the tick)
+TICK_PRICE = 1
+TICK_SIZE = 2
+TICK_OPTION_COMPUTATION = 21
+
+# the fields of a record, with their struct format; records are packed and
+# little-endian
+TICK_FIELDS = (
+    ('time', 'd'),
+    ('conid', 'q'),
+    ('kind', 'h'),
+    ('field', 'h'),
+    # the price, the size, or the option price
+    ('value', 'd'),
+    ('delta', 'd'),
+    ('gamma', 'd'),
+    ('vega', 'd'),
+    ('theta', 'd'),
+    ('implied_vol', 'd'),
+    ('underlying_price', 'd'),
+    ('pv_dividends', 'd')
+)
+
+RECORD = struct.Struct('<' + ''.join(f[1] for f in TICK_FIELDS))
+
+# each file starts with a magic string and the record size
+MAGIC = b'UNTWSTCK'
+HEADER = struct.Struct('<8sI4x')
+
+# the message types a recorder listens to
+TICK_TYPES = ('tickPrice', 'tickSize', 'tickOptionComputation')
+
+_NO_GREEKS = (float('nan'),) * 7
+
+class TickRecorder(object):
+    """
+    Writes every tick of the instruments requested through the connections
+    it is given to (see the *recorder* argument of *IBConnection*) to files
+    named *prefix*-*session*-*number*.ticks in *directory*. A new file is
+    started once the current one reaches *max_file_size* bytes.
+
+    Ticks are buffered in memory and written by a background thread every
+    *flush_interval* seconds, so that the IbPy reader thread only appends to
+    the buffer. If more than *buffer_size* ticks are waiting, further ones
+    are dropped (and counted in *dropped*) rather than slowing down the
+    reader thread.
+    """
+
+    def __init__(self, directory, prefix='ticks', max_file_size=64 << 20,
+        buffer_size=100000, flush_interval=0.1):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self.files = []
+        self._session = strftime('%Y%m%d-%H%M%S')
+        self._file = None
+        self._file_size = 0
+        # ticker id -> conId of the instrument
+        self._conids = {}
+        self._buffer = deque()
+        self._lock = Lock()
+        self._closed = Event()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._thread = Thread(target=self._run, name='untws-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def track(self, ticker_id, conid):
+        """Records the ticks of *ticker_id* under *conid*"""
+        self._conids[ticker_id] = conid
+
+    def untrack(self, ticker_id):
+        """Stops recording the ticks of *ticker_id*"""
+        self._conids.pop(ticker_id, None)
+
+    def record(self, msg):
+        """Callback for ibpy"""
+        conid = self._conids.get(msg.tickerId)
+        if conid is None:
+            return
+        name = msg.typeName
+        if name == 'tickPrice':
+            record = (time(), conid, TICK_PRICE, msg.field, msg.price) + \
+                _NO_GREEKS
+        elif name == 'tickSize':
+            record = (time(), conid, TICK_SIZE, msg.field, msg.size) + \
+                _NO_GREEKS
+        else:
+            record = (
+                time(),
+                conid,
+                TICK_OPTION_COMPUTATION,
+                msg.field,
+                msg.optPrice,
+                msg.delta,
+                msg.gamma,
+                msg.vega,
+                msg.theta,
+                msg.impliedVol,
+                msg.undPrice,
+                msg.pvDividend
+            )
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+        else:
+            self._buffer.append(record)
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Writing ticks failed")
+
+    def flush(self):
+        """Writes the buffered ticks to disk"""
+        with self._lock:
+            records = []
+            try:
+                while True:
+                    records.append(self._buffer.popleft())
+            except IndexError:
+                pass
+            if not records:
+                return
+            data = b''.join(RECORD.pack(*r) for r in records)
+            offset = 0
+            while offset < len(data):
+                if self._file is None or \
+                        self._file_size + RECORD.size > self.max_file_size:
+                    self._rotate()
+                # as many whole records as fit in the current file
+                room = (self.max_file_size - self._file_size) // RECORD.size
+                chunk = data[offset:offset + max(room, 1) * RECORD.size]
+                self._file.write(chunk)
+                self._file_size += len(chunk)
+                offset += len(chunk)
+            self._file.flush()
+            self.written += len(records)
+
+    def _rotate(self):
+        """Closes the current file, and starts a new one"""
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(
+            self.directory,
+            '%s-%s-%05d.ticks' % (self.prefix, self._session, len(self.files))
+        )
+        self._file = open(path, 'ab')
+        self._file.write(HEADER.pack(MAGIC, RECORD.size))
+        self._file_size = HEADER.size
+        self.files.append(path)
+
+    def close(self):
+        """Writes the remaining ticks, and closes the current file"""
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def tick_dtype():
+    """The NumPy dtype of a record"""
+    import numpy as np
+    return np.dtype([(name, '<' + code) for name, code in TICK_FIELDS])
+
+def read_ticks(path):
+    """
+    Memory-maps the ticks recorded in *path*, as a read-only NumPy
+    structured array with the fields of *TICK_FIELDS*. Nothing is copied,
+    so files of any size can be opened. A record still being written at
+    the end of the file is left out.
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        magic, size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or size != RECORD.size:
+        raise Exception("%s is not a tick recording" % path)
+    count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    if count == 0:
+        return np.zeros(0, dtype=tick_dtype())
+    return np.memmap(
+        path,
+        dtype=tick_dtype(),
+        mode='r',
+        offset=HEADER.size,
+        shape=(count,)
+    )
+
+def recorded_files(directory, prefix='ticks'):
+    """The files recorded in *directory*, oldest first"""
+    return sorted(glob.glob(os.path.join(directory, prefix + '-*.ticks')))
+
+def load_ticks(directory, prefix='ticks'):
+    """
+    Returns all the ticks recorded in *directory* as a single NumPy array
+    (unlike *read_ticks*, this copies them into memory).
+    """
+    import numpy as np
+    arrays = [read_ticks(path) for path in recorded_files(directory, prefix)]
+    if not arrays:
+        return np.zeros(0, dtype=tick_dtype())
+    return np.concatenate(arrays)
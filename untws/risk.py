@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# risk.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Real-time aggregation of the risk of a book of positions, backed by NumPy
+arrays.
+"""
+
+from threading import Lock
+import numpy as np
+from ib.ext.Contract import Contract
+from untws.connection import OPT_DATA_FIELDS, SubscriptionLimitExceeded
+from untws.instrument import Stock, StockOption, Futures, FuturesOption
+
+__all__ = ['RiskEngine', 'MEASURES', 'GROUPINGS']
+
+# the risk measures, in column order: dollar delta, dollar gamma (the change
+# in dollar delta for a 1% move of the underlying), vega and theta (per
+# volatility point and per day, in dollars) and unrealized P&L
+MEASURES = ('delta', 'gamma', 'vega', 'theta', 'pnl')
+
+# the ways positions can be grouped
+GROUPINGS = ('underlying', 'account', 'expiry')
+
+_SEC_TYPES = (
+    (StockOption, 'OPT'),
+    (FuturesOption, 'FOP'),
+    (Futures, 'FUT'),
+    (Stock, 'STK')
+)
+
+# quote state columns
+_BID, _ASK, _LAST, _UND, _DELTA, _GAMMA, _VEGA, _THETA = range(8)
+_PRICE_TICKS = {1: _BID, 2: _ASK, 4: _LAST}
+
+NAN = float('nan')
+
+def _clean(column, values):
+    """
+    Replaces by *NaN* what TWS sends for the values it does not have (e.g.
+    -1 for a missing bid, or a huge number for a greek it cannot compute)
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        if column == _DELTA:
+            valid = np.abs(values) <= 1
+        elif column == _THETA:
+            valid = np.abs(values) < 1e100
+        else:
+            valid = (values >= 0) & (values < 1e100)
+    return np.where(valid, values, np.nan)
+
+def _clean_value(column, value):
+    """Same as *_clean*, for a single value"""
+    if column == _DELTA:
+        valid = -1 <= value <= 1
+    elif column == _THETA:
+        valid = -1e100 < value < 1e100
+    else:
+        valid = 0 <= value < 1e100
+    return float(value) if valid else NAN
+
+def _contract(connection, instrument):
+    """The contract to request market data for *instrument* with"""
+    cache = connection.contract_cache
+    if cache is not None:
+        contract = cache.get(instrument.conid)
+        if contract is not None:
+            return contract
+    c = Contract()
+    c.m_conId = instrument.conid
+    for cls, sec_type in _SEC_TYPES:
+        if isinstance(instrument, cls):
+            c.m_secType = sec_type
+            break
+    c.m_localSymbol = instrument.ticker
+    c.m_currency = instrument.currency
+    if c.m_secType in ('STK', 'OPT'):
+        c.m_exchange = 'SMART'
+    else:
+        c.m_exchange = instrument.exchange
+    return c
+
+def _multiplier(instrument):
+    if isinstance(instrument, (StockOption, FuturesOption)):
+        value = instrument.contract_size
+    elif isinstance(instrument, Futures):
+        value = instrument.point_value
+    else:
+        value = None
+    return float(value) if value else 1.0
+
+class RiskEngine(object):
+    """
+    The dollar greeks and P&L of a list of positions (see *MEASURES*),
+    summed by underlying, account and expiry.
+
+    Positions are joined with their quotes by conId: each row of the
+    engine is a position, and positions in the same contract (e.g. in
+    several accounts) share a quote. Once *start* is called, each tick
+    received updates the rows of its contract only, and the totals of their
+    groups are adjusted by the difference, so that reading the risk never
+    involves recomputing the whole book.
+
+    Greeks are taken from the option computations of the *side* price
+    ('bid', 'ask', 'last' or 'model'); stocks and futures have a delta of
+    one. Prices are the mid point if there is a bid and an ask, else the
+    last price, else the price the position came with. Positions without a
+    quote yet count as zero.
+
+    Use *IBConnection.track_risk* to create one.
+    """
+
+    def __init__(self, connection, positions, side='model'):
+        self._connection = connection
+        self.positions = list(positions)
+        self.side = side
+        self._side_tick = [
+            f for f, name in OPT_DATA_FIELDS.items() if name == side
+        ][0]
+        n = len(self.positions)
+        instruments = [p.instrument for p in self.positions]
+        conids = np.array([i.conid for i in instruments], dtype=np.int64)
+        # one quote per contract; _quote_of maps rows to their quote
+        self.conids, first, self._quote_of = np.unique(
+            conids,
+            return_index=True,
+            return_inverse=True
+        )
+        self.instruments = [instruments[i] for i in first]
+        self._quote_index = dict(
+            (int(c), k) for k, c in enumerate(self.conids)
+        )
+        # quote -> rows holding it
+        order = np.argsort(self._quote_of, kind='mergesort')
+        bounds = np.searchsorted(
+            self._quote_of[order],
+            np.arange(len(self.conids) + 1)
+        )
+        self._rows_of = [
+            order[bounds[k]:bounds[k + 1]].tolist()
+            for k in range(len(self.conids))
+        ]
+        # (account, conId) -> row
+        self._row_of = dict(
+            ((p.account_name, p.instrument.conid), row)
+            for row, p in enumerate(self.positions)
+        )
+
+        self._quotes = np.full((len(self.conids), 8), np.nan)
+        self.quantity = np.array(
+            [p.quantity for p in self.positions],
+            dtype=float
+        )
+        self.multiplier = np.array(
+            [_multiplier(i) for i in instruments],
+            dtype=float
+        )
+        self.average_cost = np.array(
+            [p.average_cost for p in self.positions],
+            dtype=float
+        )
+        self._position_price = np.array(
+            [np.nan if p.price is None else p.price for p in self.positions],
+            dtype=float
+        )
+        self._is_option = np.array(
+            [isinstance(i, (StockOption, FuturesOption)) for i in instruments],
+            dtype=bool
+        )
+
+        # grouping -> (labels, row -> label index)
+        self._groups = {}
+        for grouping in GROUPINGS:
+            keys = [self._group_key(grouping, p) for p in self.positions]
+            labels = sorted(set(keys), key=lambda k: (k is not None, k))
+            index = dict((label, i) for i, label in enumerate(labels))
+            self._groups[grouping] = (
+                labels,
+                np.array([index[k] for k in keys], dtype=np.intp)
+            )
+
+        # row -> exposures, and grouping -> label -> totals
+        self._exposures = np.zeros((n, len(MEASURES)))
+        self._totals = dict(
+            (g, np.zeros((len(self._groups[g][0]), len(MEASURES))))
+            for g in GROUPINGS
+        )
+        # row -> the totals it adds to, for the updates of single rows
+        self._row_totals = [
+            tuple(
+                self._totals[g][self._groups[g][1][row]] for g in GROUPINGS
+            )
+            for row in range(n)
+        ]
+        self._lock = Lock()
+        self._listeners = []
+        # the quotes we subscribed to
+        self._quotes_owned = []
+        self.ticks = 0
+        self.recompute()
+
+    @property
+    def connection(self):
+        """Returns the connection object"""
+        return self._connection
+
+    @staticmethod
+    def _group_key(grouping, position):
+        instrument = position.instrument
+        if grouping == 'account':
+            return position.account_name
+        elif grouping == 'underlying':
+            return getattr(instrument, 'underlying', instrument.ticker)
+        return getattr(instrument, 'expiration_date', None)
+
+    def _compute(self, rows):
+        """The exposures of *rows* (an array of row numbers)"""
+        quotes = self._quotes[self._quote_of[rows]]
+        mid = (quotes[:, _BID] + quotes[:, _ASK]) / 2
+        price = np.where(np.isnan(mid), quotes[:, _LAST], mid)
+        price = np.where(np.isnan(price), self._position_price[rows], price)
+        option = self._is_option[rows]
+        spot = np.where(option, quotes[:, _UND], price)
+        size = self.quantity[rows] * self.multiplier[rows]
+        out = np.empty((len(rows), len(MEASURES)))
+        out[:, 0] = np.where(option, quotes[:, _DELTA], 1.0) * size * spot
+        out[:, 1] = np.where(option, quotes[:, _GAMMA], 0.0) * size * \
+            spot * spot / 100
+        out[:, 2] = np.where(option, quotes[:, _VEGA], 0.0) * size
+        out[:, 3] = np.where(option, quotes[:, _THETA], 0.0) * size
+        out[:, 4] = price * size - self.quantity[rows] * self.average_cost[rows]
+        # what we have no quote for counts as zero
+        out[np.isnan(out)] = 0.0
+        return out
+
+    def _update_row(self, row):
+        """
+        Recomputes *row*, and adjusts the totals of its groups. This is
+        *_compute* for a single row, in plain Python: NumPy costs more than
+        it saves on so little data.
+        """
+        bid, ask, last, spot, delta, gamma, vega, theta = \
+            self._quotes[self._quote_of[row]].tolist()
+        price = (bid + ask) / 2
+        if price != price:
+            price = last
+        if price != price:
+            price = float(self._position_price[row])
+        if not self._is_option[row]:
+            spot, delta, gamma, vega, theta = price, 1.0, 0.0, 0.0, 0.0
+        quantity = float(self.quantity[row])
+        size = quantity * float(self.multiplier[row])
+        new = [
+            delta * size * spot,
+            gamma * size * spot * spot / 100,
+            vega * size,
+            theta * size,
+            price * size - quantity * float(self.average_cost[row])
+        ]
+        new = [0.0 if v != v else v for v in new]
+        exposures = self._exposures[row]
+        change = np.subtract(new, exposures)
+        exposures[:] = new
+        for totals in self._row_totals[row]:
+            totals += change
+
+    def recompute(self):
+        """
+        Recomputes every row and total from scratch (the incremental totals
+        may otherwise accumulate rounding errors over a long session).
+        """
+        rows = np.arange(len(self.positions))
+        with self._lock:
+            self._exposures[:] = self._compute(rows)
+            for grouping, (labels, index) in self._groups.items():
+                # in place, as _row_totals refers to the rows of the totals
+                totals = self._totals[grouping]
+                totals[:] = 0.0
+                np.add.at(totals, index, self._exposures)
+
+    def refresh(self, max_in_flight=50, timeout=None):
+        """
+        Loads a market data snapshot of every contract (in a single batch,
+        see *IBConnection.get_market_data_batch*) and recomputes the book.
+        """
+        batch = self._connection.get_market_data_batch(
+            [_contract(self._connection, i) for i in self.instruments],
+            max_in_flight,
+            timeout
+        )
+        columns = (
+            (_BID, batch.column('bid')),
+            (_ASK, batch.column('ask')),
+            (_LAST, batch.column('last')),
+            (_UND, batch.greek('underlying_price', self.side)),
+            (_DELTA, batch.greek('delta', self.side)),
+            (_GAMMA, batch.greek('gamma', self.side)),
+            (_VEGA, batch.greek('vega', self.side)),
+            (_THETA, batch.greek('theta', self.side))
+        )
+        with self._lock:
+            for column, values in columns:
+                values = _clean(column, values)
+                current = self._quotes[:, column]
+                current[:] = np.where(np.isnan(values), current, values)
+        self.recompute()
+
+    def start(self, refresh=True, timeout=None):
+        """
+        Opens a streaming subscription (see *IBConnection.subscribe*) for
+        every contract of the book, after loading a snapshot of them first
+        if *refresh* is *True*. Each contract uses a market data line, so
+        *max_subscriptions* must allow for all of them.
+        """
+        connection = self._connection
+        if refresh:
+            self.refresh(timeout=timeout)
+        open_quotes = connection.subscriptions
+        if len(open_quotes) + len(self.instruments) > \
+                connection.max_subscriptions:
+            raise SubscriptionLimitExceeded(
+                "Tracking the risk of %d contracts needs more than %d "
+                "market data subscriptions" % \
+                (len(self.instruments), connection.max_subscriptions)
+            )
+        open_quotes = set(id(q) for q in open_quotes)
+        for instrument in self.instruments:
+            quote = connection.subscribe(_contract(connection, instrument))
+            quote.add_listener(self._process_tick)
+            self._quotes_owned.append((quote, id(quote) not in open_quotes))
+
+    def stop(self):
+        """Stops updating the risk, and closes our subscriptions"""
+        quotes, self._quotes_owned = self._quotes_owned, []
+        for quote, owned in quotes:
+            quote.remove_listener(self._process_tick)
+            if owned:
+                self._connection.unsubscribe(quote)
+
+    def _process_tick(self, quote, msg):
+        name = msg.typeName
+        if name == 'tickPrice':
+            column = _PRICE_TICKS.get(msg.field)
+            if column is None:
+                return
+            values = ((column, msg.price),)
+        elif name == 'tickOptionComputation':
+            if msg.field != self._side_tick:
+                return
+            values = (
+                (_UND, msg.undPrice),
+                (_DELTA, msg.delta),
+                (_GAMMA, msg.gamma),
+                (_VEGA, msg.vega),
+                (_THETA, msg.theta)
+            )
+        else:
+            return
+        k = self._quote_index.get(quote.instrument.m_conId)
+        if k is None:
+            return
+        with self._lock:
+            quote_row = self._quotes[k]
+            for column, value in values:
+                quote_row[column] = _clean_value(column, value)
+            for row in self._rows_of[k]:
+                self._update_row(row)
+            self.ticks += 1
+        for listener in self._listeners:
+            listener(self, int(self.conids[k]))
+
+    def update_position(self, position):
+        """
+        Applies a change of quantity or average cost to a position of the
+        book. It can be used as a *PortfolioTracker* listener; positions
+        which are not in the book are ignored.
+        """
+        row = self._row_of.get(
+            (position.account_name, position.instrument.conid)
+        )
+        if row is None:
+            return
+        with self._lock:
+            self.quantity[row] = position.quantity
+            self.average_cost[row] = position.average_cost
+            if position.price is not None:
+                self._position_price[row] = position.price
+            self._update_row(row)
+
+    def add_listener(self, listener):
+        """
+        Calls *listener(engine, conid)* (from the IbPy reader thread) after
+        each tick which changed the risk.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Stops calling *listener*"""
+        self._listeners.remove(listener)
+
+    @property
+    def exposures(self):
+        """
+        The exposures of every position, as an array with one row per
+        position and one column per measure of *MEASURES*.
+        """
+        with self._lock:
+            return self._exposures.copy()
+
+    def table(self, by):
+        """
+        The totals grouped *by* 'underlying', 'account' or 'expiry', as a
+        (labels, array) pair, the array having one row per label and one
+        column per measure. Stocks have a *None* expiry.
+        """
+        labels, index = self._groups[by]
+        with self._lock:
+            return list(labels), self._totals[by].copy()
+
+    def aggregate(self, by):
+        """
+        Same as *table*, as a dictionary mapping labels to dictionaries of
+        measures.
+        """
+        labels, totals = self.table(by)
+        return dict(
+            (label, dict(zip(MEASURES, row.tolist())))
+            for label, row in zip(labels, totals)
+        )
+
+    def by_underlying(self):
+        """The totals per underlying (see *aggregate*)"""
+        return self.aggregate('underlying')
+
+    def by_account(self):
+        """The totals per account (see *aggregate*)"""
+        return self.aggregate('account')
+
+    def by_expiry(self):
+        """The totals per expiry date (see *aggregate*)"""
+        return self.aggregate('expiry')
+
+    def totals(self):
+        """The totals of the whole book, as a dictionary of measures"""
+        with self._lock:
+            return dict(
+                zip(MEASURES, self._totals['account'].sum(axis=0).tolist())
+            )
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# scheduler.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+Rate limiting of the requests sent to TWS.
+
+TWS disconnects clients sending more than 50 messages per second. Every
+outbound call of a connection goes through a *RequestScheduler*, which
+sends them from a background thread, highest priority first, as fast as
+its token bucket allows.
+"""
+
+import heapq
+import logging
+from itertools import count
+from threading import Condition, Thread
+from time import time
+
+__all__ = [
+    'TokenBucket', 'RequestScheduler', 'SchedulerClosed', 'PRIORITY_CANCEL',
+    'PRIORITY_ORDER', 'PRIORITY_REQUEST', 'PRIORITY_MARKET_DATA',
+    'PRIORITY_HISTORICAL'
+]
+
+log = logging.getLogger(__name__)
+
+# request priorities, lower values are sent first
+PRIORITY_CANCEL = 0
+PRIORITY_ORDER = 1
+PRIORITY_REQUEST = 2
+PRIORITY_MARKET_DATA = 3
+PRIORITY_HISTORICAL = 4
+
+class TokenBucket(object):
+    """
+    Allows *rate* messages per second on average, and bursts of up to
+    *capacity* messages.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = time()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def delay(self, now=None):
+        """Returns the number of seconds until a token is available"""
+        if now is None:
+            now = time()
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self, now=None):
+        """Consumes a token (which must be available)"""
+        if now is None:
+            now = time()
+        self._refill(now)
+        self._tokens -= 1
+
+class SchedulerClosed(Exception):
+    """Raised when a call is submitted to a closed *RequestScheduler*"""
+
+class _Job(object):
+    """A call waiting in the scheduler's queue"""
+
+    __slots__ = ('priority', 'call', 'args', 'submitted', 'sent', 'withdrawn')
+
+    def __init__(self, priority, call, args):
+        self.priority = priority
+        self.call = call
+        self.args = args
+        self.submitted = time()
+        # the time it was sent at, once it is
+        self.sent = False
+        self.withdrawn = False
+
+class RequestScheduler(object):
+    """
+    Sends calls from a background thread, by order of priority (and by
+    order of submission within a priority), no faster than *bucket* allows.
+
+    *pacing* optionally maps priorities to additional token buckets, which
+    calls of that priority must also get a token from (e.g. to respect the
+    historical data pacing rules).
+    """
+
+    def __init__(self, bucket, pacing=None):
+        self.bucket = bucket
+        self.pacing = pacing if pacing is not None else {}
+        self._queue = []
+        self._sequence = count()
+        self._condition = Condition()
+        self._closed = False
+        # metrics
+        self._sent = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._max_depth = 0
+        self._thread = None
+        self._start()
+
+    def submit(self, priority, call, *args):
+        """
+        Queues *call(\\*args)* to be sent with the given *priority*. Returns a
+        job which can be passed to *withdraw*. Raises *SchedulerClosed* if
+        the scheduler is closed: the call would only be sent after
+        *reopen*, long after its caller gave up on it.
+        """
+        job = _Job(priority, call, args)
+        with self._condition:
+            if self._closed:
+                raise SchedulerClosed("Calls cannot be sent until reopen()")
+            heapq.heappush(self._queue, (priority, next(self._sequence), job))
+            if len(self._queue) > self._max_depth:
+                self._max_depth = len(self._queue)
+            self._condition.notify()
+        return job
+
+    def withdraw(self, job):
+        """
+        Removes *job* from the queue if it was not sent yet. Returns *True*
+        if it was withdrawn (or if *job* is *None*: it was never queued),
+        *False* if it was already sent.
+        """
+        if job is None:
+            return True
+        with self._condition:
+            if job.sent:
+                return False
+            job.withdrawn = True
+            return True
+
+    def cancel(self, job, call, *args):
+        """
+        Cancels the request sent by *job*: if it is still queued it is
+        simply withdrawn, otherwise *call(\\*args)* (e.g. *cancelMktData*)
+        is sent ahead of everything else. Nothing is sent if the scheduler
+        is closed: the request ended along with the connection.
+        """
+        if self.withdraw(job):
+            return
+        try:
+            self.submit(PRIORITY_CANCEL, call, *args)
+        except SchedulerClosed:
+            pass
+
+    @property
+    def queue_depth(self):
+        """The number of calls waiting to be sent"""
+        return len(self._queue)
+
+    def metrics(self):
+        """
+        Returns a dictionary with the queue depth (current and maximum), the
+        number of calls sent, and the average and maximum time (in seconds)
+        they spent queued.
+        """
+        with self._condition:
+            return {
+                'queue_depth': len(self._queue),
+                'max_queue_depth': self._max_depth,
+                'sent': self._sent,
+                'average_wait': self._total_wait / self._sent \
+                    if self._sent else 0.0,
+                'max_wait': self._max_wait
+            }
+
+    def close(self):
+        """Stops the background thread; queued calls are dropped"""
+        with self._condition:
+            self._closed = True
+            self._queue = []
+            self._condition.notify()
+
+    def reopen(self):
+        """Starts sending calls again after *close*"""
+        with self._condition:
+            self._closed = False
+            # the thread may not have noticed it was closed yet, in which
+            # case it simply carries on
+            if self._thread is None:
+                self._start()
+
+    def _start(self):
+        self._thread = Thread(target=self._run, name='untws-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_job(self):
+        """Waits for the next job which may be sent, and pops it"""
+        with self._condition:
+            while True:
+                if self._closed:
+                    self._thread = None
+                    return None
+                while self._queue and self._queue[0][2].withdrawn:
+                    heapq.heappop(self._queue)
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                pacing = self.pacing.get(self._queue[0][0])
+                delay = self.bucket.delay()
+                if pacing is not None:
+                    delay = max(delay, pacing.delay())
+                if delay > 0:
+                    # a more urgent job may be submitted meanwhile
+                    self._condition.wait(delay)
+                    continue
+                job = heapq.heappop(self._queue)[2]
+                self.bucket.take()
+                if pacing is not None:
+                    pacing.take()
+                job.sent = time()
+                wait = job.sent - job.submitted
+                self._sent += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+                return job
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                job.call(*job.args)
+            except Exception:
+                # one bad call must not stop the others from being sent
+                log.exception("Sending %s failed", job.call)
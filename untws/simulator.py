@@ -0,0 +1,606 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# simulator.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+A simulated TWS, to run *IBConnection* without one (e.g. for benchmarks and
+continuous integration).
+"""
+
+import heapq
+import logging
+from datetime import date, timedelta
+from itertools import count
+from random import Random
+from threading import Condition, Thread
+from time import time
+from ib.ext.Contract import Contract
+from ib.ext.Execution import Execution
+from ib.ext.OrderState import OrderState
+from ib.opt import message
+
+__all__ = [
+    'SimulatedTransport', 'SyntheticMarket', 'RecordedMarket',
+    'synthetic_portfolio'
+]
+
+log = logging.getLogger(__name__)
+
+def _listener_key(message_type):
+    """
+    The key listeners of *message_type* are registered under, as IbPy's
+    dispatcher does it: the name of the message class (e.g. 'TickPrice').
+    The method names of the messages (e.g. 'tickPrice') are rejected,
+    since IbPy would silently never call their listeners.
+    """
+    key = getattr(message_type, '__name__', message_type)
+    if key in message.registry:
+        raise ValueError(
+            "IbPy listeners are registered by message class (e.g. "
+            "message.%s), not by name ('%s')" % (key, key)
+        )
+    return key
+
+class SimulatedTransport(object):
+    """
+    Stands in for the IbPy connection of an *IBConnection* (see its
+    *transport* argument), answering requests with messages made up by
+    *market* (a *SyntheticMarket* by default, or a *RecordedMarket*) and
+    *portfolio* (a list of *updatePortfolio* fields, such as returned by
+    *synthetic_portfolio*).
+
+    Supported requests are *reqCurrentTime*, *reqAccountUpdates*,
+    *reqPositions*, *reqMktData* (snapshots and streaming), *reqMktDepth*
+    (if *market* offers depth), *placeOrder* and their cancellations. Orders are filled in full at their limit price
+    (or at the last price of *market*) if *fill_orders* is *True*, and
+    otherwise rest until they are cancelled.
+
+    Messages are delivered from a thread of their own, like IbPy does,
+    *latency* seconds after the request, and at most *rate* per second (as
+    fast as possible if *None*). They are always delivered in the order
+    they were produced, so runs are reproducible.
+    """
+
+    def __init__(self, market=None, portfolio=(), latency=0.0, rate=None,
+        fill_orders=True):
+        self.market = market if market is not None else SyntheticMarket()
+        self.portfolio = list(portfolio)
+        self.latency = latency
+        self.rate = rate
+        self.fill_orders = fill_orders
+        # order id -> (contract, order) of the resting orders
+        self._resting = {}
+        self._executions = count(1)
+        # request method -> number of calls
+        self.requests = {}
+        # message type -> listeners, None for listeners of every type
+        self._listeners = {}
+        self._condition = Condition()
+        # (due time, sequence number, message type, fields, stream)
+        self._queue = []
+        self._sequence = count()
+        self._next_slot = 0
+        # ticker ids of the streaming requests which were not cancelled
+        self._streams = set()
+        self._thread = None
+        self._connected = False
+
+    def register(self, listener, *types):
+        for key in map(_listener_key, types):
+            self._listeners.setdefault(key, []).append(listener)
+        return True
+
+    def registerAll(self, listener):
+        self._listeners.setdefault(None, []).append(listener)
+        return True
+
+    def unregister(self, listener, *types):
+        for key in map(_listener_key, types):
+            if listener in self._listeners.get(key, ()):
+                self._listeners[key].remove(listener)
+        return True
+
+    def unregisterAll(self, listener):
+        for listeners in self._listeners.values():
+            if listener in listeners:
+                listeners.remove(listener)
+        return True
+
+    def connect(self):
+        with self._condition:
+            if self._connected:
+                return True
+            self._connected = True
+            self._thread = Thread(target=self._run, name='untws-simulator')
+            self._thread.daemon = True
+            self._thread.start()
+        self._deliver(0, 'nextValidId', {'orderId': 1})
+        return True
+
+    def isConnected(self):
+        return self._connected
+
+    def disconnect(self):
+        with self._condition:
+            if not self._connected:
+                return
+            self._connected = False
+            self._queue = []
+            self._streams.clear()
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _count(self, method):
+        self.requests[method] = self.requests.get(method, 0) + 1
+
+    def _deliver(self, delay, name, fields, stream=None):
+        """
+        Queues a message, to be delivered *delay* seconds after the latency.
+        Ticks of the streaming request *stream* are dropped once it is
+        cancelled.
+        """
+        with self._condition:
+            due = time() + self.latency + delay
+            if self.rate is not None:
+                due = max(due, self._next_slot)
+                self._next_slot = due + 1.0 / self.rate
+            heapq.heappush(
+                self._queue,
+                (due, next(self._sequence), name, fields, stream)
+            )
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._connected:
+                    if self._queue:
+                        wait = self._queue[0][0] - time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+                if not self._connected:
+                    return
+                due, sequence, name, fields, stream = \
+                    heapq.heappop(self._queue)
+                if stream is not None and stream not in self._streams:
+                    continue
+            msg = getattr(message, name)(**fields)
+            for listener in self._listeners.get(type(msg).__name__, []) + \
+                    self._listeners.get(None, []):
+                try:
+                    listener(msg)
+                except Exception:
+                    log.exception("Listener failed on %s", name)
+
+    def reqCurrentTime(self):
+        self._count('reqCurrentTime')
+        self._deliver(0, 'currentTime', {'time': int(time())})
+
+    def reqAccountUpdates(self, subscribe, acctCode):
+        self._count('reqAccountUpdates')
+        if not subscribe:
+            return
+        accounts = set()
+        for fields in self.portfolio:
+            if acctCode and fields['accountName'] != acctCode:
+                continue
+            accounts.add(fields['accountName'])
+            self._deliver(0, 'updatePortfolio', fields)
+        for account in sorted(accounts) or [acctCode]:
+            self._deliver(0, 'accountDownloadEnd', {'accountName': account})
+
+    def reqPositions(self):
+        self._count('reqPositions')
+        for fields in self.portfolio:
+            self._deliver(0, 'position', {
+                'account': fields['accountName'],
+                'contract': fields['contract'],
+                'pos': fields['position'],
+                'avgCost': fields['averageCost']
+            })
+        self._deliver(0, 'positionEnd', {})
+
+    def cancelPositions(self):
+        self._count('cancelPositions')
+
+    def reqMktData(self, tickerId, contract, genericTickList, snapshot):
+        self._count('reqMktData')
+        if snapshot and genericTickList:
+            self._deliver(0, 'error', {
+                'id': tickerId,
+                'errorCode': 321,
+                'errorMsg': 'Error validating request:-\'bC\' : cause - '
+                    'Snapshot market data subscription is not applicable '
+                    'to generic ticks'
+            })
+            return
+        ticks = self.market.ticks(contract, snapshot, genericTickList)
+        if ticks is None:
+            self._deliver(0, 'error', {
+                'id': tickerId,
+                'errorCode': 200,
+                'errorMsg': 'No security definition has been found for the '
+                    'request'
+            })
+            return
+        stream = None
+        if not snapshot:
+            stream = tickerId
+            with self._condition:
+                self._streams.add(tickerId)
+        for offset, name, fields in ticks:
+            fields = dict(fields, tickerId=tickerId)
+            self._deliver(offset, name, fields, stream)
+        if snapshot:
+            self._deliver(
+                max([t[0] for t in ticks] or [0]),
+                'tickSnapshotEnd',
+                {'reqId': tickerId}
+            )
+
+    def cancelMktData(self, tickerId):
+        self._count('cancelMktData')
+        with self._condition:
+            self._streams.discard(tickerId)
+
+    def reqMktDepth(self, tickerId, contract, numRows):
+        self._count('reqMktDepth')
+        depth = getattr(self.market, 'depth', None)
+        updates = depth(contract, numRows) if depth is not None else None
+        if updates is None:
+            self._deliver(0, 'error', {
+                'id': tickerId,
+                'errorCode': 200,
+                'errorMsg': 'No security definition has been found for the '
+                    'request'
+            })
+            return
+        with self._condition:
+            self._streams.add(tickerId)
+        for offset, name, fields in updates:
+            fields = dict(fields, tickerId=tickerId)
+            self._deliver(offset, name, fields, tickerId)
+
+    def cancelMktDepth(self, tickerId):
+        self._count('cancelMktDepth')
+        with self._condition:
+            self._streams.discard(tickerId)
+
+    def _order_status(self, order_id, status, filled, remaining, price):
+        self._deliver(0, 'orderStatus', {
+            'orderId': order_id,
+            'status': status,
+            'filled': filled,
+            'remaining': remaining,
+            'avgFillPrice': price,
+            'permId': order_id,
+            'parentId': 0,
+            'lastFillPrice': price,
+            'clientId': 0,
+            'whyHeld': None
+        })
+
+    def placeOrder(self, id, contract, order):
+        self._count('placeOrder')
+        state = OrderState()
+        state.m_status = 'Submitted'
+        self._deliver(0, 'openOrder', {
+            'orderId': id,
+            'contract': contract,
+            'order': order,
+            'orderState': state
+        })
+        self._order_status(id, 'Submitted', 0, order.m_totalQuantity, 0.0)
+        if not self.fill_orders:
+            with self._condition:
+                self._resting[id] = (contract, order)
+            return
+        if order.m_orderType == 'LMT':
+            price = order.m_lmtPrice
+        else:
+            last = [t for t in self.market.ticks(contract, True) or ()
+                if t[1] == 'tickPrice' and t[2]['field'] == 4]
+            price = last[0][2]['price'] if last else 0.0
+        execution = Execution()
+        execution.m_orderId = id
+        execution.m_execId = '%08d.01' % next(self._executions)
+        execution.m_side = 'BOT' if order.m_action == 'BUY' else 'SLD'
+        execution.m_shares = order.m_totalQuantity
+        execution.m_cumQty = order.m_totalQuantity
+        execution.m_price = price
+        execution.m_avgPrice = price
+        self._deliver(0, 'execDetails', {
+            'reqId': -1,
+            'contract': contract,
+            'execution': execution
+        })
+        self._order_status(id, 'Filled', order.m_totalQuantity, 0, price)
+
+    def cancelOrder(self, id):
+        self._count('cancelOrder')
+        with self._condition:
+            resting = self._resting.pop(id, None)
+        if resting is not None:
+            # TWS confirms with an error, ahead of the order status
+            self._deliver(0, 'error', {
+                'id': id,
+                'errorCode': 202,
+                'errorMsg': 'Order Canceled - reason:'
+            })
+            self._order_status(
+                id,
+                'Cancelled',
+                0,
+                resting[1].m_totalQuantity,
+                0.0
+            )
+
+def _option_ticks(contract, underlying):
+    """Made up option computations for *contract*"""
+    strike = contract.m_strike or underlying
+    moneyness = (underlying - strike) / underlying
+    call = contract.m_right in ('C', 'CALL')
+    delta = 0.5 + max(-0.45, min(0.45, moneyness * 5))
+    if not call:
+        delta -= 1
+        intrinsic = max(strike - underlying, 0)
+    else:
+        intrinsic = max(underlying - strike, 0)
+    vol = 0.2 + abs(moneyness) / 2
+    ticks = []
+    for field, bump in ((10, -0.01), (11, 0.01), (12, 0.0), (13, 0.0)):
+        ticks.append((0, 'tickOptionComputation', {
+            'field': field,
+            'impliedVol': vol + bump,
+            'delta': delta,
+            'optPrice': intrinsic + 1 + bump * 10,
+            'pvDividend': 0.0,
+            'gamma': 0.02,
+            'vega': 0.1,
+            'theta': -0.05,
+            'undPrice': underlying
+        }))
+    return ticks
+
+def _generic_ticks(conid, generic_ticks):
+    """Made up ticks for the generic ticks requested"""
+    ticks = []
+    for generic_tick in generic_ticks.split(','):
+        if generic_tick == '100':
+            ticks.append((0, 'tickSize', {'field': 29, 'size': 1000 + conid}))
+            ticks.append((0, 'tickSize', {'field': 30, 'size': 800 + conid}))
+        elif generic_tick == '101':
+            ticks.append((0, 'tickSize', {'field': 27, 'size': 5000 + conid}))
+            ticks.append((0, 'tickSize', {'field': 28, 'size': 4000 + conid}))
+        elif generic_tick == '104':
+            ticks.append((0, 'tickGeneric', {'tickType': 23, 'value': 0.18}))
+        elif generic_tick == '106':
+            ticks.append((0, 'tickGeneric', {
+                'tickType': 24,
+                'value': 0.2 + (conid % 10) / 100.0
+            }))
+        elif generic_tick == '165':
+            ticks.append((0, 'tickSize', {'field': 21, 'size': 100000}))
+    return ticks
+
+class SyntheticMarket(object):
+    """
+    Made up quotes, derived from the conId of the contract so that they are
+    the same from one run to the next. Options also get option
+    computations, and streaming requests the generic ticks they ask for.
+
+    Streaming requests get *updates* more bid and ask ticks, one every
+    *interval* seconds, following a random walk. Market depth requests get
+    a book a cent wide per level, whose best levels follow the same walk.
+    """
+
+    def __init__(self, updates=0, interval=1.0):
+        self.updates = updates
+        self.interval = interval
+
+    def ticks(self, contract, snapshot, generic_ticks=''):
+        """
+        Returns the ticks TWS sends for *contract*, as (delay, message type,
+        fields) tuples.
+        """
+        conid = contract.m_conId or 0
+        underlying = 50.0 + conid % 100
+        if contract.m_secType in ('OPT', 'FOP'):
+            price = 1.0 + (conid % 50) / 10.0
+        else:
+            price = underlying
+        ticks = [
+            (0, 'tickPrice', {'field': 1, 'price': price - 0.01,
+                'canAutoExecute': 1}),
+            (0, 'tickPrice', {'field': 2, 'price': price + 0.01,
+                'canAutoExecute': 1}),
+            (0, 'tickPrice', {'field': 4, 'price': price,
+                'canAutoExecute': 0}),
+            (0, 'tickSize', {'field': 0, 'size': 100}),
+            (0, 'tickSize', {'field': 3, 'size': 100}),
+            (0, 'tickSize', {'field': 8, 'size': 10000 + conid}),
+            (0, 'tickString', {'tickType': 45, 'value': str(int(time()))})
+        ]
+        if contract.m_secType in ('OPT', 'FOP'):
+            ticks.extend(_option_ticks(contract, underlying))
+        ticks.extend(_generic_ticks(conid, generic_ticks))
+        if not snapshot:
+            walk = Random(conid)
+            for i in range(1, self.updates + 1):
+                price = max(price + walk.choice((-0.01, 0.01)), 0.01)
+                for field, tick in ((1, price - 0.01), (2, price + 0.01)):
+                    ticks.append((i * self.interval, 'tickPrice', {
+                        'field': field,
+                        'price': tick,
+                        'canAutoExecute': 1
+                    }))
+        return ticks
+
+    def depth(self, contract, rows):
+        """
+        Returns the *updateMktDepth* messages TWS sends for *contract*, as
+        (delay, message type, fields) tuples.
+        """
+        conid = contract.m_conId or 0
+        if contract.m_secType in ('OPT', 'FOP'):
+            price = 1.0 + (conid % 50) / 10.0
+        else:
+            price = 50.0 + conid % 100
+        updates = []
+        for position in range(rows):
+            # sides are 0 for asks and 1 for bids
+            for side, sign in ((0, 1), (1, -1)):
+                updates.append((0, 'updateMktDepth', {
+                    'position': position,
+                    'operation': 0,
+                    'side': side,
+                    'price': round(price + sign * 0.01 * (position + 1), 2),
+                    'size': 100 * (position + 1)
+                }))
+        walk = Random(conid)
+        for i in range(1, self.updates + 1):
+            price = max(price + walk.choice((-0.01, 0.01)), 0.01)
+            for side, sign in ((0, 1), (1, -1)):
+                updates.append((i * self.interval, 'updateMktDepth', {
+                    'position': 0,
+                    'operation': 1,
+                    'side': side,
+                    'price': round(price + sign * 0.01, 2),
+                    'size': 100
+                }))
+        return updates
+
+class RecordedMarket(object):
+    """
+    Replays the ticks recorded by a *TickRecorder* (as a NumPy array, see
+    *recorder.load_ticks*). Snapshots get the last recorded value of each
+    field; streaming requests get every recorded tick, spaced as they were
+    recorded divided by *speed* (all at once if *speed* is *None*).
+    Contracts which were not recorded are rejected like TWS does.
+    """
+
+    def __init__(self, ticks, speed=None):
+        import numpy as np
+        self.speed = speed
+        order = np.argsort(ticks['conid'], kind='mergesort')
+        self._ticks = ticks[order]
+        conids, first = np.unique(self._ticks['conid'], return_index=True)
+        last = list(first[1:]) + [len(self._ticks)]
+        # conId -> slice of its ticks
+        self._ranges = dict(
+            (int(c), (int(s), int(e))) for c, s, e in zip(conids, first, last)
+        )
+
+    @classmethod
+    def from_directory(cls, directory, prefix='ticks', speed=None):
+        """Replays the ticks recorded in *directory*"""
+        from untws.recorder import load_ticks
+        return cls(load_ticks(directory, prefix), speed)
+
+    def ticks(self, contract, snapshot, generic_ticks=''):
+        """
+        Same as *SyntheticMarket.ticks*; only the recorded ticks are
+        replayed, whatever *generic_ticks* asks for
+        """
+        if contract.m_conId not in self._ranges:
+            return None
+        start, end = self._ranges[contract.m_conId]
+        records = self._ticks[start:end]
+        if snapshot:
+            # the last value of each field, in the order they were recorded
+            latest = {}
+            for i, record in enumerate(records):
+                latest[(record['kind'], record['field'])] = i
+            records = records[sorted(latest.values())]
+        first = records['time'][0] if len(records) else 0
+        ticks = []
+        for record in records:
+            if snapshot or self.speed is None:
+                delay = 0
+            else:
+                delay = (record['time'] - first) / self.speed
+            ticks.append(_replay(delay, record))
+        return ticks
+
+def _replay(delay, record):
+    """Converts a recorded tick to a (delay, message type, fields) tuple"""
+    from untws.recorder import TICK_PRICE, TICK_SIZE
+    field = int(record['field'])
+    if record['kind'] == TICK_PRICE:
+        return (delay, 'tickPrice', {
+            'field': field,
+            'price': float(record['value']),
+            'canAutoExecute': 0
+        })
+    if record['kind'] == TICK_SIZE:
+        return (delay, 'tickSize', {
+            'field': field,
+            'size': int(record['value'])
+        })
+    return (delay, 'tickOptionComputation', {
+        'field': field,
+        'impliedVol': float(record['implied_vol']),
+        'delta': float(record['delta']),
+        'optPrice': float(record['value']),
+        'pvDividend': float(record['pv_dividends']),
+        'gamma': float(record['gamma']),
+        'vega': float(record['vega']),
+        'theta': float(record['theta']),
+        'undPrice': float(record['underlying_price'])
+    })
+
+def synthetic_portfolio(size, accounts=('DU000001',), options=0.5,
+    expiries=12):
+    """
+    Makes up a portfolio of *size* positions, spread over *accounts*, of
+    which a fraction *options* are options (over *expiries* monthly
+    expiries) and the rest stocks. Returns the fields of the
+    *updatePortfolio* messages.
+    """
+    first = date(2013, 9, 20)
+    portfolio = []
+    for i in range(size):
+        c = Contract()
+        c.m_conId = i + 1
+        c.m_currency = 'USD'
+        c.m_exchange = 'SMART'
+        c.m_primaryExch = 'NYSE'
+        c.m_symbol = 'SYM%d' % (i % 500)
+        if i < size * options:
+            expiry = first + timedelta(days=28 * (i % expiries))
+            c.m_secType = 'OPT'
+            c.m_right = 'C' if i % 2 else 'P'
+            c.m_strike = 50.0 + i % 100
+            c.m_expiry = expiry.strftime('%Y%m%d')
+            c.m_multiplier = '100'
+            c.m_localSymbol = '%-6s%s%s%08d' % (
+                c.m_symbol,
+                expiry.strftime('%y%m%d'),
+                c.m_right,
+                c.m_strike * 1000
+            )
+            price = 1.0 + (i % 50) / 10.0
+            multiplier = 100
+        else:
+            c.m_secType = 'STK'
+            c.m_localSymbol = c.m_symbol
+            price = 50.0 + i % 100
+            multiplier = 1
+        quantity = (i % 10 + 1) * (1 if i % 3 else -1)
+        portfolio.append({
+            'contract': c,
+            'position': quantity,
+            'marketPrice': price,
+            'marketValue': price * quantity * multiplier,
+            'averageCost': price * multiplier,
+            'unrealizedPNL': 0.0,
+            'realizedPNL': 0.0,
+            'accountName': accounts[i % len(accounts)]
+        })
+    return portfolio
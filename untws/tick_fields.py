@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# tick_fields.py
+#
+# Copyright (c) 2013 Maan Bsat. All rights reserved.
+
+"""
+The market data fields TWS sends, and maps of the fields to request and
+decode out of the ticks.
+"""
+
+__all__ = [
+    'TickField', 'FieldMap', 'field_map', 'known_tick_types', 'TICK_FIELDS',
+    'DEFAULT_FIELDS', 'TICK_MESSAGES'
+]
+
+# message type -> (attribute holding the tick type, attribute holding the
+# value), for the messages carrying a single field
+TICK_MESSAGES = {
+    'tickPrice': ('field', 'price'),
+    'tickSize': ('field', 'size'),
+    'tickGeneric': ('tickType', 'value'),
+    'tickString': ('tickType', 'value')
+}
+
+class TickField(object):
+    """
+    A market data field: the message type and tick type TWS sends it as,
+    the type of its values (*float* or *int*), and the generic tick to
+    request for TWS to send it (*None* if it is sent by default).
+    """
+
+    def __init__(self, name, message_type, tick_type, kind=float,
+        generic_tick=None):
+        self.name = name
+        self.message_type = message_type
+        self.tick_type = tick_type
+        self.kind = kind
+        self.generic_tick = generic_tick
+
+    def __repr__(self):
+        return "<TickField(%s)>" % self.name
+
+# the fields we know how to decode
+TICK_FIELDS = (
+    TickField('bid', 'tickPrice', 1),
+    TickField('ask', 'tickPrice', 2),
+    TickField('last', 'tickPrice', 4),
+    TickField('high', 'tickPrice', 6),
+    TickField('low', 'tickPrice', 7),
+    TickField('close', 'tickPrice', 9),
+    TickField('open', 'tickPrice', 14),
+    TickField('bid_size', 'tickSize', 0, int),
+    TickField('ask_size', 'tickSize', 3, int),
+    TickField('last_size', 'tickSize', 5, int),
+    TickField('volume', 'tickSize', 8, int),
+    # seconds since the epoch
+    TickField('last_timestamp', 'tickString', 45, int),
+    TickField('average_volume', 'tickSize', 21, int, 165),
+    TickField('call_open_interest', 'tickSize', 27, int, 101),
+    TickField('put_open_interest', 'tickSize', 28, int, 101),
+    TickField('call_volume', 'tickSize', 29, int, 100),
+    TickField('put_volume', 'tickSize', 30, int, 100),
+    TickField('historical_vol', 'tickGeneric', 23, float, 104),
+    TickField('implied_vol', 'tickGeneric', 24, float, 106)
+)
+
+_BY_NAME = dict((f.name, f) for f in TICK_FIELDS)
+
+# the fields quotes have unless told otherwise
+DEFAULT_FIELDS = ('bid', 'ask', 'last', 'high', 'low', 'close')
+
+class FieldMap(object):
+    """
+    The market data fields to decode (names of *TICK_FIELDS*, in order);
+    ticks of the other fields are ignored. *generic_ticks* is the generic
+    tick list to pass to *reqMktData* for TWS to send them.
+
+    *table* is computed once, and maps each message type to the attributes
+    holding its tick type and value, and a dictionary of tick type ->
+    (field name, type), so that decoding a tick takes two lookups.
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        unknown = [f for f in fields if f not in _BY_NAME]
+        if unknown:
+            raise ValueError(
+                "Unknown market data fields: %s" % ', '.join(unknown)
+            )
+        self.fields = tuple(fields)
+        self.table = {}
+        generic_ticks = set()
+        for name in self.fields:
+            field = _BY_NAME[name]
+            tick_attribute, value_attribute = TICK_MESSAGES[field.message_type]
+            entry = self.table.setdefault(
+                field.message_type,
+                (tick_attribute, value_attribute, {})
+            )
+            entry[2][field.tick_type] = (name, field.kind)
+            if field.generic_tick is not None:
+                generic_ticks.add(field.generic_tick)
+        self.generic_ticks = ','.join(str(t) for t in sorted(generic_ticks))
+
+    def kind(self, name):
+        """The type of the values of field *name*"""
+        return _BY_NAME[name].kind
+
+    def decode(self, data, msg):
+        """
+        Records the value of a tick message into the dictionary *data*, if
+        it is one of our fields. Returns *True* if it was.
+        """
+        entry = self.table.get(msg.typeName)
+        if entry is None:
+            return False
+        field = entry[2].get(getattr(msg, entry[0]))
+        if field is None:
+            return False
+        data[field[0]] = field[1](getattr(msg, entry[1]))
+        return True
+
+    def __repr__(self):
+        return "<FieldMap(%s)>" % ', '.join(self.fields)
+
+def field_map(fields):
+    """
+    A *FieldMap* out of *fields*: a *FieldMap* (returned as is), or a list
+    of field names
+    """
+    if isinstance(fields, FieldMap):
+        return fields
+    return FieldMap(fields)
+
+def known_tick_types():
+    """Message type -> {tick type: field name} of all the fields we know"""
+    known = {}
+    for field in TICK_FIELDS:
+        known.setdefault(field.message_type, {})[field.tick_type] = field.name
+    return known